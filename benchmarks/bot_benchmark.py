@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# bot_benchmark.py - Benchmarks for the hot paths of several bots, run against
+#   a fake XMPP bridge (fake_bridge.py) so that no XMPP account is needed.
+#   The workloads are synthetic and generated from a fixed random seed, so
+#   results from different commits can be compared with each other.  The
+#   scenarios are:
+#
+#   system_bot_tick - One pass through Systembot's system checks (load, CPU
+#       idle time, disk, memory, temperature, and the process watchdog), which
+#       is what the bot does every time its main loop runs.
+#   kodi_bot_search - Kodi Bot searching a synthetic music library (100,000
+#       tracks by default) for song titles.
+#   web_search_bot_parse - Web Search Bot parsing a batch of search requests.
+#   copy_bot_copy - Copy Bot, running as a separate process, copying a
+#       directory full of files when asked to through the fake bridge.
+#
+#   Every run can be appended to a results file (one JSON document per line,
+#   tagged with the commit it was run against) and compared with an earlier
+#   run.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import argparse
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import requests
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_bridge
+
+# Constants.
+# Top level directory of the Exocortex Halo repository.
+halo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which more than one bot has its own copy of.  They have to be thrown
+# away before loading another bot's modules.
+shared_module_names = ["dispatcher", "globals", "instrumentation", "openwrt",
+    "outbox", "parser", "processes", "system_stats", "kodi_library", "help"]
+
+# Words that synthetic track titles are made out of.
+title_words = ["love", "night", "city", "dream", "fire", "heart", "rain",
+    "blue", "electric", "ghost", "machine", "midnight", "neon", "ocean",
+    "paper", "radio", "shadow", "silver", "summer", "thunder", "velvet",
+    "wild", "winter", "world", "zero", "angel", "broken", "crystal", "dark",
+    "echo", "falling", "golden", "highway", "island", "jungle", "kingdom",
+    "light", "memory", "northern", "orbit", "parade", "quiet", "river",
+    "signal", "static", "tokyo", "under", "violet", "wire", "yesterday"]
+
+# Song titles Kodi Bot is asked to find.
+kodi_bot_searches = ["electric dream", "midnight radio", "silver river",
+    "this title is not in the library"]
+
+# Requests Web Search Bot is asked to parse.  The last one isn't a valid
+# request, so the bot tells the user (by way of the fake bridge) that it
+# didn't understand.
+web_search_bot_requests = ["help", "list search engines",
+    "get top ten hits for exocortex", "top 5 hits for halo",
+    "send me top five hits for xmpp bridges",
+    "search ddg for python pyparsing", "list categories",
+    "search images for top 5 hits for cute cats",
+    "search news for big cute cats", "make me a sandwich"]
+
+# Functions.
+# load_module(): Loads a module out of a bot's directory.  Several bots have
+#   modules with the same names, so they're thrown away first.  Takes two
+#   arguments, the name of the bot's directory and the name of the module.
+#   Returns the module.
+def load_module(bot_directory, module_name):
+    for module in shared_module_names:
+        sys.modules.pop(module, None)
+    sys.path.insert(0, os.path.join(halo_directory, bot_directory))
+    try:
+        return importlib.import_module(module_name)
+    finally:
+        sys.path.pop(0)
+
+# message_sender(): Builds a send_message_to_user() function for a bot which
+#   sends its messages to the fake bridge.  Takes two arguments, the fake
+#   bridge and the name of the bot.  Returns the function.
+def message_sender(bridge, bot_name):
+    def send_message_to_user(message):
+        requests.put(bridge.url() + "replies",
+            headers={"Content-type": "application/json"},
+            data=json.dumps({"name": bot_name, "reply": message, "id": None}))
+    return send_message_to_user
+
+# time_rounds(): Runs a function a number of times and times each run.
+#   Takes two arguments, the function and the number of rounds.  Returns a
+#   list of how long each round took, in seconds.
+def time_rounds(function, rounds):
+    timings = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+# system_bot_tick(): Benchmarks one pass through Systembot's system checks.
+def system_bot_tick(args, bridge):
+    alerts = load_module("system_bot", "alerts")
+    processes = load_module("system_bot", "processes")
+    system_stats = load_module("system_bot", "system_stats")
+    send_message_to_user = message_sender(bridge, "Systembot")
+
+    # A process that doesn't exist, so the watchdog has to look through the
+    # whole process table.  It's never restarted.
+    processes_to_monitor = [["no_such_process_for_benchmarking", "true"]]
+
+    # The alert rules the bot starts with out of the box.
+    alerts.configure(alerts.default_rules(3600, 90.0, 15.0, 2, 2, 100))
+
+    def tick():
+        system_stats.take_snapshot()
+        system_stats.check_system(send_message_to_user)
+        processes.check_process_list(processes_to_monitor)
+
+    return {"timings": time_rounds(tick, args.rounds or 50)}
+
+# kodi_bot_search(): Benchmarks Kodi Bot searching for song titles in a
+#   synthetic music library.
+def kodi_bot_search(args, bridge):
+    kodi_library = load_module("kodi_bot", "kodi_library")
+
+    # Build the same library every time.
+    generator = random.Random(args.seed)
+    library = []
+    for i in range(args.library_size):
+        library.append({"songid": i,
+            "label": " ".join(generator.sample(title_words,
+                generator.randint(1, 4))).title()})
+
+    def search():
+        for search_term in kodi_bot_searches:
+            kodi_library.search_media_library_songs(search_term, library, 80)
+
+    return {"timings": time_rounds(search, args.rounds or 3),
+        "library_size": args.library_size}
+
+# web_search_bot_parse(): Benchmarks Web Search Bot parsing search requests.
+def web_search_bot_parse(args, bridge):
+    parser = load_module("web_search_bot", "parser")
+    parser.globals.server = bridge.url()
+    parser.globals.bot_name = "WebSearchBot"
+    parser.globals.search_engines = [
+        {"name": "duckduckgo", "shortcut": "ddg"},
+        {"name": "wikipedia", "shortcut": "wp"}]
+    parser.globals.search_categories = ["general", "images", "it", "map",
+        "music", "news", "science", "videos"]
+
+    def parse():
+        for search_request in web_search_bot_requests:
+            parser.parse_search_request(search_request)
+
+    return {"timings": time_rounds(parse, args.rounds or 100)}
+
+# copy_bot_copy(): Benchmarks Copy Bot copying a directory of files.  The bot
+#   runs as its own process and gets its orders from the fake bridge, so this
+#   measures the whole trip: picking up the command, parsing it, copying the
+#   files, and answering.
+def copy_bot_copy(args, bridge):
+    bot_name = "BenchmarkCopyBot"
+    work_directory = tempfile.mkdtemp(prefix="copy_bot_benchmark_")
+    bot = None
+
+    try:
+        # Build the same directory of files every time.
+        generator = random.Random(args.seed)
+        source = os.path.join(work_directory, "source")
+        os.mkdir(source)
+        for i in range(args.files):
+            with open(os.path.join(source, "file%05d.dat" % i), "wb") as file:
+                file.write(bytes(generator.getrandbits(8)
+                    for j in range(args.file_size)))
+
+        config_file = os.path.join(work_directory, "copy_bot.conf")
+        with open(config_file, "w") as file:
+            file.write("[DEFAULT]\n")
+            file.write("queue = " + bridge.url() + "\n")
+            file.write("bot_name = " + bot_name + "\n")
+            file.write("loglevel = warning\n")
+            file.write("polling_time = 0.05\n")
+
+        bridge.add_agent(bot_name)
+        bot = subprocess.Popen([sys.executable,
+            os.path.join(halo_directory, "copy_bot", "copy_bot.py"),
+            "--config", config_file], cwd=work_directory)
+        if not bridge.wait_for_replies(bot_name, 1, 30):
+            return {"skipped": "Copy Bot didn't come online."}
+
+        timings = []
+        for i in range(args.rounds or 5):
+            destination = os.path.join(work_directory, "destination%d" % i)
+            os.mkdir(destination)
+            expected = len(bridge.wait_for_replies(bot_name, 0, 0)) + 1
+            bridge.feed(bot_name, "copy all files in " + source + " to " +
+                destination)
+            replies = bridge.wait_for_replies(bot_name, expected, 300)
+            if len(replies) < expected:
+                return {"skipped": "Copy Bot didn't answer."}
+            timings.append(replies[-1]["handler_time"])
+            shutil.rmtree(destination)
+
+        return {"timings": timings, "files": args.files,
+            "file_size": args.file_size}
+    finally:
+        if bot:
+            bot.terminate()
+            bot.wait()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+# Every scenario, in the order they run in.
+scenarios = {"system_bot_tick": system_bot_tick,
+    "kodi_bot_search": kodi_bot_search,
+    "web_search_bot_parse": web_search_bot_parse,
+    "copy_bot_copy": copy_bot_copy}
+
+# summarize(): Turns a scenario's timings into milliseconds.  Takes one
+#   argument, the hash table the scenario returned.  Returns the hash table
+#   with the timings replaced by a summary.
+def summarize(results):
+    if "timings" not in results:
+        return results
+    timings = [i * 1000.0 for i in results.pop("timings")]
+    results["rounds"] = len(timings)
+    results["min_ms"] = min(timings)
+    results["median_ms"] = statistics.median(timings)
+    results["mean_ms"] = statistics.mean(timings)
+    return results
+
+# current_commit(): Figures out which commit the benchmarks are running
+#   against.  Returns the output of `git describe --always --dirty` or
+#   "unknown".
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "describe", "--always",
+            "--dirty"], cwd=halo_directory,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+# load_previous_run(): Loads the last run recorded in a results file.  Takes
+#   one argument, the path to the file.  Returns the run or None.
+def load_previous_run(path):
+    previous_run = None
+    try:
+        with open(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    previous_run = json.loads(line)
+    except Exception as e:
+        logging.warning("Unable to read results file " + path + ": " + str(e))
+    return previous_run
+
+# Core code...
+argparser = argparse.ArgumentParser(description="Benchmarks for the hot paths of several bots, run against a fake XMPP bridge.")
+
+argparser.add_argument("--scenario", action="append", choices=list(scenarios),
+    help="Scenario to run.  Can be given more than once.  Defaults to all of them.")
+argparser.add_argument("--rounds", action="store", type=int, default=0,
+    help="Number of rounds to run each scenario for.  Every scenario has its own default.")
+argparser.add_argument("--seed", action="store", type=int, default=1,
+    help="Seed for generating synthetic workloads.  Defaults to 1.")
+argparser.add_argument("--library-size", action="store", type=int,
+    default=100000, help="Number of tracks in Kodi Bot's synthetic library.  Defaults to 100000.")
+argparser.add_argument("--files", action="store", type=int, default=500,
+    help="Number of files Copy Bot copies.  Defaults to 500.")
+argparser.add_argument("--file-size", action="store", type=int, default=4096,
+    help="Size in bytes of each file Copy Bot copies.  Defaults to 4096.")
+argparser.add_argument("--output", action="store",
+    help="File to append the results to, one JSON document per line.")
+argparser.add_argument("--compare", action="store",
+    help="Results file to compare against.  The last run in it is used.")
+argparser.add_argument("--loglevel", action="store", default="warning",
+    help="Valid log levels: critical, error, warning, info, debug, notset.  Defaults to warning.")
+
+args = argparser.parse_args()
+logging.basicConfig(level=args.loglevel.upper(),
+    format="%(levelname)s: %(message)s")
+
+bridge = fake_bridge.FakeBridge()
+bridge.start()
+
+run = {"commit": current_commit(), "timestamp": time.time(),
+    "python": platform.python_version(), "machine": platform.machine(),
+    "cpus": os.cpu_count(), "seed": args.seed, "scenarios": {}}
+for name in args.scenario or list(scenarios):
+    logging.info("Running scenario " + name + ".")
+    try:
+        results = scenarios[name](args, bridge)
+    except ImportError as e:
+        results = {"skipped": str(e)}
+    run["scenarios"][name] = summarize(results)
+bridge.stop()
+
+previous_run = None
+if args.compare:
+    previous_run = load_previous_run(args.compare)
+
+print("Commit: " + run["commit"])
+if previous_run:
+    print("Compared with: " + previous_run["commit"])
+print("%-22s %8s %12s %12s %10s" % ("scenario", "rounds", "min (ms)",
+    "median (ms)", "change"))
+for name in run["scenarios"]:
+    results = run["scenarios"][name]
+    if "skipped" in results:
+        print("%-22s skipped: %s" % (name, results["skipped"]))
+        continue
+    change = ""
+    if previous_run and "median_ms" in previous_run["scenarios"].get(name, {}):
+        change = "%+.1f%%" % ((results["median_ms"] /
+            previous_run["scenarios"][name]["median_ms"] - 1.0) * 100.0)
+    print("%-22s %8d %12.2f %12.2f %10s" % (name, results["rounds"],
+        results["min_ms"], results["median_ms"], change))
+
+if args.output:
+    with open(args.output, "a") as file:
+        file.write(json.dumps(run) + "\n")
+
+# Fin.
+sys.exit(0)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# fake_bridge.py - A stand-in for the Exocortex XMPP Bridge that doesn't need
+#   an XMPP account.  It speaks the same REST API the bots use: GET /<agent>
+#   hands out the next command for that agent (or {"command": "no commands"}),
+#   and PUT /replies accepts a reply or a JSON list of replies.  Commands come
+#   from a script instead of from XMPP, and replies are recorded (and
+#   optionally written to a file) instead of being sent anywhere.
+#
+#   Scripts are text files with one command per line, written the same way
+#   you'd send them to the XMPP bridge:
+#
+#   Systembot, system load.
+#   Waldo, copy all files in /tmp/foo to /tmp/bar
+#
+#   Blank lines and lines starting with # are skipped.
+#
+#   It can be run on its own (point a bot's "queue" setting at it) or imported
+#   by benchmarks, which is what bot_benchmark.py does.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+# Classes.
+# FakeBridge: Class that holds the message queues of a fake XMPP bridge, the
+#   replies the bots have sent to it, and the HTTP server the bots talk to.
+class FakeBridge(object):
+
+    # Initialize new instances of the class.  Takes two optional arguments,
+    # the address and port to listen on.  Port 0 picks a free port.
+    def __init__(self, host="127.0.0.1", port=0):
+        # Hash table of agent names to lists of commands waiting for them.
+        # Each command is a hash table with the command and its ID.
+        self.message_queue = {}
+
+        # Every reply the bots have sent, in the order they arrived.
+        self.replies = []
+
+        # When each command was picked up, keyed by correlation ID, and when
+        # each agent last picked up a command, keyed by agent name.  Used to
+        # work out how long a bot took to answer.  Bots which don't send the
+        # correlation ID back are matched up with the last command they
+        # picked up, like the real bridge does.
+        self.dispatched = {}
+        self.last_dispatched = {}
+
+        # Message IDs of the replies that have been accepted, so that
+        # duplicates can be thrown away the same way the real bridge does.
+        self.message_ids = set()
+
+        # Optional path to a file that replies are appended to.
+        self.replies_file = ""
+
+        # The HTTP server runs in its own thread.
+        self.lock = threading.Condition()
+        self.server = HTTPServer((host, port), _FakeBridgeHandler)
+        self.server.bridge = self
+        self.thread = None
+
+    # url(): Returns the base URL of the fake bridge, which is what goes into
+    #   a bot's "queue" setting.
+    def url(self):
+        return "http://%s:%d/" % self.server.server_address
+
+    # start(): Starts answering HTTP requests in a background thread.
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+            daemon=True)
+        self.thread.start()
+        logging.debug("Fake bridge listening on " + self.url())
+
+    # stop(): Stops answering HTTP requests.
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # add_agent(): Creates an empty message queue for an agent.  Takes one
+    #   argument, the name of the agent.
+    def add_agent(self, agent):
+        with self.lock:
+            self.message_queue.setdefault(agent, [])
+
+    # feed(): Adds a command to an agent's message queue.  Takes two
+    #   arguments, the name of the agent and the command.  Returns the
+    #   command's correlation ID.
+    def feed(self, agent, command):
+        command_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.message_queue.setdefault(agent, []).append({
+                "command": command, "id": command_id})
+        return command_id
+
+    # load_script(): Feeds every command in a script to the fake bridge.
+    #   Takes one argument, the path to the script.  Returns the number of
+    #   commands fed.
+    def load_script(self, path):
+        count = 0
+        with open(path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if "," not in line:
+                    logging.warning("Skipping script line without an agent name: " + line)
+                    continue
+                (agent, command) = line.split(",", 1)
+                self.feed(agent.strip(), command.strip())
+                count = count + 1
+        return count
+
+    # wait_for_replies(): Waits until a given number of replies have arrived
+    #   from an agent.  Takes three arguments, the name of the agent, the
+    #   number of replies, and the maximum number of seconds to wait.
+    #   Returns the agent's replies, which might be fewer than asked for if
+    #   the wait timed out.
+    def wait_for_replies(self, agent, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                replies = [i for i in self.replies if i["name"] == agent]
+                remaining = deadline - time.monotonic()
+                if len(replies) >= count or remaining <= 0:
+                    return replies
+                self.lock.wait(remaining)
+
+    # _dispatch(): Helper method that pops the next command for an agent.
+    #   Returns the command or None if there isn't one.
+    def _dispatch(self, agent):
+        with self.lock:
+            if not self.message_queue[agent]:
+                return None
+            command = self.message_queue[agent].pop(0)
+            self.dispatched[command["id"]] = time.monotonic()
+            self.last_dispatched[agent] = self.dispatched[command["id"]]
+            return command
+
+    # _reply(): Helper method that records a reply from a bot.  Takes one
+    #   argument, the deserialized reply.
+    def _reply(self, reply):
+        now = time.monotonic()
+        with self.lock:
+            if reply.get("message_id"):
+                if reply["message_id"] in self.message_ids:
+                    return
+                self.message_ids.add(reply["message_id"])
+
+            record = {"name": reply["name"], "reply": reply["reply"],
+                "id": reply.get("id"), "timestamp": time.time(),
+                "handler_time": None}
+            if record["id"] in self.dispatched:
+                record["handler_time"] = now - self.dispatched[record["id"]]
+            elif "id" not in reply and reply["name"] in self.last_dispatched:
+                record["handler_time"] = now - \
+                    self.last_dispatched[reply["name"]]
+            self.replies.append(record)
+            self.lock.notify_all()
+
+        logging.info("Reply from " + record["name"] + ": " + record["reply"])
+        if self.replies_file:
+            with open(self.replies_file, "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+# _FakeBridgeHandler: Subclass that implements the REST API of the XMPP
+#   bridge on top of a FakeBridge.
+class _FakeBridgeHandler(BaseHTTPRequestHandler):
+
+    # Process HTTP/1.1 GET requests.
+    def do_GET(self):
+        bridge = self.server.bridge
+
+        if self.path == "/":
+            with bridge.lock:
+                self._send_json(200, {"active agents":
+                    list(bridge.message_queue.keys())})
+            return
+
+        agent = self.path.strip("/")
+        if agent not in bridge.message_queue:
+            self._send_json(404, {agent: "not found"})
+            return
+
+        command = bridge._dispatch(agent)
+        if not command:
+            self._send_json(200, {"command": "no commands"})
+            return
+        self._send_json(200, {"command": command["command"],
+            "id": command["id"]})
+
+    # Process HTTP/1.1 PUT requests.
+    def do_PUT(self):
+        bridge = self.server.bridge
+
+        if self.path.strip("/") != "replies":
+            self._send_json(404, {self.path.strip("/"): "not found"})
+            return
+
+        try:
+            content = self.rfile.read(int(self.headers["Content-Length"]))
+            replies = json.loads(content.decode())
+        except:
+            self._send_json(400, {"result": None,
+                "error": "You need to send valid JSON."})
+            return
+
+        # A single reply is a batch of one.
+        if not isinstance(replies, list):
+            replies = [replies]
+        for reply in replies:
+            if not isinstance(reply, dict) or "name" not in reply or \
+                    "reply" not in reply:
+                self._send_json(400, {"result": None,
+                    "error": "All required keys were not found in the JSON document."})
+                return
+
+        for reply in replies:
+            bridge._reply(reply)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # Send a JSON document with an HTTP status code.
+    def _send_json(self, code, document):
+        message = json.dumps(document).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    # Keep the HTTP server from writing every request to stderr.
+    def log_message(self, format, *args):
+        logging.debug("Fake bridge: " + (format % args))
+
+# Core code...
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="A stand-in for the Exocortex XMPP Bridge which feeds bots commands from a script and records their replies.")
+
+    argparser.add_argument("--host", action="store", default="127.0.0.1",
+        help="Address to listen on.  Defaults to 127.0.0.1.")
+    argparser.add_argument("--port", action="store", type=int, default=8003,
+        help="Port to listen on.  Defaults to 8003, the same as the XMPP bridge.")
+    argparser.add_argument("--script", action="store",
+        help="File of commands to feed the bots, one per line: <agent>, <command>")
+    argparser.add_argument("--agent", action="append", default=[],
+        help="Name of an agent to create an empty message queue for.  Can be given more than once.")
+    argparser.add_argument("--replies", action="store",
+        help="File to append replies to, one JSON document per line.")
+    argparser.add_argument("--loglevel", action="store", default="info",
+        help="Valid log levels: critical, error, warning, info, debug, notset.  Defaults to info.")
+
+    args = argparser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(),
+        format="%(levelname)s: %(message)s")
+
+    bridge = FakeBridge(args.host, args.port)
+    for agent in args.agent:
+        bridge.add_agent(agent)
+    if args.script:
+        logging.info("Fed " + str(bridge.load_script(args.script)) + " commands from " + args.script + ".")
+    if args.replies:
+        bridge.replies_file = args.replies
+
+    logging.info("Fake bridge listening on " + bridge.url())
+    try:
+        bridge.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
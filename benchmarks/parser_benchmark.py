@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# parser_benchmark.py - A micro-benchmark for the PyParsing-based command
+#   parsers of Systembot and Web Search Bot.  Each parser is loaded
+#   straight out of its bot's directory and fed a fixed set of commands many
+#   times over.  Every command is timed twice: once through the dispatcher's
+#   first-word index (which is what the bots use), and once through every
+#   registered grammar in order (which is how the parsers used to work).
+#   Copy Bot isn't here: all of its commands start with "copy", so there's
+#   nothing for an index to do and it doesn't use one.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Dropped Copy Bot, which no longer uses the dispatcher.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+
+# Constants.
+# Top level directory of the Exocortex Halo repository.
+halo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands that get fed to each parser.  They're cleaned up the same way the
+# parsers clean them up, so only the parsing is measured.
+system_bot_commands = ["help", "load", "system load", "system info", "cpus",
+    "disk usage", "free memory", "uptime", "public ip address", "local ip",
+    "network traffic", "core temp", "top processes", "local datetime",
+    "make me a sandwich"]
+
+web_search_bot_commands = ["help", "list search engines",
+    "get top ten hits for exocortex", "top 5 hits for halo",
+    "send me top five hits for xmpp bridges",
+    "search ddg for python pyparsing", "list categories",
+    "search images for top 5 hits for cute cats",
+    "search news for big cute cats"]
+
+# Functions.
+# load_parser(): Loads the parser.py module of a bot.  Every bot has its own
+#   parser.py (and globals.py, and dispatcher.py), so they have to be loaded
+#   one at a time with the bot's directory at the front of the search path.
+#   Takes one argument, the name of the bot's directory.  Returns the module.
+def load_parser(bot_directory):
+    for module in ["parser", "globals", "dispatcher"]:
+        sys.modules.pop(module, None)
+    sys.path.insert(0, os.path.join(halo_directory, bot_directory))
+    try:
+        return importlib.import_module("parser")
+    finally:
+        sys.path.pop(0)
+
+# time_commands(): Runs a list of commands through a parsing function a
+#   number of times.  Takes three arguments, the function, the list of
+#   commands, and the number of rounds.  Returns the number of microseconds
+#   each command took on average.
+def time_commands(function, commands, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        for command in commands:
+            function(command)
+    elapsed = time.perf_counter() - start
+    return (elapsed / (rounds * len(commands))) * 1000000.0
+
+# benchmark(): Benchmarks one dispatcher with and without its first-word
+#   index.  Takes four arguments, the name of the parser, the dispatcher, the
+#   list of commands, and the number of rounds.  Returns a hash table of
+#   results.
+def benchmark(name, dispatcher, commands, rounds):
+    results = {}
+    results["parser"] = name
+    results["commands"] = len(commands)
+    results["indexed_usec"] = time_commands(dispatcher.dispatch, commands,
+        rounds)
+    results["all_grammars_usec"] = time_commands(dispatcher.dispatch_all,
+        commands, rounds)
+    return results
+
+# Core code...
+argparser = argparse.ArgumentParser(description="A micro-benchmark for the command parsers of Systembot and Web Search Bot.")
+
+# Number of times to run each set of commands.
+argparser.add_argument("--rounds", action="store", type=int, default=200,
+    help="Number of times to run every command through each parser.  Defaults to 200.")
+
+# Loglevels: critical, error, warning, info, debug, notset.
+argparser.add_argument("--loglevel", action="store", default="warning",
+    help="Valid log levels: critical, error, warning, info, debug, notset.  Defaults to warning.")
+
+args = argparser.parse_args()
+logging.basicConfig(level=args.loglevel.upper(),
+    format="%(levelname)s: %(message)s")
+
+all_results = []
+
+# Systembot.
+system_bot_parser = load_parser("system_bot")
+all_results.append(benchmark("system_bot", system_bot_parser.commands,
+    system_bot_commands, args.rounds))
+
+# Web Search Bot.  It needs to know which search engines and categories Searx
+# has enabled, and it mustn't try to talk to the XMPP bridge.
+web_search_bot_parser = load_parser("web_search_bot")
+web_search_bot_parser.globals.search_engines = [
+    {"name": "duckduckgo", "shortcut": "ddg"},
+    {"name": "wikipedia", "shortcut": "wp"}]
+web_search_bot_parser.globals.search_categories = ["general", "images", "it",
+    "map", "music", "news", "science", "videos"]
+web_search_bot_parser.globals.send_message_to_user = lambda server, message: None
+web_search_bot_parser.update_search_categories()
+all_results.append(benchmark("web_search_bot",
+    web_search_bot_parser.search_requests, web_search_bot_commands,
+    args.rounds))
+
+print("%-22s %10s %14s %14s %8s" % ("parser", "commands", "indexed (us)",
+    "all (us)", "speedup"))
+for results in all_results:
+    print("%-22s %10d %14.1f %14.1f %7.1fx" % (results["parser"],
+        results["commands"], results["indexed_usec"],
+        results["all_grammars_usec"],
+        results["all_grammars_usec"] / results["indexed_usec"]))
+
+# Fin.
+sys.exit(0)
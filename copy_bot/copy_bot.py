@@ -14,6 +14,8 @@
 
 # License: GPLv3
 
+# v2.2 - Every command is timed, per kind of command.  The totals are kept in
+#       a metrics file and can be asked for with the "stats" command.
 # v2.1 - Reworked the startup logic so that being unable to immediately
 #       connect to either the message bus or the intended service is a
 #       terminal state.  Instead, it loops and sleeps until it connects and
@@ -39,6 +41,7 @@ import shutil
 import sys
 import time
 
+import instrumentation
 import parser
 
 # Global variables.
@@ -69,6 +72,10 @@ polling_time = 30
 # Handle to a copy request from the user.
 copy_request = None
 
+# Path to the file per-command statistics are kept in.  Defaults to
+# <bot_name>.metrics.
+metrics_file = ""
+
 # Functions.
 # set_loglevel(): Turn a string into a numerical value which Python's logging
 #   module can use because.
@@ -235,6 +242,7 @@ def online_help():
 I am designed to remotely copy one or more files from one location on the hot I am running on to another location on the host.  When specifying files, please ensure that you specify as full a path as possible to the source file, because this bot defaults to its current working directory, which may not be what you want.  This is a potentially useful bot if used in a clever fashion.  The interactive commands I currently suppot are:
 
     help - Display this online help.
+    stats/bot stats/command stats - How long each kind of command has taken me to carry out.
 
     Individual files:
     copy /path/to/foo.txt /another/path/to
@@ -307,6 +315,15 @@ except:
     # Nothing to do here, it's an optional configuration setting.
     pass
 
+# Set the path to the file per-command statistics are kept in.
+try:
+    metrics_file = config.get("DEFAULT", "metrics_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+if not metrics_file:
+    metrics_file = bot_name + ".metrics"
+
 # Set the loglevel from the override on the command line.
 if args.loglevel:
     loglevel = set_loglevel(args.loglevel.lower())
@@ -328,6 +345,10 @@ logger.debug("Message queue to report to: " + message_queue)
 logger.debug("Bot name to respond to search requests with: " + bot_name)
 logger.debug("Time in seconds for polling the message queue: " +
     str(polling_time))
+logger.debug("Metrics file: " + metrics_file)
+
+# Load the per-command statistics from the last time the bot ran.
+instrumentation.configure(metrics_file)
 
 # Try to contact the XMPP bridge.  Keep trying until you reach it or the
 # system shuts down.
@@ -346,6 +367,10 @@ logger.debug("Entering main loop to handle requests.")
 while True:
     command = None
 
+    # Every command goes straight back to the top of the loop when it's done,
+    # so this is where measuring the last one ends.
+    instrumentation.finish()
+
     # Check the message queue for download requests.
     try:
         logger.debug("Contacting message queue: " + message_queue)
@@ -374,6 +399,12 @@ while True:
             time.sleep(float(polling_time))
             continue
 
+        # Measure what it costs to carry out the command.
+        if isinstance(command, dict):
+            instrumentation.start(command["type"])
+        else:
+            instrumentation.start(command)
+
         if command == "unknown":
             message = "I didn't recognize that command."
             send_message_to_user(message)
@@ -384,6 +415,13 @@ while True:
             send_message_to_user(online_help())
             continue
 
+        # If the user is requesting the bot's own statistics...
+        if command == "stats":
+            message = "This is what carrying out each kind of command has cost me so far:\n\n"
+            message = message + instrumentation.report()
+            send_message_to_user(message)
+            continue
+
         # If the user is requesting a multiple file copy.
         if command['type'] == "copy":
             message = copy_files(command)
@@ -10,6 +10,14 @@
 
 # License: GPLv3
 
+# v2.3 - Copy requests no longer go through the dispatcher.  Every copy
+#       grammar starts with "copy", so its first-word index couldn't rule
+#       any of them out and only added overhead; they're tried in order from
+#       a list instead.
+# v2.2 - Added a command to get the bot's own per-command statistics.
+# v2.1 - Copy requests go through a dispatcher which stops at the first
+#       grammar that matches instead of running every one of them.
+#      - Fixed "copy <dir> into <dir>," which was using the "to" grammar.
 # v2.0 - Ported to Python 3.
 # v1.0 - Initial release.
 
@@ -23,6 +31,8 @@ import pyparsing as pp
 # Parser primitives
 # We define them up here because they'll be re-used over and over.
 help_command = pp.CaselessLiteral("help")
+stats_command = pp.Optional(pp.CaselessLiteral("bot") |
+    pp.CaselessLiteral("command")) + pp.CaselessLiteral("stats")
 
 # File paths are of the form ((/)*a?)?
 # * Zero or more slashes.
@@ -86,7 +96,97 @@ copy_all_files_to_dir = copy_command + all_command + files_command + in_command
 # copy all files in <dir> into <dir>
 copy_all_files_into_dir = copy_command + all_command + files_command + in_command + pathname_match + into_command + pathname_match
 
+# copy_request(): Utility function that builds the action for one
+#   of the copy grammars.  Takes three arguments, the positions of the source
+#   and destination filespecs in the parsed command, and a description of the
+#   request for logging.  Returns a function which builds a filespecs hash
+#   table out of a parsed command.
+def copy_request(source, destination, description):
+    def action(parsed_command):
+        filespecs = {}
+        filespecs['from'] = parsed_command[source]
+        filespecs['to'] = parsed_command[destination]
+        filespecs['type'] = "copy"
+        logging.debug(description + " " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
+        return filespecs
+    return action
+
+# The copy grammars, as lists of (grammar, action) tuples.  The most specific
+# grammars come first, because a request like "copy foo to bar" also matches
+# "copy <file> <dir>" and the first match wins.
+multiple_file_copies = []
+
+# "copy all files in /path/to into /another/path"
+multiple_file_copies.append((copy_all_files_into_dir,
+    copy_request(4, 6, "Copy all files in")))
+
+# "copy all files in /path/to to /another/path"
+multiple_file_copies.append((copy_all_files_to_dir,
+    copy_request(4, 6, "Copy all files in")))
+
+# "copy * in /path/to into /another/path"
+multiple_file_copies.append((copy_asterisk_into_dir,
+    copy_request(3, 5, "Copy * in")))
+
+# "copy * in /path/to to /another/path"
+multiple_file_copies.append((copy_asterisk_to_dir,
+    copy_request(3, 5, "Copy * in")))
+
+# "copy everything in /path/to into /another/path"
+# (The * is implied.)
+multiple_file_copies.append((copy_everything_into_dir_command,
+    copy_request(3, 5, "Copy everything in")))
+
+# "copy everything in /path/to to /another/path"
+# (The * is implied.)
+multiple_file_copies.append((copy_everything_in_dir_command,
+    copy_request(3, 5, "Copy everything in")))
+
+# "copy /path/to into /another/path"
+# (The * is implied.)
+multiple_file_copies.append((copy_dir_into_dir_command,
+    copy_request(1, 3, "Copy")))
+
+# "copy /path/to to /another/path"
+# (The * is implied.)
+multiple_file_copies.append((copy_dir_to_dir_command,
+    copy_request(1, 3, "Copy")))
+
+single_file_copies = []
+
+# "copy from foo into bar"
+single_file_copies.append((copy_from_into_command,
+    copy_request(2, 4, "Copy from")))
+
+# "copy foo into bar"
+single_file_copies.append((copy_into_command,
+    copy_request(1, 3, "Copy")))
+
+# "copy from foo to bar"
+single_file_copies.append((copy_from_command,
+    copy_request(2, 4, "Copy from")))
+
+# "copy foo to bar"
+single_file_copies.append((copy_to_command,
+    copy_request(1, 3, "Copy")))
+
+# "copy foo bar"
+single_file_copies.append((copy_foo_bar_command,
+    copy_request(1, 2, "Copy")))
+
 # Functions
+# first_match(): Tries a list of (grammar, action) tuples on a command, in
+#   order.  Returns what the action of the first grammar that matches
+#   returned, or None if none of them did.
+def first_match(grammars, command):
+    for (grammar, action) in grammars:
+        try:
+            parsed_command = grammar.parseString(command)
+        except pp.ParseException:
+            continue
+        return action(parsed_command)
+    return None
+
 # parse_help(): Function that matches the word "help" all by itself in an input
 #   string.  Returns the string "help" on a match and None if not.
 def parse_help(command):
@@ -96,170 +196,44 @@ def parse_help(command):
     except:
         return None
 
+# parse_stats(): Function that matches the word "stats" (optionally "bot
+#   stats" or "command stats") all by itself in an input string.  Returns the
+#   string "stats" on a match and None if not.
+def parse_stats(command):
+    try:
+        parsed_command = stats_command.parseString(command)
+        return "stats"
+    except:
+        return None
+
 # parse_single_file_copy(): Function that matches one-to-one copy requests.
+#   Returns a hash table of filespecs, which is empty if nothing matched.
 def parse_single_file_copy(command):
     logging.debug("Entered function parser.parse_single_file_copy().")
     logging.debug("Value of command: " + str(command))
 
-    # Handle that holds the output from each parser.
-    parsed_command = None
-
     # Hash that holds the filespecs.
-    filespecs = {}
-
-    # "copy foo bar"
-    try:
-        parsed_command = copy_foo_bar_command.parseString(command)
-        filespecs['from'] = parsed_command[1]
-        filespecs['to'] = parsed_command[2]
-        filespecs['type'] = "copy"
-        logger.debug("Copy " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy foo to bar"
-    try:
-        parsed_command = copy_to_command.parseString(command)
-        filespecs['from'] = parsed_command[1]
-        filespecs['to'] = parsed_command[3]
-        filespecs['type'] = "copy"
-        logger.debug("Copy " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy from foo to bar"
-    try:
-        parsed_command = copy_from_command.parseString(command)
-        filespecs['from'] = parsed_command[2]
-        filespecs['to'] = parsed_command[4]
-        filespecs['type'] = "copy"
-        logger.debug("Copy from " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy foo into bar"
-    try:
-        parsed_command = copy_into_command.parseString(command)
-        filespecs['from'] = parsed_command[1]
-        filespecs['to'] = parsed_command[3]
-        filespecs['type'] = "copy"
-        logger.debug("Copy " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy from foo into bar"
-    try:
-        parsed_command = copy_from_into_command.parseString(command)
-        filespecs['from'] = parsed_command[2]
-        filespecs['to'] = parsed_command[4]
-        filespecs['type'] = "copy"
-        logger.debug("Copy from " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
+    filespecs = first_match(single_file_copies, command)
+    if not filespecs:
+        filespecs = {}
 
     # Return the filespecs hash table.
-    logging.debug("Value of parsed_command: " + str(parsed_command))
     logging.debug("Value of filespecs: " + str(filespecs))
     return filespecs
 
 # parse_multiple_file_copy(): Function that matches multiple file copy requests.
 #   This pretty much means everything in a directory into another directory.
+#   Returns a hash table of filespecs, which is empty if nothing matched.
 def parse_multiple_file_copy(command):
     logging.debug("Entered function parser.parse_multiple_file_copy().")
     logging.debug("Value of command: " + str(command))
 
-    # Handle that holds the output from each parser.
-    parsed_command = None
-
     # Hash that holds the filespecs.
-    filespecs = {}
-
-    # "copy /path/to to /another/path"
-    # (The * is implied.)
-    try:
-        parsed_command = copy_dir_to_dir_command.parseString(command)
-        filespecs['from'] = parsed_command[1]
-        filespecs['to'] = parsed_command[3]
-        filespecs['type'] = "copy"
-        logger.debug("Copy " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy /path/to into /another/path"
-    # (The * is implied.)
-    try:
-        parsed_command = copy_dir_to_dir_command.parseString(command)
-        filespecs['from'] = parsed_command[1]
-        filespecs['to'] = parsed_command[3]
-        filespecs['type'] = "copy"
-        logger.debug("Copy " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy everything in /path/to to /another/path"
-    # (The * is implied.)
-    try:
-        parsed_command = copy_everything_in_dir_command.parseString(command)
-        filespecs['from'] = parsed_command[3]
-        filespecs['to'] = parsed_command[5]
-        filespecs['type'] = "copy"
-        logger.debug("Copy everything in " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy everything in /path/to into /another/path"
-    # (The * is implied.)
-    try:
-        parsed_command = copy_everything_into_dir_command.parseString(command)
-        filespecs['from'] = parsed_command[3]
-        filespecs['to'] = parsed_command[5]
-        filespecs['type'] = "copy"
-        logger.debug("Copy everything in " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy * in /path/to to /another/path"
-    try:
-        parsed_command = copy_asterisk_to_dir.parseString(command)
-        filespecs['from'] = parsed_command[3]
-        filespecs['to'] = parsed_command[5]
-        filespecs['type'] = "copy"
-        logger.debug("Copy * in " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy * in /path/to into /another/path"
-    try:
-        parsed_command = copy_asterisk_into_dir.parseString(command)
-        filespecs['from'] = parsed_command[3]
-        filespecs['to'] = parsed_command[5]
-        filespecs['type'] = "copy"
-        logger.debug("Copy * in " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy all files in /path/to to /another/path"
-    try:
-        parsed_command = copy_all_files_to_dir.parseString(command)
-        filespecs['from'] = parsed_command[4]
-        filespecs['to'] = parsed_command[6]
-        filespecs['type'] = "copy"
-        logger.debug("Copy all files in " + str(filespecs['from']) + " to " + str(filespecs['to']) + " detected.")
-    except:
-        pass
-
-    # "copy all files in /path/to into /another/path"
-    try:
-        parsed_command = copy_all_files_into_dir.parseString(command)
-        filespecs['from'] = parsed_command[4]
-        filespecs['to'] = parsed_command[6]
-        filespecs['type'] = "copy"
-        logger.debug("Copy all files in " + str(filespecs['from']) + " into " + str(filespecs['to']) + " detected.")
-    except:
-        pass
+    filespecs = first_match(multiple_file_copies, command)
+    if not filespecs:
+        filespecs = {}
 
     # Return the filespecs hash table.
-    logging.debug("Value of parsed_command: " + str(parsed_command))
     logging.debug("Value of filespecs: " + str(filespecs))
     return filespecs
 
@@ -288,6 +262,11 @@ def parse_command(command):
     if parsed_command == "help":
         return parsed_command
 
+    # The bot's own statistics?
+    parsed_command = parse_stats(command)
+    if parsed_command == "stats":
+        return parsed_command
+
     # Multiple file copy?
     parsed_command = parse_multiple_file_copy(command)
     if parsed_command:
@@ -15,6 +15,7 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v5.1 - Added optional latency tracing of commands and replies.
 # v5.0 - Ported to Python 3.
 # v4.0 - Refacted bot to break major functional parts out into separate modules.
 #      - Made the interface and port the REST API listens on configurable.
@@ -89,6 +90,7 @@ import threading
 
 import message_queue
 import rest
+import tracing
 import xmppclient
 
 # Globals.
@@ -165,6 +167,13 @@ agents = config.get("DEFAULT", "agents")
 for i in agents.split(','):
     message_queue.message_queue[i] = []
 
+# Get the path to the file latency traces are written to.  This is optional.
+try:
+    tracing.trace_file = config.get("DEFAULT", "trace_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
 # Figure out how to configure the logger.  Start by reading from the config
 # file.
 config_log = config.get("DEFAULT", "loglevel").lower()
@@ -54,7 +54,9 @@
 # License: GPLv3
 
 # This hash table's keys are the names of agents, the associated values are
-# lists which implement the message queues.
+# lists which implement the message queues.  Each entry in an agent's message
+# queue is a hash table holding the command and its correlation ID (see
+# tracing.py).  Entries in the replies queue hold the reply and its trace.
 message_queue = {}
 
 # Add the message queue so this bot's agents can send replies.
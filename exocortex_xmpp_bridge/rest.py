@@ -8,6 +8,15 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v5.3 - One bad reply in a list no longer gets the whole list rejected: the
+#        good ones are sent, and the answer says which ones weren't and why.
+#        Successful PUTs to /replies answer with JSON that says lists are
+#        accepted, so constructs know they can send them.
+# v5.2 - /replies accepts a JSON list of replies so constructs can send them
+#        in batches, and throws away replies whose message ID it has already
+#        seen so that constructs can safely send them again.
+# v5.1 - Commands handed to constructs carry a correlation ID, which
+#        constructs can send back with their replies for latency tracing.
 # v5.0 - Reworking for Python 3.
 # v4.0 - Refacted bot to break major functional parts out into separate modules.
 # v3.0 - Rewriting to use SleekXMPP, because I'm tired of XMPPpy's lack of
@@ -63,15 +72,24 @@
 
 # License: GPLv3
 
+from collections import OrderedDict
 from http.server import HTTPServer
 from http.server import BaseHTTPRequestHandler
 
 import json
 import logging
+import threading
 
 import message_queue
+import tracing
 
 # Globals.
+# Message IDs of the replies that have been accepted recently, oldest first.
+# Constructs which keep an outbox send a reply again if they don't hear back,
+# so this is how duplicates are caught.
+maximum_message_ids = 1000
+recent_message_ids = OrderedDict()
+message_ids_lock = threading.Lock()
 
 # RESTRequestHandler: Subclass that implements a REST API service.  The main
 #   rails are the names of agents or constructs that will poll message queues
@@ -123,16 +141,18 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
 
         # Extract the earliest command from the agent's message queue.
         command = message_queue.message_queue[agent].pop(0)
+        tracing.command_dispatched(command["id"])
 
         # Assemble a JSON document of the earliest pending command.  Then send
         # the JSON document to the agent.  Multiple hits will be required to
         # empty the queue.
         logging.debug("Returning earliest command from message queue " + agent
-            + ": " + command)
+            + ": " + command["command"])
         self.send_response(200)
         self.send_header("Content-Type:", "application/json")
         self.end_headers()
-        message = json.dumps({"command": command}).encode()
+        message = json.dumps({"command": command["command"],
+            "id": command["id"]}).encode()
         self.wfile.write(message)
         return
 
@@ -140,7 +160,22 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
     #
     # {
     #   "name": "<bot's name>",
-    #   "reply": "<The bot's witty repartee' goes here.>"
+    #   "reply": "<The bot's witty repartee' goes here.>",
+    #   "id": "<optional correlation ID of the command being answered>",
+    #   "message_id": "<optional unique ID of this reply>"
+    # }
+    #
+    # A construct can also send a JSON list of replies in one request.  They
+    # are sent to the user in the order they appear in the list.  Replies with
+    # a message ID which has already been seen are acknowledged but not sent
+    # again.  Replies in a list that don't make sense are skipped and the rest
+    # are sent anyway.  The answer says so:
+    #
+    # {
+    #   "result": "ok",
+    #   "accepted": <number of replies accepted>,
+    #   "rejected": [{"index": <position in the list>, "error": "..."}],
+    #   "batches": true
     # }
 
     # Process HTTP/1.1 PUT requests.
@@ -184,25 +219,72 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         if not self._ensure_json():
             return
         response = self._deserialize_content(content)
-        if not response:
-            return
-
-        # Normalize the keys in the JSON to lowercase.
-        response = self._normalize_keys(response)
-
-        # Ensure that all of the required keys are in the JSON document.
-        if not self._ensure_all_keys(response):
+        if response is None:
             return
 
-        # Generate a reply to the bot's owner and add it to the bot's private
-        # message queue.
-        reply = "Got a message from " + response['name'] + ":\n\n"
-        reply = reply + response['reply']
-        message_queue.message_queue['replies'].append(reply)
-        self.send_response(200)
-        self.end_headers()
+        # A single reply has to make sense or the whole request is rejected,
+        # like it always was.
+        if not isinstance(response, list):
+            if not isinstance(response, dict):
+                logging.debug('400, {"result": null, "error": "You need to send a reply or a list of replies.", "id": 400}')
+                self._send_http_response(400, '{"result": null, "error": "You need to send a reply or a list of replies.", "id": 400}')
+                return
+            response = self._normalize_keys(response)
+            if not self._ensure_all_keys(response):
+                return
+            response = [response]
+
+        # Normalize the keys in the JSON to lowercase and pick out the replies
+        # in the list that have all of the required keys.
+        replies = []
+        rejected = []
+        for i in range(len(response)):
+            if not isinstance(response[i], dict):
+                rejected.append({"index": i, "error": "A reply has to be a JSON object."})
+                continue
+            response[i] = self._normalize_keys(response[i])
+            missing = self._missing_keys(response[i])
+            if missing:
+                rejected.append({"index": i, "error": "Missing required keys: " + ", ".join(missing)})
+                continue
+            if not isinstance(response[i]["name"], str) or \
+                    not isinstance(response[i]["reply"], str):
+                rejected.append({"index": i, "error": "name and reply have to be strings."})
+                continue
+            replies.append(response[i])
+        if rejected:
+            logging.warning("Rejected " + str(len(rejected)) + " of " + str(len(response)) + " replies: " + json.dumps(rejected))
+
+        for response in replies:
+            if self._seen_before(response.get("message_id")):
+                logging.debug("Already sent message " +
+                    str(response["message_id"]) + ".  Skipping it.")
+                continue
+
+            # Generate a reply to the bot's owner and add it to the bot's
+            # private message queue.
+            reply = "Got a message from " + response['name'] + ":\n\n"
+            reply = reply + response['reply']
+            message_queue.message_queue['replies'].append({"reply": reply,
+                "trace": tracing.reply_received(response['name'], response)})
+        self._send_http_response(200, {"result": "ok",
+            "accepted": len(replies), "rejected": rejected, "batches": True})
         return
 
+    # Check whether or not a reply with a given message ID has been accepted
+    # already, and remember the message ID if it hasn't.  Replies without a
+    # message ID are never duplicates.
+    def _seen_before(self, message_id):
+        if not message_id:
+            return False
+        with message_ids_lock:
+            if message_id in recent_message_ids:
+                return True
+            recent_message_ids[message_id] = True
+            while len(recent_message_ids) > maximum_message_ids:
+                recent_message_ids.popitem(last=False)
+        return False
+
     # Send an HTTP response, consisting of the status code, headers and
     # payload.  Takes two arguments, the HTTP status code and a JSON document
     # containing an appropriate response.
@@ -260,16 +342,15 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
             logging.debug("Normalizing key " + key + " to " + key.lower() + ".")
         return arguments
 
+    # Return a list of the keys required for every client access that aren't
+    # in the hash table.
+    def _missing_keys(self, arguments):
+        return [key for key in self.required_keys if key not in arguments]
+
     # Ensure that all of the keys required for every client access are in the
     # hash table.
     def _ensure_all_keys(self, arguments):
-        all_keys_found = True
-
-        for key in self.required_keys:
-            if key not in list(arguments.keys()):
-                all_keys_found = False
-
-        if not all_keys_found:
+        if self._missing_keys(arguments):
             logging.debug('400, {"result": null, "error": "All required keys were not found in the JSON document.  Look at the online help.", "id": 400}')
             self._send_http_response(400, '{"result": null, "error": "All required keys were not found in the JSON document.  Look at the online help.", "id": 400}')
             return False
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# tracing.py - A module of the Exocortex XMPP Bridge that follows every
+#   command from the moment it arrives over XMPP to the moment the construct's
+#   reply goes back out, so that it's possible to figure out where the time
+#   goes.  Each command gets a correlation ID which the constructs hand back
+#   when they PUT to /replies.  Each hop is timestamped:
+#
+#   received    - XMPPClient.message() put the command into a message queue
+#   dispatched  - a construct picked the command up with GET /<agent>
+#   replied     - the construct PUT its reply to /replies
+#   sent        - process_replies_queue() handed the reply to the XMPP server
+#
+#   From those we get time in queue (dispatched - received), handler time
+#   (replied - dispatched) and outbound latency (sent - replied).  Every
+#   completed trace is appended to a trace file as a line of JSON and rolled
+#   into a running per-construct summary.
+#
+#   A command is only traced as far as the first reply to it; any more
+#   replies are counted, but not timed against it again.  Constructs that
+#   don't send correlation IDs back have their replies matched up with the
+#   last command they picked up that hasn't been replied to yet, as long as
+#   it isn't too old, so an alert hours later isn't taken for the answer.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.1 - Traces are finished by the first reply to them, and commands are
+#        forgotten if they haven't been replied to in maximum_age seconds.
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+from collections import OrderedDict
+
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+
+# Globals.
+# Path to the file traces are appended to.  If empty, traces are only kept in
+# memory for the summary.
+trace_file = ""
+
+# Maximum number of commands that can be in flight at any one time before the
+# oldest ones are forgotten.  Constructs which never reply (or which reply
+# many times) would otherwise make this grow without bound.
+maximum_outstanding = 1000
+
+# Number of seconds a command can go without a reply before it's forgotten.
+# A reply after that is counted but not timed.
+maximum_age = 600
+
+# Commands which have been received but haven't been replied to yet, keyed
+# by correlation ID, oldest first.
+outstanding = OrderedDict()
+
+# Running per-construct statistics, keyed by construct name.
+summary = {}
+
+# The XMPP client and the REST API server run in different threads, so
+# everything in here is protected by a lock.
+lock = threading.Lock()
+
+# The three phases that get summarised.
+phases = ["time_in_queue", "handler_time", "outbound_latency"]
+
+# Functions.
+# new_trace(): Called when a command comes in over XMPP.  Takes two arguments,
+#   the name of the agent the command is for and the command itself.  Returns
+#   a new correlation ID as a string.
+def new_trace(agent, command):
+    trace_id = uuid.uuid4().hex[:12]
+    with lock:
+        outstanding[trace_id] = {"id": trace_id, "agent": agent,
+            "command": command, "timestamp": time.time(),
+            "received": time.monotonic(), "dispatched": None}
+        while len(outstanding) > maximum_outstanding:
+            outstanding.popitem(last=False)
+        _expire(time.monotonic())
+    logging.debug("Started trace " + trace_id + " for agent " + agent + ".")
+    return trace_id
+
+# command_dispatched(): Called when a construct picks a command up from its
+#   message queue.  Takes one argument, the correlation ID.
+def command_dispatched(trace_id):
+    with lock:
+        if trace_id in outstanding:
+            outstanding[trace_id]["dispatched"] = time.monotonic()
+
+# find_trace(): Figures out which command a reply belongs to.  If the construct
+#   sent the correlation ID back, that's easy.  If it didn't (older constructs
+#   don't know about correlation IDs), assume the reply belongs to the most
+#   recently dispatched command for that construct that hasn't been replied
+#   to yet.  Takes three arguments, the name of the construct, the
+#   correlation ID (which may be None), and whether or not to guess.
+#   Constructs which know about correlation IDs send a null ID with
+#   unsolicited replies (such as alerts), so there's no guessing for them.
+#   Returns the correlation ID or None.
+def find_trace(agent, trace_id, guess):
+    with lock:
+        _expire(time.monotonic())
+        if trace_id and trace_id in outstanding:
+            return trace_id
+        if not guess:
+            return None
+        for key in reversed(outstanding):
+            if outstanding[key]["agent"] == agent and \
+                    outstanding[key]["dispatched"] is not None:
+                return key
+    return None
+
+# reply_received(): Called when a construct PUTs a reply to /replies.  The
+#   command the reply belongs to is finished with, so it's taken out of the
+#   commands waiting for replies.  Takes two arguments, the name of the
+#   construct and the deserialized reply.  Returns a hash table which travels
+#   through the /replies queue with the reply.
+def reply_received(agent, reply):
+    reply_trace = {"id": None, "agent": agent, "replied": time.monotonic()}
+    trace_id = find_trace(agent, reply.get("id"), "id" not in reply)
+    with lock:
+        # Another reply might have got to it first.
+        trace = outstanding.pop(trace_id, None) if trace_id else None
+    if trace:
+        reply_trace["id"] = trace_id
+        reply_trace["command"] = trace["command"]
+        reply_trace["received"] = trace["received"]
+        reply_trace["dispatched"] = trace["dispatched"]
+    return reply_trace
+
+# reply_sent(): Called after process_replies_queue() has sent a reply to the
+#   bot's owner.  Works out how long each hop took, writes the trace out, and
+#   updates the summary.  Takes one argument, the hash table that
+#   reply_received() built.
+def reply_sent(reply_trace):
+    now = time.monotonic()
+    record = {"id": reply_trace["id"], "agent": reply_trace["agent"],
+        "timestamp": time.time(), "time_in_queue": None,
+        "handler_time": None,
+        "outbound_latency": round(now - reply_trace["replied"], 6)}
+
+    if reply_trace["id"]:
+        record["command"] = reply_trace["command"]
+        if reply_trace["dispatched"] is not None:
+            record["time_in_queue"] = round(reply_trace["dispatched"] -
+                reply_trace["received"], 6)
+            record["handler_time"] = round(reply_trace["replied"] -
+                reply_trace["dispatched"], 6)
+
+    with lock:
+
+        # Roll the phases into the running per-construct statistics.
+        stats = summary.setdefault(record["agent"], {"replies": 0})
+        stats["replies"] = stats["replies"] + 1
+        for phase in phases:
+            if record[phase] is None:
+                continue
+            if phase not in stats:
+                stats[phase] = {"count": 0, "total": 0.0, "max": 0.0}
+            stats[phase]["count"] = stats[phase]["count"] + 1
+            stats[phase]["total"] = stats[phase]["total"] + record[phase]
+            stats[phase]["max"] = max(stats[phase]["max"], record[phase])
+
+    logging.debug("Completed trace: " + str(record))
+    if not trace_file:
+        return
+    try:
+        with open(trace_file, "a") as file:
+            file.write(json.dumps(record) + "\n")
+    except Exception as e:
+        logging.warning("Unable to write to trace file " + trace_file +
+            ": " + str(e))
+
+# _expire(): Helper function that forgets commands which have gone too long
+#   without a reply.  Takes one argument, the current time
+#   (time.monotonic()).  The lock has to be held.
+def _expire(now):
+    while outstanding:
+        oldest = next(iter(outstanding.values()))
+        if now - oldest["received"] <= maximum_age:
+            break
+        outstanding.popitem(last=False)
+
+# latency_report(): Builds a human readable summary of the traces collected so
+#   far, slowest construct first.  Takes no arguments.  Returns a string.
+def latency_report():
+    report = ""
+
+    with lock:
+        if not summary:
+            return "I haven't traced any replies yet."
+
+        # Sort the constructs by their mean handler time, slowest first.
+        def mean_handler_time(agent):
+            if "handler_time" not in summary[agent]:
+                return 0.0
+            return summary[agent]["handler_time"]["total"] / \
+                summary[agent]["handler_time"]["count"]
+
+        for agent in sorted(summary, key=mean_handler_time, reverse=True):
+            report = report + "Agent " + agent + " (" + \
+                str(summary[agent]["replies"]) + " replies):\n"
+            for phase in phases:
+                if phase not in summary[agent]:
+                    continue
+                stats = summary[agent][phase]
+                report = report + "    " + phase.replace("_", " ") + \
+                    ": mean %.3fs, max %.3fs\n" % (
+                    stats["total"] / stats["count"], stats["max"])
+    return report
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
@@ -8,6 +8,9 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v5.1 - Commands are stamped with a correlation ID and traced all the way to
+#        the construct's reply.  Added "Robots, latency." to summarise the
+#        traces.
 # v5.0 - Reworking for Python 3.
 # v4.1 - Explicitly setting the stanza type to "chat" makes the bridge work
 #        reliably with more XMPP clients (such as converse.js).
@@ -80,6 +83,7 @@ import logging
 import threading
 
 import message_queue
+import tracing
 
 # XMPPClient: XMPP client class.  Implemented using threading.Thread because
 #   it'll spin out on its own to connect to the XMPP server, while the custom
@@ -213,6 +217,11 @@ class XMPPClient(ClientXMPP):
             self._status_report()
             return
 
+        # The user is asking where the time is going.
+        if message_body == "Robots, latency.":
+            self._latency_report()
+            return
+
         # Try to split off the bot's name from the message body.  If the
         # agent's name isn't registered, bounce.
         if "," in message_body:
@@ -237,8 +246,10 @@ class XMPPClient(ClientXMPP):
         command = command.strip(".")
         logging.debug("Received request: " + command)
 
-        # Push the request into the appropriate message queue.
-        message_queue.message_queue[agent_name].append(command)
+        # Stamp the request with a correlation ID and push it into the
+        # appropriate message queue.
+        message_queue.message_queue[agent_name].append({"command": command,
+            "id": tracing.new_trace(agent_name, command)})
         logging.debug("Added request to " + agent_name + "'s message queue.")
 
         # Tell the bot's owner that the request has been added to the agent's
@@ -258,6 +269,7 @@ class XMPPClient(ClientXMPP):
 Supported commands:\n
 - help - This online help.\n
 - Robots, report. - List all constructs this bot is configured to communicate with.\n
+- Robots, latency. - Summarise how long commands spend queued, being handled, and on the way back.\n
 To send a command to one of the constructs, use your XMPP client to send a message that looks something like this:\n
 "[bot name], do this thing for me."\n
 Individual constructs may have their own online help, so try sending the command "[bot name], help."\n
@@ -275,7 +287,17 @@ Individual constructs may have their own online help, so try sending the command
             if key == "replies":
                 continue
             response = response + "Agent " + key + ": "
-            response = response + str(message_queue.message_queue[key]) + "\n"
+            response = response + str([i["command"] for i in
+                message_queue.message_queue[key]]) + "\n"
+        self.send_message(mto=self.owner, mbody=response,
+            mtype=self.stanza_type)
+        return
+
+    # Helper method that returns a summary of the latency traces when queried.
+    def _latency_report(self):
+        logging.debug("Entering XMPPClient._latency_report().")
+        response = "Where the time is going, slowest construct first:\n\n"
+        response = response + tracing.latency_report()
         self.send_message(mto=self.owner, mbody=response,
             mtype=self.stanza_type)
         return
@@ -287,8 +309,9 @@ Individual constructs may have their own online help, so try sending the command
         logging.debug("Entering XMPPClient.process_replies_queue().")
         if len(message_queue.message_queue["replies"]):
             reply = message_queue.message_queue["replies"].pop(0)
-            self.send_message(mto=self.owner, mbody=reply,
+            self.send_message(mto=self.owner, mbody=reply["reply"],
                 mtype=self.stanza_type)
+            tracing.reply_sent(reply["trace"])
         return
 
     # Fires whenever the bot's connection dies.  I need to figure out how to
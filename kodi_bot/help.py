@@ -37,7 +37,7 @@ def help_commands():
 
     I can set the playback volume higher or lower, or to a specific level.  I can also mute and unmute playback.
 
-    I can ping the Kodi server to make sure it's responding.  I can also ask it what version of the API it understands, for troubleshooting purposes.
+    I can ping the Kodi server to make sure it's responding.  I can also ask it what version of the API it understands, for troubleshooting purposes.  If you ask me for my stats I'll tell you how long each kind of command takes me to carry out.
 
     I can shut down and restart both Kodi and the server it's running on.
 
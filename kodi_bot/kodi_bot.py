@@ -13,6 +13,9 @@
 
 # License: GPLv3
 
+# v3.2 - Every command is timed and its outbound HTTP requests counted, per
+#       kind of command.  The totals are kept in a metrics file and can be
+#       asked for with the bot_stats command.
 # v3.1 - Reworked the startup logic so that being unable to immediately
 #       connect to either the message bus or the intended service is a
 #       terminal state.  Instead, it loops and sleeps until it connects and
@@ -57,6 +60,7 @@ import time
 from requests.auth import HTTPBasicAuth
 
 import help
+import instrumentation
 import kodi_library
 import parser
 
@@ -158,6 +162,10 @@ kodi_url = ""
 # Handle to an HTTP basic auth object.
 kodi_auth = None
 
+# Path to the file per-command statistics are kept in.  Defaults to
+# <bot_name>.metrics.
+metrics_file = ""
+
 # Functions.
 # set_loglevel(): Turn a string into a numerical value which Python's logging
 #   module can use because.
@@ -413,6 +421,13 @@ try:
 except:
     # This is optional.
     pass
+try:
+    metrics_file = config.get("DEFAULT", "metrics_file")
+except:
+    # This is optional.
+    pass
+if not metrics_file:
+    metrics_file = bot_name + ".metrics"
 
 # Build the Kodi URL.
 kodi_url = "http://" + kodi_host + ":" + str(kodi_port) + "/jsonrpc"
@@ -440,6 +455,10 @@ if args.no_media_library:
     logger.debug("Not building a media library.")
 if local_library:
     logger.debug("Location of local library dump: %s" % local_library)
+logger.debug("Metrics file: %s" % metrics_file)
+
+# Load the per-command statistics from the last time the bot ran.
+instrumentation.configure(metrics_file)
 
 # Try to contact the XMPP bridge.  Keep trying until you reach it or the
 # system shuts down.
@@ -513,6 +532,10 @@ while True:
     search_term = ""
     reply = ""
 
+    # Most commands go straight back to the top of the loop when they're done,
+    # so this is where measuring the last one ends.
+    instrumentation.finish()
+
     # Check the message queue for index requests.
     try:
         logger.debug("Contacting message queue: %s" % message_queue)
@@ -541,6 +564,9 @@ while True:
             time.sleep(float(polling_time))
             continue
 
+        # Measure what it costs to carry out the command.
+        instrumentation.start(parsed_command["match"])
+
         # If the bot's confidence interval on the match is below the minimum,
         # warn the user.
         if parsed_command["confidence"] <= minimum_confidence:
@@ -581,6 +607,15 @@ while True:
             send_message_to_user(kodi_settings())
             continue
 
+        # If the user is asking how long each kind of command takes, send them
+        # the statistics.
+        if parsed_command["match"] == "bot_stats":
+            logging.debug("Matched bot_stats.")
+            reply = "This is what carrying out each kind of command has cost me so far:\n\n"
+            reply = reply + instrumentation.report()
+            send_message_to_user(reply)
+            continue
+
         # If the user is asking to search the album subsection of the media
         # library, do the thing.
         if parsed_command["match"] == "search_requests_albums":
@@ -901,6 +936,7 @@ while True:
         logger.info("Message queue %s does not exist." % bot_name)
 
     # Sleep for the configured amount of time.
+    instrumentation.finish()
     time.sleep(float(polling_time))
 
 # Fin.
@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# alerts.py - Module that decides when system_bot.py should tell the user that
+#   something's wrong.  Every pass through the main loop the system stats are
+#   collected into one hash table of metrics ("load", "cpu_idle",
+#   "disk:/home", "temperature:Core 0"...), and every alert rule is checked
+#   against it.  A rule either compares a metric to a threshold, looks at
+#   how far the metric's standard deviation has spiked, scores the metric
+#   against its usual level (see anomaly.py), or works out how fast it's been
+#   growing.
+#
+#   Rules have hysteresis: once a rule fires it stays firing until the metric
+#   has come back past a separate clear level, so a value sitting right on
+#   the threshold doesn't set it off over and over.  The user hears about a
+#   rule when it starts firing, is reminded every cooldown seconds while it
+#   keeps firing, and (if the rule says so) is told when it clears.  Every
+#   alert raised in one pass goes out as one message, with duplicates
+#   removed.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.9 - A rule that's superseded doesn't use up its cooldown, so the user
+#       hears about it once the rule that superseded it clears.  What's known
+#       about metrics that haven't been seen for a day is forgotten.
+# v1.8 - Fixed evaluate() crashing on rules that supersede others but don't
+#       apply to a metric (temperature sensors without a critical
+#       temperature).  Added self tests.
+# v1.7 - Added built-in rules for services that stop answering their probes or
+#       get slower than usual.
+# v1.6 - Added built-in rules for cgroups that are running out of memory,
+#       stalling for memory, being throttled, or losing processes to the OOM
+#       killer.
+# v1.5 - Messages can use extra fields that come with the metrics, like the
+#       log line that set a log rule off.  Rules with no reminders (a cooldown
+#       of 0) alert every time they start firing, not only the first time.
+# v1.4 - Added slope rules, which fire when a metric has been growing steadily
+#       (like a process leaking memory or file descriptors), and built-in
+#       rules for leaks in monitored processes.
+# v1.3 - Added built-in rules for inode usage and disk I/O.
+# v1.2 - Added a built-in rule for saturated network links.
+# v1.1 - Added z-score rules, which compare readings to an EWMA or hour of the
+#       day baseline.  The built-in spike rules use them.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import fnmatch
+import logging
+import re
+import time
+
+import anomaly
+import timeseries
+
+from ring_buffer import RingBuffer
+
+# Constants.
+# Kinds of rules: the metric is above the threshold, the metric is below the
+# threshold, the standard deviation of the metric's recent values is above
+# the threshold, the metric is more than the threshold's worth of standard
+# deviations above its baseline (see anomaly.py), or the metric has been
+# growing by more than the threshold per hour.
+conditions = ["above", "below", "stdev_above", "zscore_above", "slope_above"]
+
+# Slope rules work from the five minute averages in the history, and only
+# count growth that's steady: a line fitted to the averages has to fit at
+# least this well (r squared), so a metric that jumped once or saws up and
+# down isn't mistaken for a leak.
+slope_resolution = 300
+steady_growth = 0.8
+
+# Variables global to this module.
+# Alert rules, in the order they were declared.
+rules = []
+
+# If False, alerting has been turned off (time_between_alerts is 0) and no
+# rule ever fires.
+enabled = True
+
+# Hash table of (source, rule name, metric) to the State of that rule for
+# that metric.  The source is "" for the system the bot is running on, or the
+# name of an OpenWRT device.
+states = {}
+
+# How many seconds a rule can go without seeing a metric before what it knows
+# about it is forgotten (interfaces, disks, processes, and fleet hosts come
+# and go), and when that was last looked for.
+expiry = 86400
+last_pruned = None
+
+# Classes.
+# Rule: Class that holds one alert rule.
+class Rule(object):
+
+    # Initialize new instances of the class.  Takes four arguments, the name
+    # of the rule, the metric it applies to (which can have shell-style
+    # wildcards, like "disk:*"), the condition (one of conditions), and the
+    # threshold.  The threshold is either a number or the name of another
+    # metric to compare against, which is looked up with the same instance
+    # ("critical_temperature" for "temperature:Core 0" means
+    # "critical_temperature:Core 0").  Optionally takes the level the metric
+    # has to get back to before the rule clears (defaults to the threshold),
+    # the number of seconds between reminders while it's firing (0 means no
+    # reminders), the message to send when it fires and when it clears (the
+    # latter can be empty), for standard deviation, z-score, and slope rules
+    # the minimum and maximum number of samples to work from (for z-score
+    # rules the maximum is how many samples the EWMA covers, for slope rules
+    # the samples are five minute averages), the names of other
+    # rules that are redundant while this one is firing for the same metric
+    # (a list or a comma separated string), and for z-score rules whether to
+    # use hour of the day baselines and how far a reading has to be from the
+    # baseline before it counts at all.
+    def __init__(self, name, metric, condition, threshold, clear=None,
+        cooldown=3600, message="", clear_message="", minimum_samples=2,
+        window=99, supersedes=None, seasonal=False, minimum_change=0.0):
+        if condition not in conditions:
+            raise ValueError("Alert rule " + name + " has an unknown condition " + str(condition) + ".")
+        self.name = name
+        self.metric = metric
+        self.condition = condition
+        self.threshold = _number_or_metric(threshold)
+        self.clear = self.threshold
+        if clear is not None and str(clear) != "":
+            self.clear = _number_or_metric(clear)
+        self.cooldown = float(cooldown)
+        self.message = message
+        if not self.message:
+            self.message = "WARNING: " + name + ": " + metric + " is {value}."
+        self.clear_message = clear_message
+        self.minimum_samples = max(2, int(minimum_samples))
+        self.window = max(1, int(window))
+        if isinstance(supersedes, str):
+            supersedes = supersedes.split(",")
+        self.supersedes = [i.strip() for i in supersedes or [] if i.strip()]
+        if isinstance(seasonal, str):
+            seasonal = seasonal.strip().lower() in ["yes", "true", "on", "1"]
+        self.seasonal = seasonal
+        self.minimum_change = float(minimum_change)
+
+        # The metric pattern is turned into a regular expression once, and
+        # which metrics it matches is remembered.
+        self.pattern = re.compile(fnmatch.translate(metric))
+        self.matched = {}
+
+    # matches(): Returns True if the rule applies to a metric.
+    def matches(self, metric):
+        if metric not in self.matched:
+            self.matched[metric] = bool(self.pattern.match(metric))
+        return self.matched[metric]
+
+# State: Class that holds what one rule knows about one metric.
+class State(object):
+
+    # Initialize new instances of the class.
+    def __init__(self):
+        # Whether the rule is firing, whether the user has been told it is,
+        # and when the user was last told anything about it.
+        self.firing = False
+        self.notified = False
+        self.last_sent = None
+
+        # When the rule last saw the metric.
+        self.last_seen = None
+
+        # Recent values of the metric, for standard deviation rules, its
+        # EWMA, for z-score rules, or for slope rules the five minute bucket
+        # the slope was last worked out in and the slope.
+        self.window = None
+
+# Functions.
+# configure(): Sets up the alert rules.  Takes two arguments, a list of Rules
+#   and whether or not alerting is turned on.
+def configure(rule_list, alerting_enabled=True):
+    global rules
+    global enabled
+    global last_pruned
+
+    rules = list(rule_list)
+    enabled = alerting_enabled
+    states.clear()
+    last_pruned = None
+    logging.debug("Loaded " + str(len(rules)) + " alert rules.")
+
+# default_rules(): Builds the alert rules system_bot.py has always had out of
+#   its configuration settings.  Takes six arguments, the time between
+#   alerts, the percentage of disk space used and of memory free to consider
+#   critical, the number of standard deviations to consider a spike, and the
+#   minimum and maximum lengths of the stat windows.  Optionally takes the
+#   percentage of a network link's speed to consider saturated, the
+#   percentage of inodes used to consider critical, the percentage of the
+#   time a disk can be busy before it's saturated, the average number of
+#   milliseconds a disk operation can take before the disk is too slow, and
+#   how many megabytes of memory and how many file descriptors a monitored
+#   process can steadily gain per hour before it's considered to be leaking
+#   them, and the percentage of its memory limit a cgroup can use, the
+#   percentage of the time it can spend stalled waiting for memory, and the
+#   percentage of scheduling periods it can be throttled in before it's a
+#   problem, and how many milliseconds slower than usual a service has to
+#   answer its probe before it counts as slowing down.  Returns a list of
+#   Rules.
+def default_rules(time_between_alerts, disk_usage, memory_remaining,
+    std_devs, minimum_length, maximum_length, link_saturation=90.0,
+    inode_usage=90.0, disk_utilization=90.0, disk_await=1000.0,
+    memory_leak_rate=50.0, fd_leak_rate=100.0, cgroup_memory_usage=90.0,
+    cgroup_memory_pressure=10.0, cgroup_throttling=25.0,
+    probe_slowdown=100.0):
+    std_devs = float(std_devs)
+
+    # Spikes are readings that are unusually far above the baseline for the
+    # time of day.  Load has to go up by at least one and temperatures by at
+    # least five degrees, or a machine that's been idle for hours would
+    # raise an alarm over nothing.
+    window = max(1, int(maximum_length) - 1)
+    def spike(name, metric, message, minimum_change):
+        return Rule(name, metric, "zscore_above", std_devs,
+            cooldown=time_between_alerts, message=message,
+            minimum_samples=minimum_length, window=window, seasonal=True,
+            minimum_change=minimum_change)
+
+    return [
+        spike("load_spike", "load",
+            "WARNING: The current system load has spiked to {value}.", 1.0),
+        spike("load5_spike", "load5",
+            "WARNING: The five minute system load has spiked to {value}.  What could be running that's doing this?", 1.0),
+        spike("load15_spike", "load15",
+            "WARNING: The fifteen minute system load has spiked to {value}.  I think something's dreadfully wrong.", 1.0),
+        Rule("cpu_busy", "cpu_idle", "below", 15.0, 20.0,
+            time_between_alerts,
+            "WARNING: The current CPU idle time is sitting at {value}.  What's keeping it so busy?"),
+        Rule("disk_full", "disk:*", "above", disk_usage,
+            float(disk_usage) - 2.0, time_between_alerts,
+            "WARNING: Disk device {instance} has {remaining}% of its capacity left.",
+            "Disk device {instance} is back down to {value}% full."),
+        Rule("inodes_full", "inodes:*", "above", inode_usage,
+            float(inode_usage) - 2.0, time_between_alerts,
+            "WARNING: Filesystem {instance} has used {value}% of its inodes.  New files can't be created when it runs out, no matter how much space is free.",
+            "Filesystem {instance} is back down to {value}% of its inodes used."),
+        Rule("disk_saturated", "io_util:*", "above", disk_utilization,
+            float(disk_utilization) - 20.0, time_between_alerts,
+            "WARNING: Disk {instance} has been busy {value}% of the time.  Anything that touches it is going to stall.",
+            "Disk {instance} isn't saturated anymore."),
+        Rule("disk_slow", "io_await:*", "above", disk_await,
+            float(disk_await) / 2.0, time_between_alerts,
+            "WARNING: Disk operations on {instance} are taking {value} milliseconds on average.",
+            "Disk operations on {instance} are back down to {value} milliseconds on average."),
+        Rule("memory_low", "memory_free", "below", memory_remaining,
+            float(memory_remaining) + 2.0, time_between_alerts,
+            "WARNING: The amount of free memory has reached the critical point of {value}% free.  You'll want to see to this before the OOM killer starts reaping processes.",
+            "Free memory is back up to {value}%."),
+        Rule("temperature_critical", "temperature:*", "above",
+            "critical_temperature", None, time_between_alerts,
+            "DANGER: Temperature sensor {instance} is now reading {value} degrees Centigrade ({fahrenheit} degrees Fahrenheit).  Critical temperature reached!  Investigate immediately!",
+            supersedes=["temperature_high"]),
+        Rule("temperature_high", "temperature:*", "above",
+            "high_temperature", None, time_between_alerts,
+            "WARNING: Temperature sensor {instance} is now reading {value} degrees Centigrade ({fahrenheit} degrees Fahrenheit).  This is alarmingly high!"),
+        spike("temperature_spike", "temperature:*",
+            "WARNING: The temperature of sensor {instance} has spiked to {value} degrees Centigrade ({fahrenheit} degrees Fahrenheit)!  Investigate immediately!", 5.0),
+        Rule("link_saturated", "utilization:*", "above", link_saturation,
+            float(link_saturation) - 10.0, time_between_alerts,
+            "WARNING: Network interface {instance} is running at {value}% of its link speed.",
+            "Network interface {instance} is back down to {value}% of its link speed."),
+        # Leaks are judged from the last six hours of history, once there
+        # are at least two hours of it.
+        Rule("memory_leak", "process_rss:*", "slope_above", memory_leak_rate,
+            float(memory_leak_rate) / 2.0, time_between_alerts,
+            "WARNING: Process {instance} is using {value} MB of memory and has been using {score} MB more every hour.  It looks like it's leaking memory, and the OOM killer will get to it eventually.",
+            "Process {instance} isn't using more and more memory anymore.",
+            minimum_samples=24, window=72),
+        Rule("fd_leak", "process_fds:*", "slope_above", fd_leak_rate,
+            float(fd_leak_rate) / 2.0, time_between_alerts,
+            "WARNING: Process {instance} has {value} files open and has been opening {score} more every hour.  It looks like it's leaking file descriptors, and it'll fall over when it hits its limit.",
+            "Process {instance} isn't opening more and more files anymore.",
+            minimum_samples=24, window=72),
+        Rule("cgroup_memory_full", "cgroup_memory_used:*", "above",
+            cgroup_memory_usage, float(cgroup_memory_usage) - 5.0,
+            time_between_alerts,
+            "WARNING: Cgroup {instance} is using {value}% of its memory limit.  The OOM killer will start on it when it hits 100%.",
+            "Cgroup {instance} is back down to {value}% of its memory limit."),
+        Rule("cgroup_memory_pressure", "cgroup_memory_pressure:*", "above",
+            cgroup_memory_pressure, float(cgroup_memory_pressure) / 2.0,
+            time_between_alerts,
+            "WARNING: Cgroup {instance} spent {value}% of the last ten seconds stalled waiting for memory.",
+            "Cgroup {instance} isn't short of memory anymore."),
+        Rule("cgroup_throttled", "cgroup_throttled:*", "above",
+            cgroup_throttling, float(cgroup_throttling) / 2.0,
+            time_between_alerts,
+            "WARNING: Cgroup {instance} was throttled in {value}% of its scheduling periods.  It needs more CPU time than its limit allows.",
+            "Cgroup {instance} isn't being throttled much anymore."),
+        Rule("cgroup_oom_kill", "cgroup_oom_kills:*", "above", 0.0, None,
+            time_between_alerts,
+            "DANGER: The OOM killer killed {value} processes in cgroup {instance}."),
+        Rule("probe_down", "probe_up:*", "below", 1.0, None,
+            time_between_alerts,
+            "WARNING: Service {instance} ({target}) isn't answering: {error}",
+            "Service {instance} is answering again."),
+        # Latency is compared to its own EWMA, so a service that's always
+        # slow doesn't set it off but one that's slowing down does.
+        Rule("probe_slow", "probe_latency:*", "zscore_above", std_devs, None,
+            time_between_alerts,
+            "WARNING: Service {instance} ({target}) took {value} ms to answer.  It usually takes around {baseline} ms.",
+            "Service {instance} is answering as fast as usual again.",
+            minimum_samples=minimum_length, window=window,
+            minimum_change=probe_slowdown),
+        Rule("unreachable", "reachable", "below", 1.0, None,
+            time_between_alerts, "WARNING: I can't reach this device.",
+            "This device can be reached again.")
+        ]
+
+# evaluate(): Checks every alert rule against one pass worth of metrics.
+#   Takes one argument, a hash table of metric names to values, and
+#   optionally the name of the device they came from, the current time, and
+#   a hash table of metric names to extra fields their messages can use
+#   (like the log line that matched).  Returns a list of (rule name, message)
+#   tuples for everything the user should be told about, which might be
+#   empty.
+def evaluate(metrics, source="", now=None, context=None):
+    alerts = []
+    if not enabled:
+        return alerts
+    if now is None:
+        now = time.monotonic()
+
+    # Rules are checked after the rules that supersede them, so that whether
+    # they've been silenced is known before they decide to tell the user
+    # anything.
+    silenced = set()
+    for rule in _superseding_first(rules):
+        for metric in metrics:
+            if not rule.matches(metric):
+                continue
+            message = _evaluate_rule(rule, metric, metrics, source, now,
+                context, (rule.name, metric) in silenced)
+            if message:
+                alerts.append((rule.name, message))
+            # A rule that didn't apply (a temperature sensor without a
+            # critical temperature, say) doesn't have a state to look at.
+            state = states.get((source, rule.name, metric))
+            if rule.supersedes and state is not None and state.firing:
+                for i in rule.supersedes:
+                    silenced.add((i, metric))
+
+    if last_pruned is None or now - last_pruned >= expiry:
+        prune(now)
+    return alerts
+
+# prune(): Forgets what the rules know about metrics they haven't seen for
+#   expiry seconds, and which metrics the rules match (which is only
+#   remembered to save time, and is worked out again as needed).  Takes one
+#   argument, the current time (on the same clock evaluate() was given).
+#   Returns the number of states forgotten.
+def prune(now):
+    global last_pruned
+
+    last_pruned = now
+    expired = [key for (key, state) in states.items()
+        if state.last_seen is not None and now - state.last_seen >= expiry]
+    for key in expired:
+        del states[key]
+    for rule in rules:
+        rule.matched.clear()
+    if expired:
+        logging.debug("Forgot the alert states of " + str(len(expired)) + " metrics that haven't been seen for a while.")
+    return len(expired)
+
+# consolidate(): Turns everything evaluate() found into one message, with
+#   alerts that say the same thing only mentioned once.  Takes one argument,
+#   a list of (rule name, message) tuples, and optionally a prefix to put in
+#   front of every line.  Returns a string, which might be empty.
+def consolidate(alerts, prefix=""):
+    lines = []
+    seen = set()
+    for (name, message) in alerts:
+        line = prefix + message.strip()
+        if line in seen:
+            continue
+        seen.add(line)
+        lines.append(line)
+    if not lines:
+        return ""
+    return "\n".join(lines) + "\n"
+
+# _superseding_first(): Helper function that puts a list of rules in the
+#   order they're checked in: every rule after the rules that supersede it,
+#   and otherwise in the order they were declared.  Takes one argument, the
+#   list of rules.  Returns a list of Rules.
+def _superseding_first(rule_list):
+    names = set(rule.name for rule in rule_list)
+    superseded_by = {}
+    for rule in rule_list:
+        for name in rule.supersedes:
+            if name in names and name != rule.name:
+                superseded_by.setdefault(name, set()).add(rule.name)
+
+    ordered = []
+    placed = set()
+    remaining = list(rule_list)
+    while remaining:
+        ready = [rule for rule in remaining
+            if superseded_by.get(rule.name, set()) <= placed]
+
+        # Rules that supersede each other go in the order they were
+        # declared.
+        if not ready:
+            ready = remaining[:1]
+        for rule in ready:
+            ordered.append(rule)
+            placed.add(rule.name)
+            remaining.remove(rule)
+    return ordered
+
+# _evaluate_rule(): Helper function that checks one rule against one metric
+#   and works out whether the user needs to hear about it.  Takes seven
+#   arguments, the rule, the name of the metric, the hash table of metrics,
+#   the source, the current time, the extra fields for messages (or None),
+#   and whether a rule that supersedes this one is firing.  A silenced rule
+#   still keeps track of whether it's firing, but the user isn't told and
+#   its cooldown isn't used up.  Returns a message or None.
+def _evaluate_rule(rule, metric, metrics, source, now, context,
+    silenced=False):
+    instance = ""
+    if ":" in metric:
+        instance = metric.split(":", 1)[1]
+
+    # If the threshold comes from another metric that isn't there, this rule
+    # doesn't apply.
+    threshold = _resolve(rule.threshold, instance, metrics)
+    clear = _resolve(rule.clear, instance, metrics)
+    if threshold is None or clear is None:
+        return None
+
+    key = (source, rule.name, metric)
+    if key not in states:
+        states[key] = State()
+    state = states[key]
+    state.last_seen = now
+
+    value = float(metrics[metric])
+    baseline = None
+    if rule.condition == "stdev_above":
+        if state.window is None:
+            state.window = RingBuffer(rule.window)
+        state.window.append(value)
+        if len(state.window) < rule.minimum_samples:
+            return None
+        measured = state.window.stdev()
+    elif rule.condition == "zscore_above":
+        if state.window is None:
+            state.window = anomaly.EWMA(anomaly.span_to_alpha(rule.window))
+
+        # The reading is scored against the baseline from before it was
+        # taken.  The hour of the day baselines are made from hourly
+        # averages, which vary less than single readings do, so they never
+        # count as less variable than the EWMA says the metric is.
+        (baseline, stdev) = (state.window.mean, state.window.stdev())
+        if rule.seasonal:
+            name = metric
+            if source:
+                name = source + ":" + metric
+            seasonal = anomaly.seasonal_baseline(name.lower().replace(" ", "_"))
+            if seasonal:
+                (baseline, stdev) = (seasonal[0], max(seasonal[1], stdev))
+        ready = len(state.window) >= rule.minimum_samples
+        state.window.update(value)
+        if not ready:
+            return None
+        measured = anomaly.zscore(value, baseline, stdev, rule.minimum_change)
+    elif rule.condition == "slope_above":
+        # The slope only changes when a five minute bucket fills up, so it's
+        # only worked out again once per bucket.
+        current = int(time.time()) // slope_resolution
+        if state.window is None or state.window[0] != current:
+            name = metric
+            if source:
+                name = source + ":" + metric
+            end = time.time()
+            points = [(i[0], i[2]) for i in timeseries.buckets(name,
+                slope_resolution, end - rule.window * slope_resolution, end)]
+            fit = None
+            if len(points) >= rule.minimum_samples:
+                fit = anomaly.trend(points)
+            state.window = (current, fit)
+        fit = state.window[1]
+        if fit is None:
+            return None
+        measured = fit[0] * 3600.0
+        if fit[1] < steady_growth:
+            measured = 0.0
+    else:
+        measured = value
+    logging.debug("Alert rule " + rule.name + " on " + source + ":" + metric + ": " + str(measured))
+
+    # Hysteresis: it takes crossing the threshold to start firing and
+    # crossing back over the clear level to stop.
+    if rule.condition == "below":
+        starting = measured < threshold
+        clearing = measured >= clear
+    else:
+        starting = measured > threshold
+        clearing = measured <= clear
+
+    fields = {"name": rule.name, "metric": metric, "instance": instance,
+        "value": round(value, 2), "threshold": threshold,
+        "remaining": round(100.0 - value, 2),
+        "fahrenheit": round(value * 9.0 / 5.0 + 32.0, 2),
+        "score": round(measured, 2),
+        "baseline": round(value if baseline is None else baseline, 2)}
+    if context and metric in context:
+        fields.update(context[metric])
+
+    # The cooldown applies across separate runs of trouble too, so that a
+    # metric bouncing back and forth across both levels doesn't send a
+    # message every time.
+    cooled_down = state.last_sent is None or now - state.last_sent >= rule.cooldown
+
+    if not state.firing:
+        if not starting:
+            return None
+        state.firing = True
+        state.notified = False
+        if not cooled_down or silenced:
+            return None
+        state.notified = True
+        state.last_sent = now
+        return _format(rule.message, fields)
+
+    if clearing:
+        state.firing = False
+        if state.notified and rule.clear_message and not silenced:
+            return _format(rule.clear_message, fields)
+        return None
+
+    # Still firing.  Remind the user every so often, or tell them for the
+    # first time if they haven't been told yet.
+    if silenced:
+        return None
+    if cooled_down and (rule.cooldown or not state.notified):
+        state.notified = True
+        state.last_sent = now
+        return _format(rule.message, fields)
+    return None
+
+# _number_or_metric(): Helper function that turns a threshold from the
+#   configuration file into a number if it is one, or leaves it as the name
+#   of a metric if it isn't.
+def _number_or_metric(threshold):
+    try:
+        return float(threshold)
+    except (TypeError, ValueError):
+        return str(threshold).strip()
+
+# _resolve(): Helper function that works out the value of a threshold for one
+#   instance of a metric.  Returns a number, or None if the threshold is a
+#   metric that doesn't exist.
+def _resolve(threshold, instance, metrics):
+    if isinstance(threshold, float):
+        return threshold
+    name = threshold
+    if instance:
+        name = threshold + ":" + instance
+    if name not in metrics or metrics[name] is None:
+        return None
+    return float(metrics[name])
+
+# _format(): Helper function that fills in the fields of an alert message.
+#   A message with a typo in it is sent as-is rather than not at all.
+def _format(message, fields):
+    try:
+        return message.format(**fields)
+    except (KeyError, IndexError, ValueError) as e:
+        logging.warning("Unable to fill in alert message '" + message + "': " + str(e))
+        return message
+
+# Self tests.  Run with python3 alerts.py.
+if __name__ == "__main__":
+    rules = default_rules(3600, 95.0, 10.0, 2, 2, 100)
+
+    # A sensor without a critical temperature still gets checked against its
+    # high temperature.
+    found = evaluate({"temperature:Core 0": 50.0,
+        "high_temperature:Core 0": 80.0})
+    assert found == [], found
+    found = evaluate({"temperature:Core 0": 85.0,
+        "high_temperature:Core 0": 80.0})
+    assert [i[0] for i in found] == ["temperature_high"], found
+
+    # One with a critical temperature only hears about that once it's been
+    # reached.
+    found = evaluate({"temperature:Core 1": 95.0,
+        "high_temperature:Core 1": 80.0,
+        "critical_temperature:Core 1": 90.0})
+    assert [i[0] for i in found] == ["temperature_critical"], found
+
+    # Being superseded doesn't use up a rule's cooldown, so the high
+    # temperature is mentioned as soon as the critical temperature clears.
+    states.clear()
+    last_pruned = None
+    sensor = {"high_temperature:Core 2": 80.0,
+        "critical_temperature:Core 2": 90.0}
+    found = evaluate(dict(sensor, **{"temperature:Core 2": 95.0}), now=0)
+    assert [i[0] for i in found] == ["temperature_critical"], found
+    found = evaluate(dict(sensor, **{"temperature:Core 2": 85.0}), now=60)
+    assert [i[0] for i in found] == ["temperature_high"], found
+    found = evaluate(dict(sensor, **{"temperature:Core 2": 85.0}), now=120)
+    assert found == [], found
+
+    # Metrics that haven't been seen for a day are forgotten.
+    evaluate({"disk:/mnt": 50.0}, now=0)
+    assert ("", "disk_full", "disk:/mnt") in states
+    evaluate({"disk:/": 50.0}, now=expiry)
+    assert ("", "disk_full", "disk:/mnt") not in states
+    assert ("", "disk_full", "disk:/") in states
+    assert "disk:/mnt" not in rules[4].matched
+    print("All self tests passed.")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# anomaly.py - Module that works out how unusual a reading is for
+#   system_bot.py.  Each metric has a baseline, and readings are scored by how
+#   many standard deviations they are above it (a z-score).  The baseline is
+#   an exponentially weighted moving average and variance (EWMA) of the
+#   metric, which follows gradual changes and costs the same to update no
+#   matter how much history it covers.
+#
+#   Things like load follow the clock (backups at 3am, builds during the
+#   day), so if there's enough history a metric can also have a baseline for
+#   each hour of the day, learned from the hourly buckets timeseries.py keeps.
+#   Those are the mean and standard deviation of the same hour across the
+#   days of history, and they're learned again once an hour.  A metric
+#   without enough history at the current hour falls back on its EWMA.
+#
+#   It can also fit a line to a metric's history, to tell whether something
+#   like a process' memory use is growing steadily.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Added trend(), which tells whether a metric is growing steadily.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import logging
+import math
+import time
+
+import timeseries
+
+# Constants.
+# Fewest days of history an hour of the day needs before it has a baseline
+# of its own.
+minimum_days = 7
+
+# How far back (in seconds) hour of the day baselines are learned from, and
+# how often (in seconds) they're learned again.
+seasonal_history = 90 * 86400
+seasonal_refresh = 3600
+
+# Variables global to this module.
+# Hash table of metric names to (time learned, list of 24 (mean, standard
+# deviation) tuples or None, one per hour of the day).
+seasonal_baselines = {}
+
+# Classes.
+# EWMA: Class that keeps the exponentially weighted moving average and
+#   variance of a metric.
+class EWMA(object):
+
+    # Initialize new instances of the class.  Takes one argument, the weight
+    # given to each new sample (between 0 and 1).
+    def __init__(self, alpha):
+        self.alpha = min(1.0, max(0.0001, float(alpha)))
+        self.mean = 0.0
+        self.variance = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # update(): Folds a sample into the average and variance.  Takes one
+    #   argument, the sample.
+    def update(self, value):
+        value = float(value)
+        self.count = self.count + 1
+        if self.count == 1:
+            self.mean = value
+            self.variance = 0.0
+            return
+        difference = value - self.mean
+        increment = self.alpha * difference
+        self.mean = self.mean + increment
+        self.variance = (1.0 - self.alpha) * (self.variance +
+            difference * increment)
+
+    # stdev(): Returns the standard deviation.
+    def stdev(self):
+        return math.sqrt(max(self.variance, 0.0))
+
+# Functions.
+# span_to_alpha(): Function that works out the weight to give each new sample
+#   so that an EWMA covers about as many samples as a window of a given
+#   length.  Takes one argument, the length.  Returns a floating point
+#   number.
+def span_to_alpha(span):
+    return 2.0 / (max(1, int(span)) + 1.0)
+
+# zscore(): Function that scores a reading against a baseline.  Readings
+#   that are less than a minimum distance from the mean score zero, so that
+#   a metric which has barely moved (and so has a tiny standard deviation)
+#   doesn't look alarming when it twitches.  Takes three arguments, the
+#   reading and the mean and standard deviation of the baseline, and
+#   optionally the minimum distance.  Returns the number of standard
+#   deviations the reading is above the mean (negative if it's below).
+def zscore(value, mean, stdev, minimum_change=0.0):
+    deviation = value - mean
+    if abs(deviation) < minimum_change or deviation == 0.0:
+        return 0.0
+    if stdev <= 0.0:
+        return math.copysign(float("inf"), deviation)
+    return deviation / stdev
+
+# trend(): Function that fits a straight line to a metric's history by least
+#   squares, to tell whether it's growing steadily.  Takes one argument, a
+#   list of (time, value) tuples.  Returns a (slope in units per second, r
+#   squared) tuple, where r squared is how well the line fits (1.0 means
+#   every point is on it), or None if there aren't two different times to
+#   fit a line to.
+def trend(points):
+    if len(points) < 2:
+        return None
+    origin = points[0][0]
+    times = [i[0] - origin for i in points]
+    values = [float(i[1]) for i in points]
+    mean_time = math.fsum(times) / len(times)
+    mean_value = math.fsum(values) / len(values)
+    spread = math.fsum((i - mean_time) ** 2 for i in times)
+    if spread <= 0.0:
+        return None
+    covariance = math.fsum((t - mean_time) * (v - mean_value)
+        for (t, v) in zip(times, values))
+    slope = covariance / spread
+    variation = math.fsum((v - mean_value) ** 2 for v in values)
+    if variation <= 0.0:
+        return (slope, 1.0)
+    return (slope, (covariance * covariance) / (spread * variation))
+
+# seasonal_baseline(): Function that returns the baseline of a metric for
+#   the current hour of the day, learning it from the history if it hasn't
+#   been recently.  Takes one argument, the name of the metric in the
+#   history, and optionally the time to look up.  Returns a (mean, standard
+#   deviation) tuple, or None if there isn't enough history.
+def seasonal_baseline(metric, now=None):
+    if now is None:
+        now = time.time()
+    if metric not in seasonal_baselines or now - seasonal_baselines[metric][0] >= seasonal_refresh:
+        seasonal_baselines[metric] = (now, learn_seasonal_baseline(metric,
+            now))
+    return seasonal_baselines[metric][1][time.localtime(now).tm_hour]
+
+# learn_seasonal_baseline(): Function that works out the mean and standard
+#   deviation of a metric at each hour of the day from the hourly buckets of
+#   its history.  The hour that's still going on is left out.  Takes two
+#   arguments, the name of the metric and the current time.  Returns a list
+#   of 24 (mean, standard deviation) tuples, with None for hours that don't
+#   have minimum_days of history.
+def learn_seasonal_baseline(metric, now):
+    hours = [[] for i in range(24)]
+    for (start, count, mean, minimum, maximum) in timeseries.buckets(metric,
+        3600, now - seasonal_history, now - 3600):
+        hours[time.localtime(start).tm_hour].append(mean)
+
+    baselines = []
+    for means in hours:
+        if len(means) < minimum_days:
+            baselines.append(None)
+            continue
+        average = math.fsum(means) / len(means)
+        variance = math.fsum((i - average) ** 2 for i in means) / (len(means) - 1)
+        baselines.append((average, math.sqrt(variance)))
+    logging.debug("Learned hour of the day baselines for " + metric + " from " + str(sum(len(i) for i in hours)) + " hours of history.")
+    return baselines
+
+if "__name__" == "__main__":
+    pass
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# cgroups.py - Module that reads how much memory, CPU time, and disk I/O
+#   control groups (cgroup v2) are using, for system_bot.py.  On a container
+#   host the system load and free memory describe the whole host, but what
+#   matters to a container or a systemd service is what it's using compared
+#   to its own limits: memory.current against memory.max, CPU time against
+#   cpu.max (and how often it was throttled for going over), and how much
+#   memory pressure it's under (from the kernel's pressure stall
+#   information).  Counters are turned into rates since the last read.
+#
+#   Cgroups can be given as paths (absolute, or relative to the cgroup
+#   filesystem) or as the names of systemd units ("nginx.service",
+#   "machine.slice"), which are looked for in the cgroup filesystem.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import logging
+import os
+import time
+
+# Constants.
+# Where the cgroup v2 filesystem is mounted.
+cgroup_root = "/sys/fs/cgroup"
+
+# Suffixes of systemd unit names, which are looked for in the cgroup
+# filesystem instead of being taken as paths.
+unit_types = (".service", ".scope", ".slice", ".socket", ".mount", ".swap")
+
+# How deep into the cgroup filesystem to look for systemd units, and how many
+# seconds to wait before looking again for one that couldn't be found.
+maximum_depth = 5
+search_interval = 60.0
+
+# Variables global to this module.
+# The cgroups to read: a list of names as they were configured.
+monitored = []
+
+# Hash table of configured names to the directories they were found at, and
+# when each name that couldn't be found was last looked for.
+paths = {}
+last_searched = {}
+
+# Hash table of configured names to (time.monotonic(), counters) tuples from
+# the last read, for working out rates.
+previous = {}
+
+# Functions.
+# configure(): Sets which cgroups to read.  Takes one argument, a list of
+#   cgroups (or a comma separated string of them), and optionally where the
+#   cgroup filesystem is mounted.
+def configure(cgroup_list, root=None):
+    global monitored
+    global cgroup_root
+
+    if root:
+        cgroup_root = root
+    if isinstance(cgroup_list, str):
+        cgroup_list = cgroup_list.split(",")
+    monitored = [i.strip() for i in cgroup_list if i.strip()]
+    paths.clear()
+    last_searched.clear()
+    previous.clear()
+    if monitored and not os.path.exists(os.path.join(cgroup_root, "cgroup.controllers")):
+        logging.warning(cgroup_root + " isn't a cgroup v2 filesystem, so cgroups can't be monitored.")
+    logging.debug("Cgroups to monitor: " + ", ".join(monitored))
+
+# read_all(): Reads every monitored cgroup.  Takes no arguments.  Returns a
+#   hash table of configured names to hash tables from read_cgroup(), without
+#   the ones that don't exist right now.
+def read_all():
+    found = {}
+    for name in monitored:
+        path = find_cgroup(name)
+        if not path:
+            continue
+        try:
+            found[name] = read_cgroup(name, path)
+        except OSError as e:
+            # The container or service went away between finding it and
+            # reading it.  Look for it again next time.
+            logging.debug("Unable to read cgroup " + name + ": " + str(e))
+            paths.pop(name, None)
+            previous.pop(name, None)
+    return found
+
+# find_cgroup(): Works out which directory of the cgroup filesystem a
+#   configured cgroup is.  Takes one argument, the configured name.  Returns
+#   the path, or None if it doesn't exist (right now).
+def find_cgroup(name):
+    if name in paths and os.path.isdir(paths[name]):
+        return paths[name]
+    paths.pop(name, None)
+
+    if not name.endswith(unit_types):
+        path = name
+        if not os.path.isabs(name):
+            path = os.path.join(cgroup_root, name)
+        if os.path.isdir(path):
+            paths[name] = path
+        return paths.get(name)
+
+    # Searching the whole cgroup filesystem is slow-ish, so a unit that isn't
+    # running isn't searched for every time.
+    now = time.monotonic()
+    if now - last_searched.get(name, -search_interval) < search_interval:
+        return None
+    last_searched[name] = now
+    base_depth = cgroup_root.rstrip(os.sep).count(os.sep)
+    for (directory, subdirectories, files) in os.walk(cgroup_root):
+        if name in subdirectories:
+            paths[name] = os.path.join(directory, name)
+            return paths[name]
+        if directory.count(os.sep) - base_depth >= maximum_depth:
+            subdirectories[:] = []
+    return None
+
+# read_cgroup(): Reads one cgroup and works out its rates since the last
+#   time.  Takes two arguments, the configured name and the path to the
+#   cgroup.  Returns a hash table of memory (bytes), memory_limit (bytes, or
+#   None if there isn't one), memory_pressure (percentage of the last ten
+#   seconds some tasks were stalled waiting for memory), oom_kills (since the
+#   last read), cpu (percentage of one CPU used), cpu_limit (percentage of one
+#   CPU it's allowed, or None), throttled (percentage of scheduling periods
+#   it was throttled in), and read_bytes, write_bytes, reads, and writes (per
+#   second).  Anything that couldn't be worked out (the rates, the first
+#   time) is left out.
+def read_cgroup(name, path):
+    stats = {}
+    now = time.monotonic()
+
+    stats["memory"] = int(_read(path, "memory.current"))
+    stats["memory_limit"] = _limit(_read(path, "memory.max"))
+    stats["memory_pressure"] = _pressure(path, "memory.pressure")
+    cpu_max = _read(path, "cpu.max", "max").split()
+    stats["cpu_limit"] = None
+    if cpu_max[0] != "max" and len(cpu_max) > 1 and int(cpu_max[1]):
+        stats["cpu_limit"] = int(cpu_max[0]) / int(cpu_max[1]) * 100.0
+
+    # The counters rates are worked out from.  Cgroups don't have to have
+    # every controller turned on, so missing files count as zero.
+    counters = {}
+    cpu_stat = _keyed(_read(path, "cpu.stat", ""))
+    counters["usage_usec"] = cpu_stat.get("usage_usec", 0)
+    counters["nr_periods"] = cpu_stat.get("nr_periods", 0)
+    counters["nr_throttled"] = cpu_stat.get("nr_throttled", 0)
+    counters["oom_kill"] = _keyed(_read(path, "memory.events", "")).get("oom_kill", 0)
+    for key in ("rbytes", "wbytes", "rios", "wios"):
+        counters[key] = 0
+    # io.stat has a line per disk: "8:0 rbytes=... wbytes=... rios=... ..."
+    for line in _read(path, "io.stat", "").splitlines():
+        fields = _keyed("\n".join(line.split()[1:]), "=")
+        for key in ("rbytes", "wbytes", "rios", "wios"):
+            counters[key] = counters[key] + fields.get(key, 0)
+
+    last = previous.get(name)
+    previous[name] = (now, counters)
+    if not last or now <= last[0]:
+        return stats
+    elapsed = now - last[0]
+    def delta(key):
+        return max(0, counters[key] - last[1][key])
+
+    stats["cpu"] = delta("usage_usec") / (elapsed * 1000000.0) * 100.0
+    stats["throttled"] = 0.0
+    if delta("nr_periods"):
+        stats["throttled"] = delta("nr_throttled") / delta("nr_periods") * 100.0
+    stats["oom_kills"] = delta("oom_kill")
+    stats["read_bytes"] = delta("rbytes") / elapsed
+    stats["write_bytes"] = delta("wbytes") / elapsed
+    stats["reads"] = delta("rios") / elapsed
+    stats["writes"] = delta("wios") / elapsed
+    return stats
+
+# _read(): Helper function that reads one of a cgroup's files.  Takes two
+#   arguments, the path to the cgroup and the name of the file, and
+#   optionally what to return if the file doesn't exist (if not given, that's
+#   an error).  Returns the contents, stripped.
+def _read(path, filename, default=None):
+    try:
+        with open(os.path.join(path, filename), "r") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        if default is None:
+            raise
+        return default
+
+# _keyed(): Helper function that turns lines of "key value" into a hash table
+#   of integers.  Takes one argument, the text, and optionally what separates
+#   keys from values.
+def _keyed(text, separator=None):
+    found = {}
+    for line in text.splitlines():
+        fields = line.split(separator, 1)
+        if len(fields) == 2:
+            try:
+                found[fields[0].strip()] = int(fields[1])
+            except ValueError:
+                continue
+    return found
+
+# _limit(): Helper function that turns a limit from a cgroup file into a
+#   number, or None if it's "max" (no limit).
+def _limit(value):
+    if value == "max":
+        return None
+    return int(value)
+
+# _pressure(): Helper function that reads the percentage of the last ten
+#   seconds some of a cgroup's tasks were stalled, from one of its pressure
+#   stall information files.  Returns None if the kernel doesn't keep it.
+def _pressure(path, filename):
+    for line in _read(path, filename, "").splitlines():
+        fields = line.split()
+        if fields and fields[0] == "some":
+            for field in fields[1:]:
+                if field.startswith("avg10="):
+                    return float(field.split("=", 1)[1])
+    return None
+
+if "__name__" == "__main__":
+    pass
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# dispatcher.py - Module that implements pre-compiled command dispatch for the
+#   PyParsing-based command parsers.  Every grammar a bot understands is
+#   registered once when the parser module is loaded, along with the words a
+#   matching command can start with.  When a command comes in only the
+#   grammars filed under its first word are tried, in the order they were
+#   registered, and the first one that matches wins.  Packrat parsing is
+#   turned on so that grammars which share prefixes don't re-parse them.
+#
+#   PyParsing keywords match the start of a word, so "temperatures" or
+#   "loadavg" have always been understood even though no grammar starts with
+#   them.  Commands whose first word isn't in the index are run through every
+#   grammar, so they still are.
+#
+#   The same module is used by several bots, so if you change it here change
+#   it everywhere.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Commands whose first word isn't in the index fall back to trying
+#        every grammar, like they did before there was an index.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import logging
+import pyparsing as pp
+
+# Memoize intermediate parse results.  This is global to PyParsing, so it only
+# has to happen once.
+pp.ParserElement.enablePackrat()
+
+# Dispatcher: Class that holds an index of compiled grammars keyed by the first
+#   word of the commands they match.
+class Dispatcher(object):
+
+    # Initialize new instances of the class.
+    def __init__(self):
+        # Hash table of first words to lists of (grammar, action) tuples.
+        self.index = {}
+
+        # Every registered grammar, in order.  Used by dispatch_all() as the
+        # slow path.
+        self.grammars = []
+
+    # register(): Adds a grammar to the index.  Takes three arguments, a list
+    #   of words the command can start with, the compiled grammar, and a
+    #   function to call with the parsed command when it matches.  The function
+    #   returns whatever the parser module wants to return for that kind of
+    #   command, or None to keep trying the rest of the grammars.
+    def register(self, first_words, grammar, action):
+        grammar.streamline()
+        for word in first_words:
+            self.index.setdefault(word.lower(), []).append((grammar, action))
+        self.grammars.append((grammar, action))
+
+    # dispatch(): Tries the grammars filed under the first word of a command,
+    #   or every grammar if none are.  Takes one argument, the command.
+    #   Returns what the matching grammar's action returned, or None if
+    #   nothing matched.
+    def dispatch(self, command):
+        words = command.split(None, 1)
+        if not words:
+            return None
+        candidates = self.index.get(words[0].lower())
+        if not candidates:
+            logging.debug("No grammars start with " + words[0] + ", trying all of them.")
+            return self.dispatch_all(command)
+        return self._try(candidates, command)
+
+    # dispatch_all(): Tries every registered grammar in order, which is how
+    #   command parsing worked before there was an index.  Used for commands
+    #   the index doesn't know, and for comparing the two.  Takes one argument,
+    #   the command.
+    def dispatch_all(self, command):
+        return self._try(self.grammars, command)
+
+    # _try(): Helper method that runs a command through a list of
+    #   (grammar, action) tuples and returns the first non-None result.
+    def _try(self, candidates, command):
+        for (grammar, action) in candidates:
+            try:
+                parsed_command = grammar.parseString(command)
+            except pp.ParseException:
+                continue
+            result = action(parsed_command)
+            if result is not None:
+                return result
+        return None
+
+if "__name__" == "__main__":
+    pass
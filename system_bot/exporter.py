@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# exporter.py - Module that serves the stats system_bot.py collects over HTTP
+#   so that dashboards can scrape them: /metrics in Prometheus' text format
+#   and /metrics.json as JSON.  Every time the periodic checks run they hand
+#   their stats to publish(), and scrapes are answered from those, so
+#   scraping never makes the bot collect anything.  Along with the latest
+#   value of each stat are its lowest, average, and highest values over the
+#   last five minutes and the last hour, from the history kept by
+#   timeseries.py.  Each format is worked out at most once per run of the
+#   checks no matter how often it's scraped.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.2 - Added the service probe stats, which are published separately from
+#       the rest of the system's stats.
+# v1.1 - Added the cgroup stats.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import json
+import logging
+import math
+import re
+import threading
+import time
+
+import timeseries
+
+# Constants.
+# Prefix of the name of every stat in Prometheus' format.
+namespace = "systembot"
+
+# Spans of the history (names and lengths in seconds) summarized along with
+# the latest value of each stat.
+windows = [("5m", 300), ("1h", 3600)]
+
+# What the part of a stat's name after the colon is (a mount point, a disk, a
+# network interface, a temperature sensor), which becomes the name of its
+# label in Prometheus' format.
+label_names = {
+    "disk": "mountpoint",
+    "inodes": "mountpoint",
+    "io_reads": "disk",
+    "io_writes": "disk",
+    "io_read_bytes": "disk",
+    "io_write_bytes": "disk",
+    "io_await": "disk",
+    "io_util": "disk",
+    "temperature": "sensor",
+    "high_temperature": "sensor",
+    "critical_temperature": "sensor",
+    "sent": "interface",
+    "received": "interface",
+    "packets_sent": "interface",
+    "packets_received": "interface",
+    "utilization": "interface",
+    "process_rss": "process",
+    "process_cpu": "process",
+    "process_fds": "process",
+    "process_threads": "process",
+    "cgroup_memory": "cgroup",
+    "cgroup_memory_used": "cgroup",
+    "cgroup_memory_pressure": "cgroup",
+    "cgroup_oom_kills": "cgroup",
+    "cgroup_cpu": "cgroup",
+    "cgroup_cpu_used": "cgroup",
+    "cgroup_throttled": "cgroup",
+    "cgroup_reads": "cgroup",
+    "cgroup_writes": "cgroup",
+    "cgroup_read_bytes": "cgroup",
+    "cgroup_write_bytes": "cgroup",
+    "probe_up": "service",
+    "probe_latency": "service"
+    }
+
+# Descriptions of the stats, for the HELP lines of Prometheus' format.
+descriptions = {
+    "load": "System load, one minute average.",
+    "load5": "System load, five minute average.",
+    "load15": "System load, fifteen minute average.",
+    "cpu_idle": "Percentage of CPU time spent idle.",
+    "memory_free": "Percentage of memory free.",
+    "disk": "Percentage of disk space used.",
+    "inodes": "Percentage of inodes used.",
+    "io_reads": "Disk reads per second.",
+    "io_writes": "Disk writes per second.",
+    "io_read_bytes": "Bytes read from disk per second.",
+    "io_write_bytes": "Bytes written to disk per second.",
+    "io_await": "Average milliseconds per disk operation.",
+    "io_util": "Percentage of the time the disk was busy.",
+    "temperature": "Temperature in degrees Centigrade.",
+    "high_temperature": "Temperature the sensor considers high.",
+    "critical_temperature": "Temperature the sensor considers critical.",
+    "sent": "Bytes sent per second.",
+    "received": "Bytes received per second.",
+    "packets_sent": "Packets sent per second.",
+    "packets_received": "Packets received per second.",
+    "utilization": "Percentage of the link speed in use.",
+    "reachable": "1 if the device answered, 0 if it didn't.",
+    "process_rss": "Resident memory of a monitored process in megabytes.",
+    "process_cpu": "Percentage of a CPU a monitored process is using.",
+    "process_fds": "File descriptors a monitored process has open.",
+    "process_threads": "Threads a monitored process is running.",
+    "cgroup_memory": "Memory a cgroup is using in megabytes.",
+    "cgroup_memory_used": "Percentage of its memory limit a cgroup is using.",
+    "cgroup_memory_pressure": "Percentage of the last ten seconds a cgroup was stalled waiting for memory.",
+    "cgroup_oom_kills": "Processes in a cgroup the OOM killer killed since the last check.",
+    "cgroup_cpu": "Percentage of a CPU a cgroup is using.",
+    "cgroup_cpu_used": "Percentage of its CPU limit a cgroup is using.",
+    "cgroup_throttled": "Percentage of scheduling periods a cgroup was throttled in.",
+    "cgroup_reads": "Disk reads per second by a cgroup.",
+    "cgroup_writes": "Disk writes per second by a cgroup.",
+    "cgroup_read_bytes": "Bytes read from disk per second by a cgroup.",
+    "cgroup_write_bytes": "Bytes written to disk per second by a cgroup.",
+    "probe_up": "1 if a service answered its probe, 0 if it didn't.",
+    "probe_latency": "Milliseconds a service took to answer its probe."
+    }
+
+# Variables global to this module.
+# Hash table of the stats most recently published by each source ("" for the
+# system the bot is running on, otherwise the name of an OpenWRT device) and
+# group (stats that are collected separately, like the service probes, so
+# they don't replace each other) to (time published, hash table of stats)
+# tuples.
+snapshots = {}
+
+# Goes up by one every time something is published, so scrapes can tell if
+# what they worked out last time is still good.
+generation = 0
+
+# Hash table of formats ("prometheus", "json") to (generation, body) tuples.
+rendered = {}
+
+# Protects snapshots, generation, and rendered.  Stats are published by the
+# periodic checks and scraped by the web server's threads.
+lock = threading.Lock()
+
+# Handle to the web server, if it's running.
+server = None
+
+# Classes.
+# Handler: Class that answers scrapes.
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            self._send(200, "text/plain; version=0.0.4; charset=utf-8",
+                render("prometheus"))
+        elif path == "/metrics.json":
+            self._send(200, "application/json", render("json"))
+        else:
+            self._send(404, "text/plain; charset=utf-8",
+                "Try /metrics or /metrics.json.\n")
+
+    # Scrapes happen every few seconds, so they're only logged when
+    # debugging.
+    def log_message(self, format, *args):
+        logging.debug("Exporter: " + self.address_string() + " - " + (format % args))
+
+    # _send(): Helper method that sends a response.  Takes three arguments,
+    #   the HTTP status code, the content type, and the body.
+    def _send(self, status, content_type, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Functions.
+# start(): Starts the web server on a thread of its own.  Takes two arguments,
+#   the address and the port to listen on.
+def start(address, port):
+    global server
+    server = ThreadingHTTPServer((address, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="exporter",
+        daemon=True).start()
+    logging.info("Serving stats at http://" + address + ":" + str(port) + "/metrics")
+
+# publish(): Makes a set of stats the ones scrapes are answered with.  Takes
+#   one argument, a hash table of stats from system_stats.collect_metrics(),
+#   and optionally the name of the OpenWRT device they're from and the group
+#   they belong to (stats published in one group don't replace the ones in
+#   another).
+def publish(metrics, source="", group=""):
+    global generation
+    with lock:
+        snapshots[(source, group)] = (time.time(), dict(metrics))
+        generation = generation + 1
+
+# render(): Returns the published stats in a given format, working it out
+#   again only if something's been published since the last time.  Takes one
+#   argument, the format ("prometheus" or "json").  Returns a string.
+def render(format):
+    with lock:
+        if format in rendered and rendered[format][0] == generation:
+            return rendered[format][1]
+        current = generation
+        published = dict(snapshots)
+
+    # Every group from the same source is scraped as one.
+    sources = {}
+    for (source, group) in sorted(published):
+        (when, metrics) = published[(source, group)]
+        if source not in sources:
+            sources[source] = (when, {})
+        sources[source][1].update(metrics)
+        sources[source] = (max(when, sources[source][0]), sources[source][1])
+
+    summaries = _summarize(sources)
+    if format == "prometheus":
+        body = _prometheus(sources, summaries)
+    else:
+        body = _json(sources, summaries)
+
+    with lock:
+        if current == generation:
+            rendered[format] = (current, body)
+    return body
+
+# _summarize(): Helper function that looks up the lowest, average, and
+#   highest value of every published stat over each of the windows.  Takes
+#   one argument, a hash table like snapshots.  Returns a hash table of
+#   (source, stat) tuples to hash tables of window names to summaries from
+#   timeseries.query().
+def _summarize(sources):
+    summaries = {}
+    now = time.time()
+    for source in sources:
+        prefix = ""
+        if source:
+            prefix = source + ":"
+        for metric in sources[source][1]:
+            history = (prefix + metric).lower().replace(" ", "_")
+            found = {}
+            for (name, length) in windows:
+                summary = timeseries.query(history, now - length, now)
+                if summary:
+                    found[name] = summary
+            summaries[(source, metric)] = found
+    return summaries
+
+# _prometheus(): Helper function that writes out stats in Prometheus' text
+#   format.  Every stat is a gauge.  The part of a stat's name before the
+#   colon becomes its name, and the part after it becomes a label.  The
+#   windows are <name>_min, <name>_mean, and <name>_max, with a "window"
+#   label.  Takes two arguments, a hash table like snapshots and the
+#   summaries from _summarize().  Returns a string.
+def _prometheus(sources, summaries):
+    # Gather the samples of each stat together, because Prometheus wants all
+    # of a stat's samples right after its HELP and TYPE lines.
+    families = {}
+    for source in sorted(sources):
+        metrics = sources[source][1]
+        for metric in sorted(metrics):
+            (base, labels) = _split(metric, source)
+            name = namespace + "_" + _sanitize(base)
+            help = descriptions.get(base, base + ".")
+            families.setdefault(name, (help, []))[1].append((labels,
+                metrics[metric]))
+            for window in summaries[(source, metric)]:
+                summary = summaries[(source, metric)][window]
+                for statistic in ("min", "mean", "max"):
+                    family = families.setdefault(name + "_" + statistic,
+                        (help.rstrip(".") + ", " + statistic + " over the window.", []))
+                    family[1].append((labels + [("window", window)],
+                        summary[statistic]))
+
+    lines = []
+    for name in sorted(families):
+        (help, samples) = families[name]
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " gauge")
+        for (labels, value) in samples:
+            lines.append(name + _labels(labels) + " " + _value(value))
+    return "\n".join(lines) + "\n"
+
+# _json(): Helper function that writes out stats as JSON.  Takes two
+#   arguments, a hash table like snapshots and the summaries from
+#   _summarize().  Returns a string.
+def _json(sources, summaries):
+    report = {"timestamp": time.time(), "sources": {}}
+    for source in sources:
+        (published, metrics) = sources[source]
+        entry = {"timestamp": published, "metrics": {}, "windows": {}}
+        for metric in metrics:
+            entry["metrics"][metric] = _finite(metrics[metric])
+            found = summaries[(source, metric)]
+            if not found:
+                continue
+            entry["windows"][metric] = {}
+            for window in found:
+                entry["windows"][metric][window] = {
+                    "min": _finite(found[window]["min"]),
+                    "mean": _finite(found[window]["mean"]),
+                    "max": _finite(found[window]["max"]),
+                    "count": found[window]["count"]}
+        report["sources"][source or "local"] = entry
+    return json.dumps(report, sort_keys=True)
+
+# _split(): Helper function that splits a stat's name into the part before
+#   the colon and labels.  Takes two arguments, the name of the stat and the
+#   name of the OpenWRT device it's from ("" for the system the bot is
+#   running on).  Returns a (name, list of (label, value) tuples) tuple.
+def _split(metric, source):
+    labels = []
+    if source:
+        labels.append(("device", source))
+    if ":" in metric:
+        (base, instance) = metric.split(":", 1)
+        labels.append((label_names.get(base, "name"), instance))
+    else:
+        base = metric
+    return (base, labels)
+
+# _sanitize(): Helper function that turns a string into a valid Prometheus
+#   stat name.
+def _sanitize(name):
+    name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return name
+
+# _labels(): Helper function that writes out a list of (label, value) tuples
+#   the way Prometheus wants them.
+def _labels(labels):
+    if not labels:
+        return ""
+    found = []
+    for (label, value) in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        found.append(label + "=\"" + value + "\"")
+    return "{" + ",".join(found) + "}"
+
+# _value(): Helper function that writes out a number the way Prometheus
+#   wants it.
+def _value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        if value > 0:
+            return "+Inf"
+        return "-Inf"
+    return repr(value)
+
+# _finite(): Helper function that turns numbers JSON can't hold (infinity,
+#   NaN) into None.
+def _finite(value):
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+if "__name__" == "__main__":
+    pass
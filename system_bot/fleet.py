@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# fleet.py - Module that lets one system_bot.py keep an eye on a whole fleet
+#   of hosts.  Every other host runs system_bot.py as an agent, which doesn't
+#   talk to the XMPP bridge, take commands, or decide on alerts; all it does
+#   is collect the same stats the system checks do and push them over HTTP to
+#   the central bot (the aggregator).  The aggregator keeps the latest stats
+#   of every host in memory, adds them to the history and checks them against
+#   the alert rules just like its own (each host with its own windows and
+#   alert states), and answers questions like "load on all hosts" without
+#   asking anybody.
+#
+#   To keep the pushes small, an agent only sends the stats that have changed
+#   since the last push (and the names of any that have gone away).  Every
+#   push has a sequence number, so if the aggregator misses one (or was
+#   restarted, or has never heard of the agent) it says so and the agent
+#   sends everything.  Everything is sent every so often anyway.
+#
+#   Every stat of every host ends up in the history, which isn't small, so
+#   the aggregator only takes so many hosts and so many stats from each, and
+#   forgets hosts that haven't pushed for a day.  It won't listen anywhere
+#   but the loopback interface without a shared key.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Limited the number of hosts and stats per host, checked the names
+#        of stats, forgot hosts that have been gone a day, and refused to
+#        take pushes from the network without a key.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import hmac
+import ipaddress
+import json
+import logging
+import math
+import re
+import requests
+import threading
+import time
+import uuid
+
+# Constants.
+# Path the aggregator takes pushes at, and the header the shared key goes in.
+push_path = "/fleet/push"
+key_header = "X-Fleet-Key"
+
+# Seconds an agent waits for the aggregator to answer a push.
+request_timeout = 10.0
+
+# An agent sends every stat (not just the ones that have changed) once every
+# this many pushes, in case the aggregator has lost track somehow.
+full_push_interval = 60
+
+# Largest push (in bytes), most stats per host, and most hosts the aggregator
+# will take.  A system with a lot of disks, interfaces, and processes has a
+# couple of hundred stats.
+maximum_push = 262144
+maximum_metrics = 500
+maximum_hosts = 100
+
+# Seconds a host can go without pushing before the aggregator forgets about
+# it altogether.
+forget_after = 86400
+
+# Host names and stat names the aggregator will take.  Stats are named
+# kind:instance, and the instance can be nearly anything (a mount point, a
+# process, a sensor with spaces in its name) as long as it's printable.
+host_name_format = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,62}$")
+metric_name_format = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,63}(:[^\x00-\x1f\x7f\"\\{}]{1,150})?$")
+
+# Variables global to this module.
+# Shared key agents have to send with every push.  Empty means no key.
+fleet_key = ""
+
+# Agent side: the URL to push to, the name of this host, the HTTP session
+# pushes are sent over, a random identifier for this run of the agent (so
+# the aggregator can tell when an agent's been restarted), the sequence
+# number of the next push, the stats the aggregator has as far as the agent
+# knows, and whether the next push has to send everything.
+aggregator_url = ""
+host_name = ""
+session = None
+agent_session = ""
+sequence = 0
+sent = {}
+full_push = True
+
+# Aggregator side: hash table of host names to Hosts, the name and latest
+# stats of the system the aggregator is running on, the number of seconds a
+# host can go without pushing before it's considered unreachable (0 means
+# three times however often it pushes), and the web server.
+hosts = {}
+local_name = ""
+local_metrics = {}
+fleet_timeout = 0.0
+server = None
+
+# Protects hosts and local_metrics, which are written by the web server's
+# threads and the system checks and read by the scheduler and the command
+# handler.
+lock = threading.Lock()
+
+# Classes.
+# Host: Class that holds what the aggregator knows about one agent.
+class Host(object):
+
+    # Initialize new instances of the class.  Takes one argument, the name of
+    # the host.
+    def __init__(self, name):
+        self.name = name
+
+        # Which run of the agent this is from, and the sequence number of the
+        # last push.
+        self.session = ""
+        self.sequence = -1
+
+        # Latest stats, when (time.monotonic() and time.time()) the agent
+        # last pushed, and how often it says it pushes.
+        self.metrics = {}
+        self.received = 0.0
+        self.received_at = 0.0
+        self.interval = 60.0
+
+        # True if the agent has pushed since the stats were last checked
+        # against the alert rules.
+        self.pending = False
+
+    # stale(): Returns True if the host hasn't pushed for too long.
+    def stale(self, now):
+        timeout = fleet_timeout or self.interval * 3.0
+        return now - self.received > timeout
+
+# Handler: Class that takes pushes from agents.
+class Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path.split("?")[0] != push_path:
+            self._send(404, {"error": "Push to " + push_path + "."})
+            return
+        if fleet_key and not hmac.compare_digest(self.headers.get(key_header, ""), fleet_key):
+            self._send(403, {"error": "Wrong or missing fleet key."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length <= 0 or length > maximum_push:
+                raise ValueError("push is empty or too large")
+            push = json.loads(self.rfile.read(length).decode("utf-8"))
+            self._send(*receive(push))
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+
+    # Pushes happen every few seconds from every host, so they're only logged
+    # when debugging.
+    def log_message(self, format, *args):
+        logging.debug("Fleet: " + self.address_string() + " - " + (format % args))
+
+    # _send(): Helper method that sends a JSON response.  Takes two
+    #   arguments, the HTTP status code and a hash table to send.
+    def _send(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Functions.
+# loopback(): Returns True if an address only listens on the loopback
+#   interface.  Takes one argument, the address.
+def loopback(address):
+    if address == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+# configure_agent(): Sets up this bot as an agent.  Takes two arguments, the
+#   base URL of the aggregator and the name of this host, and optionally the
+#   shared key.
+def configure_agent(url, name, key=""):
+    global aggregator_url
+    global host_name
+    global fleet_key
+    global session
+    global agent_session
+    global sequence
+    global full_push
+
+    aggregator_url = url.rstrip("/") + push_path
+    host_name = name
+    fleet_key = key
+    session = requests.Session()
+    if key:
+        session.headers[key_header] = key
+    agent_session = uuid.uuid4().hex
+    sequence = 0
+    sent.clear()
+    full_push = True
+    logging.debug("Pushing stats to " + aggregator_url + " as " + host_name + ".")
+
+# push(): Sends the stats that have changed since the last push to the
+#   aggregator.  If the aggregator has lost track, everything is sent again
+#   straight away.  Takes two arguments, a hash table of stats from
+#   system_stats.collect_metrics() and how often (in seconds) they're pushed.
+#   Returns True if the aggregator took them.
+def push(metrics, interval):
+    global sequence
+    global full_push
+
+    metrics = {i: float(metrics[i]) for i in metrics}
+    for attempt in range(2):
+        full = full_push or sequence % full_push_interval == 0
+        changed = metrics
+        removed = []
+        if not full:
+            changed = {i: metrics[i] for i in metrics if sent.get(i) != metrics[i]}
+            removed = [i for i in sent if i not in metrics]
+        body = {"host": host_name, "session": agent_session,
+            "sequence": sequence, "interval": float(interval), "full": full,
+            "changed": changed, "removed": removed}
+
+        try:
+            request = session.post(aggregator_url,
+                data=json.dumps(body, separators=(",", ":")),
+                headers={"Content-Type": "application/json"},
+                timeout=request_timeout)
+        except requests.RequestException as e:
+            logging.warning("Unable to push stats to the aggregator: " + str(e))
+            return False
+
+        if request.status_code == 409:
+            # The aggregator doesn't know where this agent is up to.
+            logging.info("The aggregator asked for all of the stats again.")
+            full_push = True
+            continue
+        if request.status_code != requests.codes.ok:
+            logging.warning("The aggregator returned HTTP error code " + str(request.status_code) + ": " + request.text[:200])
+            return False
+
+        sent.clear()
+        sent.update(metrics)
+        sequence = sequence + 1
+        full_push = False
+        logging.debug("Pushed " + str(len(changed)) + " of " + str(len(metrics)) + " stats to the aggregator.")
+        return True
+    return False
+
+# start(): Starts taking pushes from agents, on a thread of its own.  Takes
+#   three arguments, the address and port to listen on and the name of the
+#   system the aggregator is running on.  Optionally takes the shared key,
+#   how long a host can go without pushing before it's unreachable, and the
+#   most hosts to take pushes from.  Raises ValueError if it's asked to
+#   listen on the network without a key.
+def start(address, port, name, key="", timeout=0.0, hosts_allowed=None):
+    global server
+    global local_name
+    global fleet_key
+    global fleet_timeout
+    global maximum_hosts
+
+    if not key and not loopback(address):
+        raise ValueError("Taking pushes from agents on " + address + " needs a fleet_key.")
+    if hosts_allowed:
+        maximum_hosts = int(hosts_allowed)
+    local_name = name
+    fleet_key = key
+    fleet_timeout = float(timeout)
+    server = ThreadingHTTPServer((address, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fleet",
+        daemon=True).start()
+    logging.info("Taking pushes from agents at http://" + address + ":" + str(port) + push_path)
+
+# receive(): Applies a push from an agent.  Takes one argument, the push (a
+#   hash table).  Returns a tuple of the HTTP status code to answer with and a
+#   hash table to send back.  Raises ValueError if the push doesn't make
+#   sense.
+def receive(push):
+    if not isinstance(push, dict):
+        raise ValueError("a push has to be an object")
+    name = push.get("host")
+    if not isinstance(name, str) or not host_name_format.match(name):
+        raise ValueError("host has to be a name made of letters, numbers, dots, dashes, and underscores")
+    changed = push.get("changed", {})
+    removed = push.get("removed", [])
+    if not isinstance(changed, dict) or not isinstance(removed, list):
+        raise ValueError("changed has to be an object and removed a list")
+    if len(changed) > maximum_metrics or len(removed) > maximum_metrics:
+        raise ValueError("too many stats")
+    if not isinstance(push.get("sequence"), int):
+        raise ValueError("sequence has to be a number")
+    for i in changed:
+        if not metric_name_format.match(i):
+            raise ValueError("stat " + repr(i[:100]) + " doesn't have a usable name")
+        if not isinstance(changed[i], (int, float)) or isinstance(changed[i], bool) or not math.isfinite(changed[i]):
+            raise ValueError("stat " + i + " isn't a number")
+
+    with lock:
+        host = hosts.get(name)
+        full = bool(push.get("full"))
+
+        # A push that only has changes has to follow on from the last one
+        # (or be a retry of it, if the answer to it got lost).
+        if not full and (host is None or host.session != push.get("session") or push.get("sequence") not in (host.sequence, host.sequence + 1)):
+            return (409, {"resync": True})
+
+        # The push is worked out before it's kept, so one that's too big
+        # doesn't leave the host half updated.
+        metrics = {}
+        if host and not full:
+            metrics = dict(host.metrics)
+        metrics.update(changed)
+        for i in removed:
+            metrics.pop(i, None)
+        if len(metrics) > maximum_metrics:
+            raise ValueError("too many stats: the most a host can push is " + str(maximum_metrics))
+
+        if host is None:
+            if len(hosts) >= maximum_hosts:
+                logging.warning("Host " + name + " tried to join the fleet, but there are already " + str(maximum_hosts) + " hosts.")
+                return (403, {"error": "The fleet is full."})
+            host = Host(name)
+            hosts[name] = host
+            logging.info("Host " + name + " has joined the fleet.")
+        host.metrics = metrics
+        host.session = push.get("session")
+        host.sequence = push.get("sequence")
+        host.interval = float(push.get("interval") or host.interval)
+        host.received = time.monotonic()
+        host.received_at = time.time()
+        host.pending = True
+        return (200, {"sequence": host.sequence})
+
+# collect(): Picks out the hosts whose stats need to be checked against the
+#   alert rules: the ones that have pushed since the last time, along with
+#   "reachable" (1.0), and the ones that haven't pushed for too long, with
+#   nothing but "reachable" (0.0).  Hosts that are up to date but haven't
+#   pushed anything new are left out, so nothing is counted twice.  Hosts
+#   that haven't pushed for forget_after seconds are forgotten.  Takes no
+#   arguments.  Returns a list of (host name, hash table of stats) tuples.
+def collect():
+    found = []
+    now = time.monotonic()
+    with lock:
+        for name in sorted(hosts):
+            host = hosts[name]
+            if now - host.received > forget_after:
+                logging.info("Forgetting about host " + name + ", which hasn't reported in for a day.")
+                del hosts[name]
+                continue
+            if host.stale(now):
+                found.append((name, {"reachable": 0.0}))
+            elif host.pending:
+                metrics = dict(host.metrics)
+                metrics["reachable"] = 1.0
+                found.append((name, metrics))
+            host.pending = False
+    return found
+
+# set_local(): Remembers the latest stats of the system the aggregator is
+#   running on, so they can be compared with the rest of the fleet.  Takes
+#   one argument, a hash table of stats.
+def set_local(metrics):
+    global local_metrics
+    with lock:
+        local_metrics = dict(metrics)
+
+# report(): Looks up a stat on every host.  Takes one argument, the start of
+#   the names of the stats to look up ("load" covers load, load5, and
+#   load15; "disk" covers every disk), or None for a summary of every host.
+#   Returns a list of (host name, seconds since it last pushed or None for
+#   the aggregator itself, whether it's unreachable, hash table of matching
+#   stats) tuples, with the aggregator first.
+def report(prefix=None):
+    found = []
+    now = time.monotonic()
+    def matching(metrics):
+        if prefix is None:
+            return {i: metrics[i] for i in ("load", "cpu_idle", "memory_free") if i in metrics}
+        return {i: metrics[i] for i in metrics if i.lower().startswith(prefix.lower())}
+
+    with lock:
+        if local_name:
+            found.append((local_name, None, False, matching(local_metrics)))
+        for name in sorted(hosts):
+            host = hosts[name]
+            found.append((name, now - host.received, host.stale(now),
+                matching(host.metrics)))
+    return found
+
+if "__name__" == "__main__":
+    pass
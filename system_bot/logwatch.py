@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# logwatch.py - Module that watches log files for system_bot.py, the way
+#   `tail -F` does, and picks out lines that match log rules (the OOM killer
+#   at work, disk errors, segfaults...).  Each file is read from where the
+#   last read left off, and rotated or truncated files are noticed and
+#   started over.  On Linux, inotify says which files have changed so the
+#   rest aren't even looked at; elsewhere (or if inotify can't be set up)
+#   every file is checked for new lines each time.
+#
+#   Every line is matched against one combined regular expression made of
+#   all the rules for that file, so a line that doesn't match anything (most
+#   of them) costs one search no matter how many rules there are.  Only
+#   lines that do match are tried against the rules one at a time to see
+#   which ones they were.  Patterns that refer to their own groups by number
+#   (\1) can't be combined, since the numbers would be off, so those rules
+#   are tried on every line.  The number of matches for each rule is turned
+#   into a metric ("log_matches:<rule>") which an alert rule watches, so log
+#   rules have the same cooldowns as the rest of the alerts.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Rules whose patterns refer to groups by number aren't combined
+#        with the others, so they still match what they should.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import ctypes
+import ctypes.util
+import glob
+import logging
+import os
+import re
+import struct
+import time
+
+# Constants.
+# inotify flags: don't block, close on exec, and the events that mean a file
+# in a watched directory has new lines, has been rotated, or has appeared.
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+watch_mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Layout of the fixed part of an inotify event: watch descriptor, mask,
+# cookie, and length of the name that follows.
+inotify_event = struct.Struct("iIII")
+
+# Most bytes to read from one file per check, so a log that's exploding
+# doesn't hold everything else up.  Whatever's left is read next time.
+maximum_read = 1048576
+
+# Seconds between looking at every file whether or not inotify said they'd
+# changed, and looking for new files that match the configured globs.
+rescan_interval = 60.0
+
+# Longest line (in characters) that's put into an alert.
+maximum_line = 300
+
+# Variables global to this module.
+# Log rules (LogRule), in the order they were configured.
+rules = []
+
+# Hash table of paths to the LogFiles being watched.
+files = {}
+
+# Handle to the inotify watcher, or None if every file is checked every time.
+watcher = None
+
+# When (time.monotonic()) every file was last looked at.
+last_rescan = 0.0
+
+# Classes.
+# LogRule: Class that holds one log rule.
+class LogRule(object):
+
+    # Initialize new instances of the class.  Takes three arguments, the name
+    # of the rule, the files it applies to (a list or comma separated string
+    # of paths, which can be shell-style globs), and the regular expression
+    # lines have to match.  Optionally takes whether or not case matters.
+    def __init__(self, name, paths, pattern, ignore_case=False):
+        self.name = name
+        if isinstance(paths, str):
+            paths = paths.split(",")
+        self.paths = [i.strip() for i in paths if i.strip()]
+        if isinstance(ignore_case, str):
+            ignore_case = ignore_case.strip().lower() in ["yes", "true", "on", "1"]
+        self.ignore_case = ignore_case
+        self.pattern = pattern
+        try:
+            self.regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            raise ValueError("Log rule " + name + " has a bad pattern: " + str(e))
+
+# LogFile: Class that keeps track of how much of one log file has been read.
+class LogFile(object):
+
+    # Initialize new instances of the class.  Takes two arguments, the path
+    # to the file and the rules that apply to it.  Optionally takes whether
+    # to start at the beginning of the file instead of the end (for files
+    # that turn up after the bot started, whose lines are all new).
+    def __init__(self, path, file_rules, from_start=False):
+        self.path = path
+        self.rules = file_rules
+        self.file = None
+        self.inode = None
+        self.partial = b""
+
+        # True if there was more to read than maximum_read last time, so it
+        # has to be read again whether or not inotify says it's changed.
+        self.behind = False
+
+        # Lines that don't match this are only tried against the rules that
+        # couldn't go into it.  If the patterns can't be combined at all
+        # (they use flags that have to come first, say) every rule is tried
+        # on every line instead.
+        self.combined = None
+        self.uncombined = [i for i in file_rules
+            if _numbered_references(i.pattern)]
+        combinable = [i for i in file_rules if i not in self.uncombined]
+        try:
+            if combinable:
+                self.combined = re.compile("|".join(("(?i:" if i.ignore_case
+                    else "(?:") + i.pattern + ")" for i in combinable))
+        except re.error:
+            self.uncombined = file_rules
+        self._open(from_start)
+
+    # read(): Reads whatever's been added to the file since the last time,
+    #   starting over if the file's been rotated or truncated.  Returns a list
+    #   of (rule, line) tuples, one for every rule every new line matched.
+    def read(self):
+        found = []
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            status = None
+
+        # Rotated: finish the old file, then start on the new one from the
+        # beginning.
+        if self.file and status and status.st_ino != self.inode:
+            found = self._match(self._read_lines())
+            self._close()
+            self._open(True)
+        elif not self.file and status:
+            self._open(True)
+
+        if not self.file:
+            return found
+
+        # Truncated (copytruncate rotation): start from the beginning.
+        if status and status.st_size < self.file.tell():
+            logging.debug("Log file " + self.path + " was truncated.")
+            self.file.seek(0)
+            self.partial = b""
+        return found + self._match(self._read_lines())
+
+    # _open(): Opens the file, at the end unless told to start at the
+    #   beginning.
+    def _open(self, from_start=False):
+        try:
+            self.file = open(self.path, "rb")
+            self.inode = os.fstat(self.file.fileno()).st_ino
+            if not from_start:
+                self.file.seek(0, os.SEEK_END)
+        except OSError as e:
+            logging.debug("Unable to open log file " + self.path + ": " + str(e))
+            self.file = None
+            self.inode = None
+        self.partial = b""
+
+    # _close(): Closes the file.
+    def _close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.inode = None
+
+    # _read_lines(): Reads up to maximum_read bytes of new lines.  A line
+    #   that hasn't been finished yet is held on to until it has.
+    def _read_lines(self):
+        data = self.file.read(maximum_read)
+        self.behind = len(data) == maximum_read
+        if not data:
+            return []
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return lines
+
+    # _match(): Picks out the lines that match any of the rules.  Takes a
+    #   list of lines (bytes).  Returns a list of (rule, line) tuples.
+    def _match(self, lines):
+        found = []
+        for line in lines:
+            line = line.decode("utf-8", "replace").rstrip("\r")
+            candidates = self.rules
+            if self.combined and not self.combined.search(line):
+                candidates = self.uncombined
+            for rule in candidates:
+                if rule.regex.search(line):
+                    found.append((rule, line))
+        return found
+
+# Inotify: Class that asks the kernel to say when files in some directories
+#   change, via the C library since the standard library can't.
+class Inotify(object):
+
+    # Initialize new instances of the class.  Raises OSError if inotify isn't
+    # available.
+    def __init__(self):
+        library = ctypes.util.find_library("c")
+        if not library:
+            raise OSError("There's no C library to get inotify from.")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("This system doesn't have inotify.")
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Unable to start inotify.")
+        self.directories = {}
+
+    # watch(): Watches a directory.  Takes one argument, the path.
+    def watch(self, directory):
+        if directory in self.directories.values():
+            return
+        descriptor = self.libc.inotify_add_watch(self.fd,
+            os.fsencode(directory), watch_mask)
+        if descriptor < 0:
+            raise OSError(ctypes.get_errno(), "Unable to watch " + directory)
+        self.directories[descriptor] = directory
+
+    # changes(): Returns the paths of the files that have changed since the
+    #   last time, or None if so much changed that the kernel lost track.
+    def changes(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            if not data:
+                return changed
+            offset = 0
+            while offset + inotify_event.size <= len(data):
+                (descriptor, mask, cookie, length) = inotify_event.unpack_from(data, offset)
+                offset = offset + inotify_event.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset = offset + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if descriptor in self.directories and name:
+                    changed.add(os.path.join(self.directories[descriptor],
+                        os.fsdecode(name)))
+
+# Functions.
+# configure(): Sets up the log rules and starts watching the files they apply
+#   to.  Takes one argument, a list of LogRules.
+def configure(rule_list):
+    global rules
+    global watcher
+    global last_rescan
+
+    rules = list(rule_list)
+    for i in files.values():
+        i._close()
+    files.clear()
+    watcher = None
+    if not rules:
+        return
+
+    try:
+        watcher = Inotify()
+    except (OSError, AttributeError) as e:
+        logging.info("Unable to use inotify (" + str(e) + "), so every log file will be checked every time.")
+        watcher = None
+    _scan(False)
+    last_rescan = time.monotonic()
+    logging.debug("Watching " + str(len(files)) + " log files for " + str(len(rules)) + " log rules.")
+
+# check(): Reads whatever's been added to the log files.  Takes no arguments.
+#   Returns a hash table of metrics ("log_matches:<rule>", the number of new
+#   lines that matched each rule, which can be zero) and a hash table of
+#   metrics to the fields alert messages about them can use ("line", the
+#   most recent line that matched, and "file", the file it was in).
+def check():
+    global last_rescan
+
+    metrics = {}
+    context = {}
+    for rule in rules:
+        metrics["log_matches:" + rule.name] = 0
+    if not rules:
+        return (metrics, context)
+
+    # Every so often look at every file and look for new ones, in case
+    # inotify missed something.  Otherwise, only look at the files inotify
+    # says have changed.
+    now = time.monotonic()
+    changed = None
+    if watcher and now - last_rescan < rescan_interval:
+        changed = watcher.changes()
+    if changed is None:
+        _scan(True)
+        last_rescan = now
+        to_read = list(files.values())
+    else:
+        to_read = [files[i] for i in files if i in changed or files[i].behind]
+
+    for log_file in to_read:
+        try:
+            found = log_file.read()
+        except OSError as e:
+            logging.warning("Unable to read log file " + log_file.path + ": " + str(e))
+            continue
+        for (rule, line) in found:
+            metric = "log_matches:" + rule.name
+            metrics[metric] = metrics[metric] + 1
+            context[metric] = {"line": line[0:maximum_line],
+                "file": log_file.path}
+    return (metrics, context)
+
+# _numbered_references(): Helper function that returns True if a pattern
+#   refers to one of its groups by number (\1, or (?(1)...)), which would be
+#   a different group once it's combined with other patterns.
+def _numbered_references(pattern):
+    return re.search(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d", pattern) is not None
+
+# _scan(): Helper function that finds the files the rules apply to and starts
+#   watching any it isn't watching already.  Takes one argument, whether
+#   files that turn up now are new (and so should be read from the
+#   beginning).
+def _scan(new_files):
+    paths = {}
+    for rule in rules:
+        for pattern in rule.paths:
+            matched = glob.glob(pattern)
+            if not matched and not glob.has_magic(pattern):
+                # Doesn't exist yet, but might later.
+                matched = [pattern]
+            for path in matched:
+                paths.setdefault(os.path.abspath(path), []).append(rule)
+
+    for path in paths:
+        if path in files:
+            continue
+        files[path] = LogFile(path, paths[path], new_files)
+        if watcher:
+            try:
+                watcher.watch(os.path.dirname(path))
+            except OSError as e:
+                logging.warning("Unable to watch " + path + " with inotify: " + str(e))
+
+if "__name__" == "__main__":
+    pass
@@ -13,6 +13,18 @@
 
 # License: GPLv3
 
+# v1.7 - Per-device timeouts apply to device URLs with a path or a trailing
+#       slash.
+# v1.6 - Fixed network_traffic() for devices with interfaces that are down.
+# v1.5 - Devices no longer keep their own alert counters and windows of
+#       system load averages, the alert rules in alerts.py do.
+# v1.4 - Any number of OpenWRT devices can be monitored at the same time.
+#       Each one is a Device, and they're polled in parallel by a pool of
+#       worker threads, each with its own timeout.
+# v1.3 - All requests to OpenWRT devices go through get(), which reuses
+#       connections, gives up after a timeout, and caches each response for a
+#       short time so that one run of the main loop fetches each endpoint at
+#       most once.
 # v1.2 - Added local time and date support.
 # v1.1 - Added CPU counting support.
 #      - Added CPU idle time support.
@@ -30,17 +42,111 @@ import json
 import logging
 import math
 import requests
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 # Variables global to this module.
-# Running lists of system averages.
-one_minute_average = []
-five_minute_average = []
-fifteen_minute_average = []
+# Number of seconds to wait for an OpenWRT device to answer.
+timeout = 5
+
+# Number of seconds a response from an OpenWRT device is reused for.  This
+# should be shorter than the time between runs of the main loop, so that each
+# run fetches every endpoint at most once.
+cache_ttl = 5
+
+# Hash table of URLs to (time fetched, response) tuples.  Failed requests are
+# cached too, so that a device which is down only costs one timeout per
+# endpoint per run of the main loop.
+cache = {}
+
+# Hash table of base URLs to HTTP sessions, so that connections to each
+# device are kept alive.
+sessions = {}
+
+# Hash table of base URLs (from _base_url()) to the number of seconds to wait for that device,
+# for devices that don't use the default.
+timeouts = {}
+
+# Protects the cache and the sessions.
+lock = threading.Lock()
+
+# Pool of worker threads that poll devices in parallel, and the most devices
+# it'll poll at once.
+pool = None
+maximum_workers = 16
+
+# Classes.
+# Device: Class that holds everything Systembot keeps track of for one
+#   OpenWRT device: its name and its base URL.  What the alert rules know
+#   about it is kept by alerts.py under its name.
+class Device(object):
+
+    # Initialize new instances of the class.  Takes three arguments, the name
+    # of the device, its base URL, and the number of seconds to wait for it
+    # (which can be None for the default).
+    def __init__(self, name, url, request_timeout=None):
+        self.name = name
+        self.url = url
+        if request_timeout:
+            with lock:
+                timeouts[_base_url(url)] = float(request_timeout)
 
 # Functions.
+# configure(): Sets how long to wait for OpenWRT devices and how long to reuse
+#   their responses for.  Takes two arguments, both in seconds.
+def configure(request_timeout, ttl):
+    global timeout
+    global cache_ttl
+
+    timeout = float(request_timeout)
+    cache_ttl = float(ttl)
+
+# get(): Function that fetches a URL from an OpenWRT device over a kept-alive
+#   connection, or returns the response from the last time if it was fetched
+#   less than cache_ttl seconds ago.  Takes one argument, the URL.  Returns a
+#   Requests response object, or None if the device couldn't be reached.
+def get(url):
+    now = time.monotonic()
+    with lock:
+        if url in cache and now - cache[url][0] < cache_ttl:
+            return cache[url][1]
+
+        base_url = _base_url(url)
+        if base_url not in sessions:
+            sessions[base_url] = requests.Session()
+        session = sessions[base_url]
+        request_timeout = timeouts.get(base_url, timeout)
+
+    try:
+        request = session.get(url, timeout=request_timeout)
+    except Exception as e:
+        logging.warning("Unable to contact " + url + ": " + str(e))
+        request = None
+
+    with lock:
+        cache[url] = (time.monotonic(), request)
+    return request
+
+# _base_url(): Helper function that returns the scheme, host, and port of a
+#   URL, which sessions and timeouts are kept by.
+def _base_url(url):
+    return "/".join(url.split("/")[0:3])
+
+# map_devices(): Function that calls a function once for every device, in
+#   parallel, and waits for all of them to finish.  Takes two arguments, the
+#   function (which takes a Device) and a list of Devices.  Returns a list of
+#   what the function returned, in the same order as the devices.
+def map_devices(function, devices):
+    global pool
+
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=maximum_workers,
+            thread_name_prefix="openwrt")
+    return list(pool.map(function, devices))
+
 # sysload(): Function that takes a snapshot of the current system load
 #   averages.  Takes one argument, the base URL to the OpenWRT node.
 #   Returns system loads as a hash table.
@@ -52,9 +158,9 @@ def sysload(openwrt_host):
     sysload = {}
 
     #  Contact the OpenWRT host and get system info.
-    request = requests.get(openwrt_host + "/cgi-bin/system/info")
+    request = get(openwrt_host + "/cgi-bin/system/info")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
         sysload["one_minute"] = -1.0
         sysload["five_minute"] = -1.0
         sysload["fifteen_minute"] = -1.0
@@ -84,9 +190,9 @@ def uname(openwrt_host):
     system_info = {}
 
     #  Contact the OpenWRT host and get system info.
-    request = requests.get(openwrt_host + "/cgi-bin/system/board")
+    request = get(openwrt_host + "/cgi-bin/system/board")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/board")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/board")
         system_info["hostname"] = "ERROR - unknown"
         system_info["version"] = "ERROR - unknown"
         system_info["buildinfo"] = "ERROR - unknown"
@@ -107,9 +213,9 @@ def cpu_count(openwrt_host):
     logging.debug("Entered function openwrt.cpus().")
     request = None
 
-    request = requests.get(openwrt_host + "/cgi-bin/system/cpu")
+    request = get(openwrt_host + "/cgi-bin/system/cpu")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/cpu")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/cpu")
         return 0
     return int(request.text)
 
@@ -119,9 +225,9 @@ def cpu_idle_time(openwrt_host):
     logging.debug("Entered function openwrt.cpu_idle_time().")
     request = None
 
-    request = requests.get(openwrt_host + "/cgi-bin/system/cpu_idle")
+    request = get(openwrt_host + "/cgi-bin/system/cpu_idle")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/cpu_idle")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/cpu_idle")
         return 0.0
     return float(request.text)
 
@@ -144,9 +250,9 @@ def get_disk_usage(openwrt_host):
     disk_used = {}
 
     # Get the disk usage stats from the OpenWRT device.
-    request = requests.get(openwrt_host + "/cgi-bin/system/storage")
+    request = get(openwrt_host + "/cgi-bin/system/storage")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/storage")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/storage")
         disk_used["/"] = "unsupported"
         return disk_used
     raw_storage_stats = request.text
@@ -181,9 +287,9 @@ def memory_utilization(openwrt_host):
     memory_stats = {}
 
     #  Contact the OpenWRT host and get system info.
-    request = requests.get(openwrt_host + "/cgi-bin/system/info")
+    request = get(openwrt_host + "/cgi-bin/system/info")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
         memory_stats["free"] = "ERROR - unknown"
         memory_stats["buffers"] = "ERROR - unknown"
         memory_stats["cached"] = "ERROR - unknown"
@@ -204,9 +310,9 @@ def uptime(openwrt_host):
     uptime_seconds = {}
 
     #  Contact the OpenWRT host and get system info.
-    request = requests.get(openwrt_host + "/cgi-bin/system/info")
+    request = get(openwrt_host + "/cgi-bin/system/info")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
         return None
     uptime_seconds = json.loads(request.text)
     uptime_seconds = uptime_seconds["uptime"]
@@ -223,9 +329,9 @@ def get_logical_interfaces(openwrt_host):
     nics = []
 
     #  Contact the OpenWRT host and dump the logical network interfaces
-    request = requests.get(openwrt_host + "/cgi-bin/network/interface?dump")
+    request = get(openwrt_host + "/cgi-bin/network/interface?dump")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/interface?dump")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/interface?dump")
         return None
     interfaces = json.loads(request.text)
 
@@ -258,9 +364,9 @@ def local_ip_address(openwrt_host):
     # Iterate through the list of network interfaces.
     for nic in nics:
         #  Contact the OpenWRT host and poll the interface.
-        request = requests.get(openwrt_host + "/cgi-bin/network/interface?" + nic)
+        request = get(openwrt_host + "/cgi-bin/network/interface?" + nic)
         if not request:
-            logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/interface?" + nic)
+            logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/interface?" + nic)
             continue
         primary_nic = json.loads(request.text)
 
@@ -323,9 +429,9 @@ def network_traffic(openwrt_host):
     stats = {}
 
     # Get the list of physical NICs on the OpenWRT host.
-    request = requests.get(openwrt_host + "/cgi-bin/network/device")
+    request = get(openwrt_host + "/cgi-bin/network/device")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/device")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/network/device")
         return None
     nics = json.loads(request.text)
     del nics["lo"]
@@ -338,7 +444,7 @@ def network_traffic(openwrt_host):
 
     # For every online interface, convert rx_bytes and tx_bytes into
     # human-readable strings.
-    for i in list(nics.keys()):
+    for i in list(stats.keys()):
         stats[i]["sent"] = convert_bytes(nics[i]["statistics"]["tx_bytes"])
         stats[i]["received"] = convert_bytes(nics[i]["statistics"]["rx_bytes"])
         logging.debug("Traffic volume to date for " + i + ": " + str(stats[i]))
@@ -357,9 +463,9 @@ def local_datetime(openwrt_host):
     system_time = ""
 
     #  Contact the OpenWRT host and get system info.
-    request = requests.get(openwrt_host + "/cgi-bin/system/info")
+    request = get(openwrt_host + "/cgi-bin/system/info")
     if not request:
-        logging.err("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
+        logging.error("Failed to contact endpoint " + openwrt_host + "/cgi-bin/system/info")
         return None
 
     # Convert the current system time into a time struct.
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# outbox.py - Module that implements an on-disk outbox for messages a bot
+#   sends to the XMPP bridge.  Messages are appended to the outbox first and
+#   then sent, oldest first, in batches.  If the XMPP bridge can't be reached
+#   the messages stay in the outbox (which survives the bot being restarted)
+#   and the bot tries again later, backing off a little more every time.
+#   Every message carries a unique message ID so that the XMPP bridge can
+#   throw away duplicates if a batch gets sent twice.
+#
+#   XMPP bridges older than v5.3 of rest.py can't take more than one message
+#   at a time, so messages are sent one at a time until the XMPP bridge says
+#   it takes lists.  If the XMPP bridge turns a batch down, the messages in it
+#   are sent one at a time so only the bad ones are thrown away.
+#
+#   To use it in another bot, copy this file into the bot's directory.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Only messages the XMPP bridge rejected are thrown away, not the
+#        whole batch they were in.  Batches are only sent to XMPP bridges
+#        that say they take them.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import json
+import logging
+import os
+import requests
+import threading
+import time
+import uuid
+
+from collections import deque
+
+# Constants.
+# Headers the XMPP bridge looks for for the message to be valid.
+headers = {"Content-type": "application/json"}
+
+# Variables global to this module.
+# URL of the XMPP bridge's /replies rail.
+replies_url = ""
+
+# Path to the file the outbox is kept in.  If empty, the outbox is only kept
+# in memory.
+outbox_file = ""
+
+# Maximum number of messages the outbox will hold.  If the XMPP bridge is
+# gone for a long time the oldest messages are thrown away first.
+maximum_size = 1000
+
+# Maximum number of messages sent to the XMPP bridge at a time.
+batch_size = 20
+
+# Number of seconds to wait for the XMPP bridge to answer.
+timeout = 10
+
+# Shortest and longest number of seconds to wait before trying to reach the
+# XMPP bridge again.
+minimum_backoff = 1
+maximum_backoff = 300
+
+# Whether the XMPP bridge has said it takes lists of messages.  Until it
+# has, messages are sent one at a time.
+batches = False
+
+# Messages waiting to be sent, oldest first.
+messages = deque()
+
+# When the next attempt to reach the XMPP bridge may be made, and how long to
+# back off if it fails.
+next_attempt = 0.0
+backoff = 0
+
+# Messages can be sent from more than one thread.  The lock protects the
+# outbox itself and is never held while talking to the XMPP bridge, so adding
+# a message never has to wait on the network.  Only one thread flushes the
+# outbox at a time.
+lock = threading.Lock()
+flush_lock = threading.Lock()
+
+# Functions.
+# configure(): Sets up the outbox and loads any messages left over from the
+#   last time the bot ran.  Takes three arguments, the base URL of the XMPP
+#   bridge, the path to the outbox file (which can be empty), and the maximum
+#   number of messages to hold.
+def configure(server, path, size):
+    global replies_url
+    global outbox_file
+    global maximum_size
+
+    replies_url = server + "replies"
+    outbox_file = path
+    maximum_size = int(size)
+
+    if not outbox_file or not os.path.exists(outbox_file):
+        return
+
+    with lock:
+        try:
+            with open(outbox_file, "r") as file:
+                for line in file:
+                    line = line.strip()
+                    if line:
+                        messages.append(json.loads(line))
+        except Exception as e:
+            logging.warning("Unable to load outbox " + outbox_file + ": " +
+                str(e))
+        _trim()
+        logging.info("Loaded " + str(len(messages)) + " unsent messages from outbox " + outbox_file + ".")
+
+# append(): Adds a message to the outbox.  Takes one argument, a hash table
+#   containing the reply (the same one that would've been PUT to /replies).
+def append(reply):
+    reply["message_id"] = uuid.uuid4().hex
+    with lock:
+        messages.append(reply)
+        if _trim():
+            _save()
+        elif outbox_file:
+            try:
+                with open(outbox_file, "a") as file:
+                    file.write(json.dumps(reply) + "\n")
+            except Exception as e:
+                logging.warning("Unable to write to outbox " + outbox_file +
+                    ": " + str(e))
+
+# flush(): Sends as many messages as it can to the XMPP bridge, oldest first,
+#   in batches.  Stops at the first batch that fails and backs off.  Takes no
+#   arguments.  Returns True if the outbox is empty afterward, False if not.
+def flush():
+    global next_attempt
+    global backoff
+    global batches
+
+    # If another thread is already flushing the outbox, let it.
+    if not flush_lock.acquire(blocking=False):
+        return False
+
+    try:
+        sent = 0
+        size = batch_size
+        while True:
+            with lock:
+                if not messages:
+                    break
+                if time.time() < next_attempt:
+                    break
+                if not batches:
+                    size = 1
+                batch = [messages[i] for i in
+                    range(min(size, len(messages)))]
+
+            # One message goes by itself, which every XMPP bridge takes.
+            body = batch
+            if len(batch) == 1:
+                body = batch[0]
+            try:
+                request = requests.put(replies_url, headers=headers,
+                    data=json.dumps(body), timeout=timeout)
+            except Exception as e:
+                logging.debug("Unable to reach the XMPP bridge: " + str(e))
+                request = None
+
+            # The XMPP bridge is down or broken.  Try again later.
+            if request is None or request.status_code >= 500:
+                backoff = min(max(backoff * 2, minimum_backoff),
+                    maximum_backoff)
+                next_attempt = time.time() + backoff
+                logging.warning("Unable to send messages to the XMPP bridge.  " + str(pending()) + " messages waiting in the outbox.  Trying again in " + str(backoff) + " seconds.")
+                break
+
+            # The XMPP bridge didn't like the batch.  Go through it one
+            # message at a time to find the ones it won't take.
+            if request.status_code != 200 and len(batch) > 1:
+                logging.warning("The XMPP bridge rejected a batch of " + str(len(batch)) + " messages with HTTP status " + str(request.status_code) + ".  Sending them one at a time.")
+                size = 1
+                continue
+
+            # A message the XMPP bridge didn't like never will be, so don't
+            # let it block everything behind it.
+            if request.status_code != 200:
+                logging.error("The XMPP bridge rejected a message with HTTP status " + str(request.status_code) + ".  Discarding it: " + json.dumps(batch[0]))
+            else:
+                answer = _answer(request)
+                if answer.get("batches") and not batches:
+                    logging.debug("The XMPP bridge takes batches of messages.")
+                    batches = True
+                for rejected in answer.get("rejected", []):
+                    try:
+                        message = batch[rejected["index"]]
+                    except (KeyError, IndexError, TypeError):
+                        continue
+                    logging.error("The XMPP bridge rejected a message (" + str(rejected.get("error")) + ").  Discarding it: " + json.dumps(message))
+
+            # Take the batch out of the outbox.  Messages might have been
+            # trimmed while the batch was in flight, so go by message ID.
+            batch_ids = set(message["message_id"] for message in batch)
+            with lock:
+                while messages and messages[0]["message_id"] in batch_ids:
+                    messages.popleft()
+            sent = sent + len(batch)
+            backoff = 0
+            next_attempt = 0.0
+
+        if sent:
+            logging.debug("Sent " + str(sent) + " messages from the outbox.")
+            with lock:
+                _save()
+        return pending() == 0
+    finally:
+        flush_lock.release()
+
+# _answer(): Helper function that returns what the XMPP bridge answered a
+#   PUT with, as a hash table.  Older XMPP bridges don't answer with
+#   anything, so that's an empty hash table.
+def _answer(request):
+    try:
+        answer = request.json()
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    return answer
+
+# pending(): Returns the number of messages waiting in the outbox.
+def pending():
+    with lock:
+        return len(messages)
+
+# _trim(): Helper function that throws away the oldest messages if there are
+#   too many in the outbox.  Returns True if any were thrown away.
+def _trim():
+    dropped = 0
+    while len(messages) > maximum_size:
+        messages.popleft()
+        dropped = dropped + 1
+    if dropped:
+        logging.warning("Outbox is full.  Discarded the " + str(dropped) + " oldest messages.")
+    return dropped > 0
+
+# _save(): Helper function that rewrites the outbox file with the messages
+#   still waiting to be sent.  The file is replaced in one go so that a crash
+#   can't leave half an outbox behind.
+def _save():
+    if not outbox_file:
+        return
+    try:
+        with open(outbox_file + ".tmp", "w") as file:
+            for message in messages:
+                file.write(json.dumps(message) + "\n")
+        os.replace(outbox_file + ".tmp", outbox_file)
+    except Exception as e:
+        logging.warning("Unable to write to outbox " + outbox_file + ": " +
+            str(e))
+
+if "__name__" == "__main__":
+    pass
@@ -10,6 +10,20 @@
 
 # License: GPLv3
 
+# v3.10 - Added commands to ask about a stat on every host in the fleet.
+# v3.9 - Added a command to ask whether the services being probed are
+#       answering.
+# v3.8 - Added a command to ask what the monitored cgroups are using.
+# v3.7 - Added a command to ask about the resources a monitored process is
+#       using.
+# v3.6 - Added a command to ask what the disks are doing.
+# v3.5 - Added commands to ask for the history of a stat over a span of time
+#   or at a particular time.
+# v3.4 - Added a command to get the bot's own per-command statistics.
+# v3.3 - All of the grammars are compiled into a dispatcher once when the
+#   module is loaded.  Only the grammars that can start with the first word of
+#   a command are tried.
+#      - Fixed "local datetime," which was being parsed as "load datetime."
 # v3.2 - Added local date and time to the command structure.
 # v3.1 - Added the ability to understand requests for the top processes (in
 #   terms of CPU time at the moment) running on the system.
@@ -30,6 +44,10 @@
 # Load modules.
 import logging
 import pyparsing as pp
+import time
+
+import dispatcher
+import timeseries
 
 # Parser primitives.
 # We define them up here because they'll be re-used over and over.
@@ -94,6 +112,14 @@ network_traffic_stats_command = pp.Or([network_traffic_command,
     traffic_volume_command, network_stats_command, traffic_stats_command,
     traffic_count_command])
 
+io_command = pp.oneOf("io i/o", caseless=True)
+iostat_command = pp.CaselessLiteral("iostat")
+inodes_command = pp.CaselessLiteral("inodes")
+disk_io_command = disk_command + io_command
+io_stats_command = io_command + stats_command
+disk_io_commands = pp.Or([disk_io_command, io_stats_command, iostat_command,
+    io_command, inodes_command]) + pp.StringEnd()
+
 system_command = pp.CaselessLiteral("system")
 core_command = pp.CaselessLiteral("core")
 temperature_command = pp.CaselessLiteral("temperature")
@@ -118,17 +144,113 @@ busiest_processes_command = busiest_command + processes_command
 top_processes_commands = pp.Or([top_processes_command, busy_processes_command,
     busiest_processes_command])
 
+process_command = pp.CaselessLiteral("process")
+process_stats_commands = process_command + pp.oneOf("stats resources",
+    caseless=True) + pp.Optional(pp.restOfLine("name"))
+
+services_command = pp.oneOf("services probes", caseless=True)
+service_status_command = pp.CaselessLiteral("service") + \
+    pp.CaselessLiteral("status")
+services_commands = pp.Or([services_command, service_status_command]) + \
+    pp.StringEnd()
+
+cgroups_command = pp.oneOf("cgroups cgroup containers container",
+    caseless=True)
+cgroup_stats_commands = cgroups_command + pp.Optional(pp.oneOf("stats usage",
+    caseless=True)) + pp.StringEnd()
+
 date_command = pp.CaselessLiteral("date")
 time_command = pp.CaselessLiteral("time")
 datetime_command = pp.CaselessLiteral("datetime")
 local_command = pp.CaselessLiteral("local")
 local_date_command = local_command + date_command
 local_time_command = local_command + time_command
-local_datetime_command = load_command + datetime_command
+local_datetime_command = local_command + datetime_command
 
 local_datetime_commands = pp.Or([date_command, time_command, datetime_command,
     local_date_command, local_time_command, local_datetime_command])
 
+command_command = pp.CaselessLiteral("command")
+bot_command = pp.CaselessLiteral("bot")
+command_stats_command = command_command + stats_command
+bot_stats_command = bot_command + stats_command
+bot_stats_commands = pp.Or([stats_command, command_stats_command,
+    bot_stats_command])
+
+history_command = pp.CaselessLiteral("history")
+metric_name = pp.Word(pp.printables)
+amount = pp.Word(pp.nums)
+time_unit = pp.oneOf("minute minutes hour hours day days", caseless=True)
+last_span = pp.Optional(pp.CaselessLiteral("over")) + \
+    pp.Optional(pp.CaselessLiteral("the")) + \
+    pp.Optional(pp.CaselessLiteral("last")) + amount("amount") + \
+    time_unit("unit")
+time_of_day = pp.Group(pp.Word(pp.nums)("hour") +
+    pp.Optional(pp.Suppress(":") + pp.Word(pp.nums)("minute")) +
+    pp.Optional(pp.oneOf("am pm", caseless=True)("meridian")))
+from_span = pp.CaselessLiteral("from") + time_of_day("start") + \
+    pp.CaselessLiteral("to") + time_of_day("end")
+at_time = pp.CaselessLiteral("at") + time_of_day("at")
+history_commands = history_command + pp.Optional(metric_name("metric") +
+    pp.Optional(from_span | at_time | last_span)) + pp.StringEnd()
+
+on_all_hosts = pp.CaselessLiteral("on") + pp.oneOf("all every",
+    caseless=True) + pp.oneOf("hosts host machines servers systems",
+    caseless=True)
+fleet_stat_commands = metric_name("metric") + on_all_hosts + pp.StringEnd()
+fleet_commands = pp.oneOf("fleet hosts", caseless=True) + \
+    pp.Optional(metric_name("metric")) + pp.StringEnd()
+
+# Stats that can be asked about with "<stat> on all hosts".  Those commands
+# are tried before anything else that starts with the same word, because
+# "load" would match "load on all hosts" otherwise.
+fleet_stats = ["load", "load5", "load15", "cpu", "cpu_idle", "memory",
+    "memory_free", "disk", "inodes", "io", "temperature", "sent", "received",
+    "packets", "utilization", "process", "cgroup", "probe", "reachable"]
+
+# Compile every grammar into the dispatcher, in the order they've always been
+# tried in, along with the words that a matching command can start with.
+commands = dispatcher.Dispatcher()
+commands.register(fleet_stats, fleet_stat_commands,
+    lambda parsed: parse_fleet(parsed))
+commands.register(["fleet", "hosts"], fleet_commands,
+    lambda parsed: parse_fleet(parsed))
+commands.register(["help"], help_command, lambda parsed: "help")
+commands.register(["load", "sysload", "system"], load_or_system_load_command,
+    lambda parsed: "load")
+commands.register(["uname", "info", "system"], system_info_command,
+    lambda parsed: "info")
+commands.register(["cpus"], cpus_command, lambda parsed: "cpus")
+commands.register(["disk", "io", "i/o", "iostat", "inodes"], disk_io_commands,
+    lambda parsed: "disk io")
+commands.register(["disk", "storage"], free_disk_space_command,
+    lambda parsed: "disk")
+commands.register(["memory", "free", "ram"], unused_memory_command,
+    lambda parsed: "memory")
+commands.register(["uptime"], uptime_command, lambda parsed: "uptime")
+commands.register(["ip", "public", "addr"], ip_address_commands,
+    lambda parsed: "ip")
+commands.register(["ip", "local"], local_ip_address_commands,
+    lambda parsed: "local ip")
+commands.register(["network", "traffic"], network_traffic_stats_command,
+    lambda parsed: "traffic")
+commands.register(["system", "temperature", "temp", "overheating", "core"],
+    system_temperature_commands, lambda parsed: "temperature")
+commands.register(["top", "busy", "busiest"], top_processes_commands,
+    lambda parsed: "processes")
+commands.register(["process"], process_stats_commands,
+    lambda parsed: parse_process_stats(parsed))
+commands.register(["services", "probes", "service"], services_commands,
+    lambda parsed: "services")
+commands.register(["cgroups", "cgroup", "containers", "container"],
+    cgroup_stats_commands, lambda parsed: "cgroups")
+commands.register(["date", "time", "datetime", "local"],
+    local_datetime_commands, lambda parsed: "datetime")
+commands.register(["stats", "command", "bot"], bot_stats_commands,
+    lambda parsed: "stats")
+commands.register(["history"], history_commands,
+    lambda parsed: parse_history(parsed))
+
 # parse_help(): Function that matches the word "help" all by itself in an input
 #   string.  Returns the string "help" on a match and None if not.
 def parse_help(command):
@@ -256,10 +378,92 @@ def parse_datetime(command):
         except:
             return None
 
+# parse_process_stats(): Function that turns a parsed "process stats" command
+#   into a hash table: "process stats" on its own lists the monitored
+#   processes, "process stats <process>" asks about one of them.  Takes one
+#   argument, the parsed command.  Returns a hash table containing the type
+#   "process stats" and the process (or None).
+def parse_process_stats(parsed_command):
+    name = None
+    if "name" in parsed_command and parsed_command["name"].strip():
+        name = parsed_command["name"].strip()
+    return {"type": "process stats", "name": name}
+
+# parse_fleet(): Function that turns a parsed fleet command into a hash
+#   table: "hosts" or "fleet" on its own sums up every host, "<stat> on all
+#   hosts" or "fleet <stat>" asks about one stat (or every stat whose name
+#   starts with it) on every host.  Takes one argument, the parsed command.
+#   Returns a hash table containing the type "fleet" and the stat (or None).
+def parse_fleet(parsed_command):
+    metric = None
+    if "metric" in parsed_command:
+        metric = parsed_command["metric"]
+    return {"type": "fleet", "metric": metric}
+
+# parse_history(): Function that turns a parsed "history" command into a hash
+#   table: "history" on its own lists the stats that have a history,
+#   "history <stat>" covers the last hour, "history <stat> [over the last] <n>
+#   <minutes|hours|days>" the last n of them, "history <stat> from <time> to
+#   <time>" a span of time, and "history <stat> at <time>" the minute around a
+#   particular time.  Times look like 3am, 3:15pm, or 15:15, and mean the last
+#   time the clock read that.  Takes one argument, the parsed command.
+#   Returns a hash table containing the type "history", the stat (or None),
+#   and the start and end of the span as Unix timestamps, or None if the
+#   times don't make sense.
+def parse_history(parsed_command):
+    history = {"type": "history", "metric": None, "start": None, "end": None}
+    now = time.time()
+
+    if "metric" not in parsed_command:
+        return history
+    history["metric"] = parsed_command["metric"]
+
+    if "start" in parsed_command:
+        start = _time_of_day(parsed_command["start"])
+        end = _time_of_day(parsed_command["end"])
+        if start is None or end is None:
+            return None
+        if start > end:
+            start = start - 86400
+        history["start"] = start
+        history["end"] = end
+    elif "at" in parsed_command:
+        history["start"] = _time_of_day(parsed_command["at"])
+        if history["start"] is None:
+            return None
+        history["end"] = history["start"]
+    elif "amount" in parsed_command:
+        seconds = {"minute": 60, "hour": 3600, "day": 86400}
+        unit = parsed_command["unit"].lower().rstrip("s")
+        history["start"] = now - int(parsed_command["amount"]) * seconds[unit]
+        history["end"] = now
+    else:
+        history["start"] = now - 3600
+        history["end"] = now
+    return history
+
+# _time_of_day(): Helper function that turns a parsed time of day into the
+#   last time the clock read that, as a Unix timestamp.  Returns None if it
+#   isn't a real time.
+def _time_of_day(parsed_time):
+    hour = int(parsed_time["hour"])
+    minute = 0
+    if "minute" in parsed_time:
+        minute = int(parsed_time["minute"])
+    if "meridian" in parsed_time:
+        if hour < 1 or hour > 12:
+            return None
+        hour = hour % 12
+        if parsed_time["meridian"].lower() == "pm":
+            hour = hour + 12
+    if hour > 23 or minute > 59:
+        return None
+    return timeseries.most_recent(hour, minute)
+
 # parse_command(): Function that parses commands from the message bus.
 #   Commands come as strings and are run through PyParsing to figure out what
 #   they are.  A single-word string is returned as a match or None on no match.
-#   Conditionals are short-circuited to speed up execution.
+#   Only the grammars which can start with the command's first word are tried.
 def parse_command(command):
     parsed_command = None
 
@@ -273,69 +477,9 @@ def parse_command(command):
     if "no commands" in command:
         return None
 
-    # Online help?
-    parsed_command = parse_help(command)
-    if parsed_command == "help":
-        return parsed_command
-
-    # System load?
-    parsed_command = parse_system_load(command)
-    if parsed_command == "load":
-        return parsed_command
-
-    # System info?
-    parsed_command = parse_system_info(command)
-    if parsed_command == "info":
-        return parsed_command
-
-    # CPUs?
-    parsed_command = parse_cpus(command)
-    if parsed_command == "cpus":
-        return parsed_command
-
-    # Free disk space?
-    parsed_command = parse_disk_space(command)
-    if parsed_command == "disk":
-        return parsed_command
-
-    # Free memory?
-    parsed_command = parse_free_memory(command)
-    if parsed_command == "memory":
-        return parsed_command
-
-    # System uptime?
-    parsed_command = parse_uptime(command)
-    if parsed_command == "uptime":
-        return parsed_command
-
-    # Public  IP address?
-    parsed_command = parse_ip_address(command)
-    if parsed_command == "ip":
-        return parsed_command
-
-    # Local IP address?
-    parsed_command = parse_local_ip_address(command)
-    if parsed_command == "local ip":
-        return parsed_command
-
-    # Network traffic stats?
-    parsed_command = parse_network_traffic(command)
-    if parsed_command == "traffic":
-        return parsed_command
-
-    # System temperature?
-    parsed_command = parse_system_temperature(command)
-    if parsed_command == "temperature":
-        return parsed_command
-
-    # Busiest processes on the system?
-    parsed_command = parse_top_processes(command)
-    if parsed_command == "processes":
-        return parsed_command
-
-    # Local date and time?
-    parsed_command = parse_datetime(command)
-    if parsed_command == "datetime":
+    # Run the command through the dispatcher.
+    parsed_command = commands.dispatch(command)
+    if parsed_command:
         return parsed_command
 
     # Fall-through: Nothing matched.
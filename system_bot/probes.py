@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# probes.py - Module that checks whether services are actually answering, for
+#   system_bot.py.  A process being in the process table doesn't mean it's
+#   doing its job, so each probe connects to a service the way a client
+#   would: it opens a TCP connection, fetches a URL over HTTP(S), or connects
+#   to a Unix domain socket, optionally sending something and looking for an
+#   answer.  How long that took (the latency) goes into the history so that a
+#   service getting slower can be noticed.
+#
+#   Every probe runs at the same time as the others on a pool of threads, and
+#   each one has its own timeout, so a service that's hanging only costs its
+#   own probe.  A probe that hasn't finished by the time it should have (a
+#   DNS lookup that won't time out, for example) is counted as failed and
+#   isn't started again until it's finished.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import concurrent.futures
+import logging
+import requests
+import socket
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Constants.
+# Kinds of probes.
+kinds = ["tcp", "http", "unix"]
+
+# Seconds to wait on top of a probe's own timeout before giving up on it.
+grace = 1.0
+
+# Most bytes to read while looking for what a probe expects to get back.
+maximum_answer = 65536
+
+# Variables global to this module.
+# Probes (Probe), in the order they were configured.
+probes = []
+
+# Threads the probes run on, one per probe.
+pool = None
+
+# Hash table of probe names to the futures of probes that hadn't finished
+# when they were last given up on.
+running = {}
+
+# Hash table of probe names to the results of their last runs:
+# (time.time(), latency in milliseconds or None, error or None) tuples.
+results = {}
+
+# Classes.
+# Probe: Class that holds one probe.
+class Probe(object):
+
+    # Initialize new instances of the class.  Takes two arguments, the name of
+    # the probe and what to probe: host:port for TCP, a URL for HTTP, or the
+    # path to a Unix domain socket.  Optionally takes the kind of probe (one of
+    # kinds, which is worked out from the target if not given), the timeout
+    # in seconds, something to send once connected (TCP and Unix sockets, with
+    # \r and \n for carriage returns and newlines), a string the answer has
+    # to contain, and for HTTP the status codes that count as working (a list
+    # or comma separated string, defaulting to anything below 400).
+    def __init__(self, name, target, kind=None, timeout=5.0, send="",
+        expect="", status=None):
+        self.name = name
+        self.target = target.strip()
+        if not kind:
+            kind = "tcp"
+            if self.target.lower().startswith(("http://", "https://")):
+                kind = "http"
+            elif self.target.startswith("/"):
+                kind = "unix"
+        self.kind = kind.strip().lower()
+        if self.kind not in kinds:
+            raise ValueError("Probe " + name + " is of unknown type " + self.kind + ".")
+        self.timeout = float(timeout)
+        self.send = send.replace("\\r", "\r").replace("\\n", "\n").encode("utf-8")
+        self.expect = expect
+        if isinstance(status, str):
+            status = status.split(",")
+        self.status = [int(i) for i in status or [] if str(i).strip()]
+
+        # Where to connect to for TCP.  IPv6 addresses are in brackets.
+        self.address = None
+        if self.kind == "tcp":
+            (host, separator, port) = self.target.rpartition(":")
+            if not separator or not port.isdigit():
+                raise ValueError("Probe " + name + " needs a target of host:port.")
+            self.address = (host.strip("[]"), int(port))
+
+    # run(): Probes the service once.  Returns a (latency in milliseconds,
+    #   error) tuple: the latency is None if the probe failed, and the error
+    #   says why.
+    def run(self):
+        start = time.monotonic()
+        try:
+            if self.kind == "http":
+                self._http()
+            else:
+                self._socket()
+        except Exception as e:
+            return (None, str(e) or e.__class__.__name__)
+        return ((time.monotonic() - start) * 1000.0, None)
+
+    # _http(): Fetches the URL, and raises an exception if it doesn't work.
+    def _http(self):
+        request = requests.get(self.target, timeout=self.timeout,
+            allow_redirects=False)
+        if self.status:
+            if request.status_code not in self.status:
+                raise ValueError("HTTP status " + str(request.status_code))
+        elif request.status_code >= 400:
+            raise ValueError("HTTP status " + str(request.status_code))
+        if self.expect and self.expect not in request.text:
+            raise ValueError("the page doesn't contain " + repr(self.expect))
+
+    # _socket(): Connects to the TCP port or the Unix domain socket, sends
+    #   whatever the probe sends, and reads until what it expects turns up.
+    #   Raises an exception if any of that doesn't work.
+    def _socket(self):
+        if self.kind == "tcp":
+            connection = socket.create_connection(self.address, self.timeout)
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+        with connection:
+            if self.kind == "unix":
+                connection.connect(self.target)
+            if self.send:
+                connection.sendall(self.send)
+            if not self.expect:
+                return
+
+            # The timeout applies to every read, so the whole thing has a
+            # deadline too.
+            deadline = time.monotonic() + self.timeout
+            answer = b""
+            expect = self.expect.encode("utf-8")
+            while expect not in answer:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or len(answer) >= maximum_answer:
+                    raise ValueError("the answer doesn't contain " + repr(self.expect))
+                connection.settimeout(remaining)
+                data = connection.recv(4096)
+                if not data:
+                    raise ValueError("the connection was closed before the answer contained " + repr(self.expect))
+                answer = answer + data
+
+# Functions.
+# configure(): Sets up the probes.  Takes one argument, a list of Probes.
+def configure(probe_list):
+    global probes
+    global pool
+
+    probes = list(probe_list)
+    running.clear()
+    results.clear()
+    if pool:
+        pool.shutdown(wait=False)
+    pool = None
+    if probes:
+        pool = ThreadPoolExecutor(max_workers=len(probes),
+            thread_name_prefix="probe")
+    logging.debug("Service probes: " + ", ".join(i.name + " (" + i.kind + " " + i.target + ")" for i in probes))
+
+# check(): Runs every probe at the same time and waits for them to finish or
+#   time out.  Takes no arguments.  Returns a hash table of metrics
+#   ("probe_up:<probe>", 1.0 or 0.0, and "probe_latency:<probe>", in
+#   milliseconds, for the probes that worked) and a hash table of metrics to
+#   the fields alert messages about them can use ("target", and "error" for
+#   the probes that failed).
+def check():
+    metrics = {}
+    context = {}
+    if not probes:
+        return (metrics, context)
+
+    # Probes that still haven't finished from last time aren't started again.
+    started = {}
+    outcomes = {}
+    for probe in probes:
+        if probe.name in running:
+            if not running[probe.name].done():
+                outcomes[probe.name] = (None, "it still hasn't finished from the last time")
+                continue
+            del running[probe.name]
+        started[probe.name] = pool.submit(probe.run)
+
+    deadline = max(i.timeout for i in probes) + grace
+    concurrent.futures.wait(list(started.values()), timeout=deadline)
+    for probe in probes:
+        if probe.name not in started:
+            continue
+        future = started[probe.name]
+        if future.done():
+            outcomes[probe.name] = future.result()
+        else:
+            running[probe.name] = future
+            outcomes[probe.name] = (None, "no answer in " + str(probe.timeout) + " seconds")
+
+    now = time.time()
+    for probe in probes:
+        (latency, error) = outcomes[probe.name]
+        results[probe.name] = (now, latency, error)
+        metrics["probe_up:" + probe.name] = 0.0 if error else 1.0
+        context["probe_up:" + probe.name] = {"target": probe.target,
+            "error": error or ""}
+        if latency is not None:
+            metrics["probe_latency:" + probe.name] = round(latency, 2)
+            context["probe_latency:" + probe.name] = {"target": probe.target}
+        if error:
+            logging.debug("Probe " + probe.name + " failed: " + error)
+    return (metrics, context)
+
+if "__name__" == "__main__":
+    pass
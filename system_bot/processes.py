@@ -10,75 +10,313 @@
 
 # License: GPLv3
 
+# v2.6 - An argument also matches by its file name without the extension, so
+#         "test_bot" matches "python /path/to/test_bot.py".  Patterns that
+#         only match part of an argument (the way `ps ax` used to be searched)
+#         still match, with a warning, so nothing gets started twice.
+# v2.5 - Added resource_metrics(), which measures how much memory, CPU time,
+#         file descriptors, and threads each monitored process is using.
+# v2.4 - The busiest processes are worked out by a thread that measures CPU
+#         usage at a fixed interval, so they're correct and ready whenever
+#         somebody asks.
+# v2.3 - Processes system_bot.py restarts are supervised directly: their exits
+#         are picked up the moment they happen and they're restarted
+#         according to a restart policy, with exponential backoff and
+#         crash loop detection.
+# v2.2 - Replaced `ps ax` with an index of running processes built with
+#         psutil, which is kept up to date incrementally.  Monitored
+#         processes are matched by name or by whole command line arguments
+#         rather than by substring.
 # v2.1 - Added the ability to find out the top X running processes on the
 #         system.
 # v2.0 - Ported to Python 3.
 # v1.0 - Initial release.
 
 # TO-DO:
-# - Rewrite processes.get_process_list() to use psutil instead.
+# -
 
 # Load modules.
+import heapq
 import logging
 import os
 import psutil
 import subprocess
 import sys
+import threading
+import time
+
+from collections import deque
+
+# Variables global to this module.
+# Index of the processes running on the system, keyed by PID.  Each entry is a
+# hash table containing the name of the process and its command line (as a
+# list).  Processes don't change their command lines very often, so they're
+# only looked up when a PID is seen for the first time.
+process_index = {}
+
+# The PID each monitored process was last found at, keyed by the string it's
+# looked for by.  As long as that PID is still around there's no need to
+# search for it.
+monitored_pids = {}
+
+# Patterns that have been found only by searching for them as part of a
+# command line and have been warned about, so the warning isn't repeated
+# every time they're looked for.
+substring_patterns = set()
+
+# Processes system_bot.py has started and is looking after, keyed by the
+# string they're looked for by.  Each entry is a hash table containing the
+# monitored process, its Popen object, when it was started, when it was
+# restarted recently, how long to wait before restarting it next time, and
+# its state: "running", "waiting" (to be restarted), "stopped" (exited
+# normally and isn't supposed to be restarted), or "failed" (crash looping or
+# couldn't be started).  Exits are picked up by a thread per process which
+# waits for it, so they're handled the moment they happen.
+supervised = {}
+supervisor_lock = threading.Lock()
+
+# The CPU sampler thread, how often it runs, and how many of the busiest
+# processes it keeps track of.
+cpu_sampler = None
+cpu_sample_interval = 5.0
+cpu_sample_size = 10
+
+# Total CPU time of every process as of the last sample, keyed by PID, when
+# that was, and the busiest processes it found.  cpu_top_processes is None
+# until there have been two samples.
+cpu_samples = {}
+cpu_sample_time = 0.0
+cpu_top_processes = None
+cpu_sample_lock = threading.Lock()
+cpu_lock = threading.Lock()
+
+# The strings monitored processes are looked for by, whose resource usage is
+# measured by resource_metrics(), and the PID, total CPU time, and time of
+# the last measurement of each one, so their CPU usage can be worked out.
+# The last measurements are kept in last_resources (as returned by
+# resource_metrics()) for anybody who asks.
+tracked_processes = []
+resource_samples = {}
+last_resources = {}
+
+# How supervised processes are restarted.  Set by configure_supervisor().
+send_message_to_user = None
+restart_policy = "always"
+minimum_restart_backoff = 1.0
+maximum_restart_backoff = 300.0
+crash_loop_restarts = 5
+crash_loop_window = 600.0
 
 # Functions.
-# get_process_list(): Function that pulls a list of processes running on the
-#   local system as a large string.
+# refresh_process_index(): Function that brings the index of running
+#   processes up to date.  Only processes that have started since the last
+#   refresh are looked at, and ones that have exited are dropped.  Takes one
+#   optional argument, whether or not to throw the index away and rebuild it
+#   from scratch.
+def refresh_process_index(rebuild=False):
+    if rebuild or not process_index:
+        process_index.clear()
+        for process in psutil.process_iter(attrs=["pid", "name", "cmdline"]):
+            process_index[process.info["pid"]] = {
+                "name": process.info["name"] or "",
+                "cmdline": process.info["cmdline"] or []}
+        return
+
+    running = set(psutil.pids())
+    for pid in set(process_index) - running:
+        del process_index[pid]
+
+    for pid in running - set(process_index):
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                process_index[pid] = {"name": process.name(),
+                    "cmdline": process.cmdline()}
+        except (psutil.NoSuchProcess, psutil.AccessDenied,
+                psutil.ZombieProcess):
+            # It exited already or it's not ours to look at.  Either way
+            # there's nothing to match against.
+            continue
+
+# get_process_list(): Function that returns the command lines of the
+#   processes running on the local system, one per line, like `ps ax` does.
 def get_process_list():
-    return os.popen("ps ax").read()
+    refresh_process_index()
+    return "\n".join(" ".join(i["cmdline"]) or "[" + i["name"] + "]"
+        for i in process_index.values())
+
+# matches_process(): Function that tests whether a process in the index is
+#   the one being looked for.  A process matches if the string is its name,
+#   its full command line, or a run of whole arguments on its command line
+#   (the first of which may be just the file name of the argument, with or
+#   without its extension, so "test_bot.py --loglevel" and "test_bot" match
+#   "python /path/to/test_bot.py --loglevel debug").  Partial arguments don't
+#   match, so "bot.py" won't match "test_bot.py".  Takes two arguments, the string being looked for and the
+#   process' index entry.  Returns True or False.
+def matches_process(pattern, process):
+    if pattern == process["name"]:
+        return True
+
+    cmdline = process["cmdline"]
+    if not cmdline:
+        return False
+    if pattern == " ".join(cmdline):
+        return True
+
+    words = pattern.split()
+    for i in range(0, len(cmdline) - len(words) + 1):
+        basename = os.path.basename(cmdline[i])
+        if cmdline[i] != words[0] and basename != words[0] and \
+                os.path.splitext(basename)[0] != words[0]:
+            continue
+        if cmdline[i + 1:i + len(words)] == words[1:]:
+            return True
+    return False
+
+# find_process(): Function that looks for a process in the index.  If nothing
+#   matches, it falls back to looking for the string anywhere on a command
+#   line, the way `ps ax` used to be searched, and warns about it.  Takes one
+#   argument, the string being looked for.  Returns the PID of the process or
+#   None if it isn't running.
+def find_process(pattern):
+    pid = monitored_pids.get(pattern)
+    if pid in process_index and matches_process(pattern, process_index[pid]):
+        return pid
+
+    for pid in process_index:
+        if matches_process(pattern, process_index[pid]):
+            monitored_pids[pattern] = pid
+            return pid
+    monitored_pids.pop(pattern, None)
+
+    # Starting a process that's already running because of the way it's
+    # looked for would be worse than matching something it shouldn't.
+    for pid in process_index:
+        if pattern in " ".join(process_index[pid]["cmdline"]):
+            if pattern not in substring_patterns:
+                substring_patterns.add(pattern)
+                logging.warning("Monitored process \"" + pattern + "\" only matches part of the command line of PID " + str(pid) + " (" + " ".join(process_index[pid]["cmdline"]) + ").  Change it to the process' name or to whole arguments on its command line so it can't match the wrong process.")
+            return pid
+    return None
 
 # check_process_list(): Function that walks through a list of things to look
 #   for in the system's process table and builds another list of things that
 #   need to be restarted.  Takes one argument, a list of processes.  Returns
-#   an empty list if everything is fine, "error" if the value of 'processes'
-#   isn't defined, or another list of processes that need to be restarted.
+#   an empty list if everything is fine, or another list of processes that
+#   need to be restarted.
 def check_process_list(processes):
     logging.debug("Processes to look for: " + str(processes))
 
     crashed_processes = []
 
-    # Check the list of monitored processes.
-    process_list = get_process_list()
+    # Check the list of monitored processes.  Processes that were given up on
+    # but are running again (somebody restarted them by hand) go back to
+    # being watched normally.  Ones system_bot.py is already looking after
+    # are taken care of.
+    refresh_process_index()
     for process in processes:
-        if process[0] not in process_list:
+        if find_process(process[0]) is not None:
+            is_supervised(process[0], running=True)
+        elif not is_supervised(process[0]):
             crashed_processes.append(process)
+
+    # A process can exec() something else without changing its PID, which an
+    # incremental refresh won't notice.  Before declaring anything dead, take
+    # a fresh look at the whole process table.
+    if crashed_processes:
+        refresh_process_index(rebuild=True)
+        crashed_processes = [process for process in crashed_processes
+            if find_process(process[0]) is None]
+
     logging.debug("Dead processes : " + str(crashed_processes))
     return crashed_processes
 
+# configure_supervisor(): Function that sets up how processes system_bot.py
+#   starts are looked after once they're running.  Takes six arguments, a
+#   function to send messages to the user with, the default restart policy
+#   ("always" or "on-failure"), the shortest and longest number of seconds to
+#   wait between restarts, and the number of restarts within a number of
+#   seconds that counts as a crash loop.
+def configure_supervisor(send_function, policy, minimum_backoff,
+    maximum_backoff, loop_restarts, loop_window):
+    global send_message_to_user
+    global restart_policy
+    global minimum_restart_backoff
+    global maximum_restart_backoff
+    global crash_loop_restarts
+    global crash_loop_window
+
+    send_message_to_user = send_function
+    restart_policy = policy
+    minimum_restart_backoff = float(minimum_backoff)
+    maximum_restart_backoff = float(maximum_backoff)
+    crash_loop_restarts = int(loop_restarts)
+    crash_loop_window = float(loop_window)
+
+# is_supervised(): Function that tests whether system_bot.py is looking after
+#   a monitored process itself, in which case there's no need to look for it
+#   in the process table.  A process that was given up on stops being
+#   supervised as soon as it's seen running again (somebody restarted it by
+#   hand).  Takes two arguments, the string the process is looked for by and
+#   whether or not it's currently in the process table.  Returns True or
+#   False.
+def is_supervised(pattern, running=False):
+    with supervisor_lock:
+        if pattern not in supervised:
+            return False
+        if supervised[pattern]["state"] in ["running", "waiting"]:
+            return True
+        if running:
+            logging.debug("Process " + pattern + " is running again.  No longer holding off.")
+            del supervised[pattern]
+            return False
+        return True
+
+# start_process(): Function that starts a monitored process and a thread that
+#   waits for it to exit.  Takes one argument, the monitored process (a list
+#   of the string it's looked for by, the command line to start it with, and
+#   optionally its restart policy).  Returns True if it started, False if it
+#   couldn't be.
+def start_process(process):
+    command = process[1].split()
+
+    # Make the first element of the command a full path to the executable
+    # before caling it.
+    command[0] = sys.executable
+    logging.debug("Starting process " + process[0] + ": " + str(command))
+    try:
+        child = subprocess.Popen(command)
+    except Exception as e:
+        logging.warning("Unable to start process " + process[0] + ": " + str(e))
+        return False
+
+    with supervisor_lock:
+        entry = supervised.setdefault(process[0], {"restarts": deque(),
+            "backoff": 0.0})
+        entry["process"] = process
+        entry["child"] = child
+        entry["started"] = time.monotonic()
+        entry["state"] = "running"
+
+    threading.Thread(target=_wait_for_exit, args=(process[0], child),
+        daemon=True).start()
+    return True
+
 # restart_crashed_processes(): Function that walks through a list of crashed
-#   processes and restarts them, one by one to ensure they start back up.  The
-#   function then tests to ensure that the processes are back in the process
-#   table.  The function will attempt to restart the processes a configurable
-#   number of times, defaulting to five.  Takes two arguments, a list of
-#   strings which constitute full command lines to restart the processes and
-#   the number of times to try to restart them.  Returns True if it worked, or
-#   False if it didn't.
-def restart_crashed_processes(processes, retries=5):
+#   processes and restarts them.  From then on system_bot.py looks after them
+#   itself: if one exits it's restarted straight away according to its
+#   restart policy, backing off if it keeps exiting.  Takes one argument, a
+#   list of processes.  Returns a list of the processes that couldn't be
+#   started.
+def restart_crashed_processes(processes):
     logging.debug("Processes to restart: " + str(processes))
 
     crashed_processes = []
-    command = None
-    pid = None
 
     # Walk the list of processes to restart and try to bring them back up.
     for process in processes:
-        for i in range(0, retries):
-            command = process[1].split()
-
-            # Make the first element of the command a full path to the
-            # executable before caling it.
-            logging.debug("Restarting dead process: " + process[0])
-            command[0] = sys.executable
-            pid = subprocess.Popen(command)
-
-            # Check the process list to make sure it came back up.
-            if not check_process_list(process):
-                logging.debug("Success!  Restarted process " + process[0] + "!")
-                break
+        if start_process(process):
+            logging.debug("Success!  Restarted process " + process[0] + "!")
         else:
             logging.debug("Unable to restart crashed process: " + process[0])
             crashed_processes.append(process)
@@ -86,54 +324,267 @@ def restart_crashed_processes(processes, retries=5):
     logging.debug("Dead processes : " + str(crashed_processes))
     return crashed_processes
 
-# def get_top_processes(): Function that uses psutil to figure out what the
-#   busiest processes on the system are.  Use case: "What the hell is burning
-#   all the CPU time?"  Takes one optional argument, the number of top-X
-#   processes to find.  Defaults to 5.  Returns a list of lists of the top X
-#   processes, in descending order of CPU percentage taken up.
+# _wait_for_exit(): Helper function that runs in its own thread, waits for a
+#   supervised process to exit (which also reaps it), and decides what to do
+#   about it.  Takes two arguments, the string the process is looked for by
+#   and its Popen object.
+def _wait_for_exit(pattern, child):
+    returncode = child.wait()
+    message = ""
+    delay = 0.0
+    now = time.monotonic()
+
+    with supervisor_lock:
+        entry = supervised.get(pattern)
+        if not entry or entry["child"] is not child:
+            return
+        process = entry["process"]
+        policy = restart_policy
+        if len(process) > 2 and process[2].strip():
+            policy = process[2].strip()
+        logging.debug("Process " + pattern + " exited with status " + str(returncode) + ".")
+
+        # Processes that exit cleanly are left alone if that's the policy.
+        if policy == "on-failure" and returncode == 0:
+            entry["state"] = "stopped"
+            message = "Process " + pattern + " exited normally.  Not restarting it."
+
+        else:
+            # If it ran for a good while before exiting, it wasn't crash
+            # looping, so start backing off from scratch.
+            if now - entry["started"] > maximum_restart_backoff:
+                entry["backoff"] = 0.0
+
+            # Only the restarts within the crash loop window count.
+            entry["restarts"].append(now)
+            while entry["restarts"] and \
+                    now - entry["restarts"][0] > crash_loop_window:
+                entry["restarts"].popleft()
+
+            if len(entry["restarts"]) > crash_loop_restarts:
+                entry["state"] = "failed"
+                message = "WARNING: Process " + pattern + " has crashed " + str(len(entry["restarts"])) + " times in the last " + str(int(crash_loop_window)) + " seconds (last exit status " + str(returncode) + ").  I'm not going to restart it again.  You need to log into the server and find out what's wrong."
+            else:
+                # The first restart is immediate.  After that each one waits
+                # twice as long as the last.
+                delay = entry["backoff"]
+                entry["backoff"] = min(max(delay * 2, minimum_restart_backoff),
+                    maximum_restart_backoff)
+                entry["state"] = "waiting"
+                logging.warning("Process " + pattern + " exited with status " + str(returncode) + ".  Restarting it in " + str(delay) + " seconds.")
+
+    if message:
+        logging.warning(message)
+        if send_message_to_user:
+            send_message_to_user(message)
+        return
+
+    timer = threading.Timer(delay, _restart, args=(pattern, child))
+    timer.daemon = True
+    timer.start()
+
+# _restart(): Helper function that restarts a supervised process once its
+#   backoff is over.  Takes two arguments, the string the process is looked
+#   for by and the Popen object of the copy that exited.
+def _restart(pattern, child):
+    with supervisor_lock:
+        entry = supervised.get(pattern)
+        if not entry or entry["child"] is not child:
+            return
+        process = entry["process"]
+
+    if start_process(process):
+        return
+
+    with supervisor_lock:
+        entry["state"] = "failed"
+    message = "WARNING: Process " + pattern + " crashed and could not be restarted.  You need to log into the server and restart it manually."
+    if send_message_to_user:
+        send_message_to_user(message)
+
+# track_resources(): Function that sets which monitored processes'
+#   resource usage is measured.  Takes one argument, a list of processes from
+#   the configuration file.
+def track_resources(processes):
+    global tracked_processes
+    tracked_processes = [process[0] for process in processes]
+    resource_samples.clear()
+
+# resource_metrics(): Function that measures how much of the system's
+#   resources each monitored process is using: its resident memory (in
+#   megabytes), the percentage of a CPU it's used since the last time it was
+#   measured, and how many file descriptors it has open and threads it's
+#   running.  Takes no arguments.  Returns a hash table of metrics
+#   ("process_rss:<process>", "process_cpu:<process>",
+#   "process_fds:<process>", "process_threads:<process>"), without the ones
+#   that couldn't be measured.
+def resource_metrics():
+    global last_resources
+
+    metrics = {}
+    if not tracked_processes:
+        return metrics
+
+    refresh_process_index()
+    now = time.monotonic()
+    for pattern in tracked_processes:
+        pid = find_process(pattern)
+        if pid is None:
+            resource_samples.pop(pattern, None)
+            continue
+
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                memory = process.memory_info().rss
+                times = process.cpu_times()
+                threads = process.num_threads()
+                try:
+                    metrics["process_fds:" + pattern] = process.num_fds()
+                except (psutil.AccessDenied, AttributeError):
+                    # Somebody else's process, or not a UNIX.
+                    pass
+        except (psutil.NoSuchProcess, psutil.AccessDenied,
+                psutil.ZombieProcess):
+            metrics.pop("process_fds:" + pattern, None)
+            continue
+
+        metrics["process_rss:" + pattern] = round(memory / 1048576.0, 2)
+        metrics["process_threads:" + pattern] = threads
+
+        # The first time a process is seen (or when it's been restarted)
+        # there's nothing to work out its CPU usage from yet.
+        total = times.user + times.system
+        previous = resource_samples.get(pattern)
+        if previous and previous[0] == pid and now > previous[2]:
+            metrics["process_cpu:" + pattern] = round(max(0.0,
+                total - previous[1]) / (now - previous[2]) * 100.0, 2)
+        resource_samples[pattern] = (pid, total, now)
+    last_resources = metrics
+    return metrics
+
+# start_cpu_sampler(): Function that starts a thread which measures how much
+#   CPU time every process on the system uses, at a fixed interval, and keeps
+#   track of the busiest ones.  psutil can only work out a CPU percentage from
+#   two measurements, so asking it on demand mostly returns 0.0.  Takes two
+#   optional arguments, the number of seconds between measurements and the
+#   number of busiest processes to keep track of.
+def start_cpu_sampler(interval=5.0, number_of_processes=10):
+    global cpu_sampler
+    global cpu_sample_interval
+    global cpu_sample_size
+
+    cpu_sample_interval = float(interval)
+    cpu_sample_size = int(number_of_processes)
+    if cpu_sampler:
+        return
+    cpu_sampler = threading.Thread(target=_run_cpu_sampler, daemon=True)
+    cpu_sampler.start()
+
+# def get_top_processes(): Function that returns the busiest processes on the
+#   system as of the last time the CPU sampler ran.  Use case: "What the hell
+#   is burning all the CPU time?"  If the sampler hasn't been started or
+#   hasn't finished its first round yet, two quick measurements are taken
+#   instead.  Takes one optional argument, the number of top-X processes to
+#   return.  Defaults to 5.  Returns a list of hash tables of the top X
+#   processes, in descending order of CPU percentage taken up, or None if
+#   nothing used any CPU time.
 # MOOF: I'm leaving the function argument as-is because eventually I'd like
 #   to make this more interactive based upon user input.  But that's going to
 #   require a more solid understanding of the base case.
 def get_top_processes(number_of_processes=5):
-    top_processes = []
-    process = None
+    with cpu_lock:
+        top_processes = cpu_top_processes
 
-    # Built an array of the processes running on the server.
-    for process in psutil.process_iter():
-        process_info = process.as_dict(attrs=["cmdline", "name", "cpu_percent",
-            "pid"])
+    if top_processes is None:
+        _sample_cpu_usage()
+        time.sleep(0.25)
+        top_processes = _sample_cpu_usage()
 
-        # Kernel threads have empty cmdline values.  Skip them.
-        if not process_info["cmdline"]:
-                continue
+    # Catch the case where the process list is empty because nothing used any
+    # CPU time.
+    if not top_processes:
+        return None
+
+    top_processes = top_processes[0:number_of_processes]
+    logging.debug("Top processes on the system: " + str(top_processes))
+    return(top_processes)
+
+# _run_cpu_sampler(): Helper function that runs in its own thread and measures
+#   CPU usage every cpu_sample_interval seconds.
+def _run_cpu_sampler():
+    while True:
+        try:
+            _sample_cpu_usage()
+        except Exception as e:
+            logging.warning("Unable to sample CPU usage: " + str(e))
+        time.sleep(cpu_sample_interval)
+
+# _sample_cpu_usage(): Helper function that measures how much CPU time every
+#   process has used since the last measurement and picks out the busiest
+#   ones.  Only their command lines are looked up.  Returns the busiest
+#   processes, the same way get_top_processes() does, or None if this was the
+#   first measurement.
+def _sample_cpu_usage():
+    global cpu_samples
+    global cpu_sample_time
+    global cpu_top_processes
 
-        # Due to the fact that we want actually awake processes, skip running
-        # processes that have CPU utilization of 0.0.
-        if not process_info["cpu_percent"]:
+    with cpu_sample_lock:
+        now = time.monotonic()
+        elapsed = now - cpu_sample_time
+        samples = {}
+        busy = []
+
+        # psutil hands back the same Process object for the same process
+        # every time, and a new one if a PID gets reused, so comparing them
+        # keeps a reused PID from being credited with its predecessor's CPU
+        # time.
+        for process in psutil.process_iter(attrs=["name", "cpu_times"]):
+            times = process.info["cpu_times"]
+            if times is None:
                 continue
-        top_processes.append(process_info)
+            total = times.user + times.system
+            samples[process.pid] = (process, total)
 
-    # Catch the case where the process list is empty due to the above CPU
-    # percentage case.
-    if len(top_processes) == 0:
-        return None
+            previous = cpu_samples.get(process.pid)
+            if previous and previous[0] is process and total > previous[1]:
+                busy.append((previous[1] - total, process.pid, process))
 
-    # Sort the array based upon CPU time utilized.
-    top_processes = sorted(top_processes, key=lambda process:
-        process["cpu_percent"], reverse=True)
+        first_sample = not cpu_samples
+        cpu_samples = samples
+        cpu_sample_time = now
+        if first_sample:
+            return None
 
-    # Return the top X processes on the system.
-    top_processes = top_processes[0:number_of_processes+1]
-    logging.debug("Top processes on the system: " + str(top_processes))
-    return(top_processes)
+        # Kernel threads have empty command lines.  Skip them.  A heap means
+        # only the processes that make the cut get sorted.
+        heapq.heapify(busy)
+        top_processes = []
+        while busy and len(top_processes) < cpu_sample_size:
+            (delta, pid, process) = heapq.heappop(busy)
+            try:
+                cmdline = process.cmdline()
+            except (psutil.NoSuchProcess, psutil.AccessDenied,
+                    psutil.ZombieProcess):
+                continue
+            if not cmdline:
+                continue
+            top_processes.append({"pid": pid, "name": process.info["name"],
+                "cmdline": cmdline,
+                "cpu_percent": round(-delta / elapsed * 100, 1)})
+
+        with cpu_lock:
+            cpu_top_processes = top_processes
+        return top_processes
 
 if "__name__" == "__main__":
     print("List of system processes:")
     print(get_process_list())
 
     print("Processes that should always be running:")
-    print(check_process_list(["jfsCommit", "jfsSync"]))
+    print(check_process_list([["jfsCommit"], ["jfsSync"]]))
 
     print("Processes that should never be running:")
-    print(check_process_list(["nomatch", "this should never match"]))
+    print(check_process_list([["nomatch"], ["this should never match"]]))
     sys.exit(0)
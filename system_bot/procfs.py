@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# procfs.py - Module that takes a snapshot of the state of the system for
+#   system_bot.py straight out of /proc, once per run of the main loop, so that
+#   all of the checks look at the same numbers and nothing gets read twice:
+#   /proc/loadavg, /proc/stat, /proc/meminfo, /proc/diskstats, and the disk
+#   and inode usage of every mounted filesystem.  The list of mounted filesystems only changes when
+#   something is mounted or unmounted, so it's only read again when the kernel
+#   says it's changed (by flagging /proc/self/mounts with POLLPRI).  The
+#   cgroups being monitored (see cgroups.py) are read as part of the same
+#   snapshot.
+#
+#   The numbers are worked out the same way psutil works them out so that the
+#   alerts don't change.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.2 - Added the cgroups being monitored to the snapshot.
+# v1.1 - Added inode usage, and disk I/O (operations and bytes per second,
+#       average wait, and how busy each disk was) from /proc/diskstats.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import logging
+import os
+import psutil
+import re
+import select
+import time
+
+import cgroups
+
+# Variables global to this module.
+# The total CPU time counters from the last snapshot, for working out the
+# CPU idle time since then.  Zero the first time, which gives the idle time
+# since the system booted (which is what psutil does, too).
+previous_cpu_times = None
+
+# Mounted filesystems worth looking at: a list of mount points.  Also the
+# open /proc/self/mounts and a poll object watching it for changes.
+mount_points = None
+mounts_file = None
+mounts_poll = None
+
+# Filesystem types that don't have a device behind them (proc, tmpfs...).
+nodev_filesystems = None
+
+# The disk I/O counters from the last snapshot and when they were read, for
+# working out rates since then.
+previous_diskstats = None
+previous_diskstats_time = 0.0
+
+# Whole disks (not partitions) worth reporting I/O for.  Read once.
+block_devices = None
+
+# Size of a sector as far as /proc/diskstats is concerned, no matter what the
+# disk's real sector size is.
+sector_size = 512
+
+# Classes.
+# Snapshot: Class that holds everything read from /proc in one go.
+class Snapshot(object):
+
+    # Initialize new instances of the class.
+    def __init__(self):
+        # When the snapshot was taken.
+        self.timestamp = time.time()
+
+        # Hash table of one_minute, five_minute, and fifteen_minute system
+        # load averages.
+        self.loadavg = {}
+
+        # Percentage of time the CPUs were idle since the last snapshot.
+        self.cpu_idle = 0.0
+
+        # Hash table of total, free, buffers, cached, and available memory in
+        # bytes.
+        self.memory = {}
+
+        # Hash table of mount points to percentage of disk space used.
+        self.disk_usage = {}
+
+        # Hash table of mount points to percentage of inodes used, for
+        # filesystems that have a fixed number of them.
+        self.inode_usage = {}
+
+        # Hash table of disks to hash tables of reads and writes per second,
+        # bytes read and written per second, average time (in milliseconds)
+        # each operation took, and percentage of the time the disk was busy,
+        # since the last snapshot.  Empty the first time.
+        self.disk_io = {}
+
+        # What psutil.sensors_temperatures() returned.
+        self.temperatures = {}
+
+        # Hash table of the cgroups being monitored to hash tables of what
+        # they're using, from cgroups.read_all().
+        self.cgroups = {}
+
+# Functions.
+# take_snapshot(): Function that reads everything the checks need out of
+#   /proc.  Takes no arguments.  Returns a Snapshot.
+def take_snapshot():
+    snapshot = Snapshot()
+    snapshot.loadavg = read_loadavg()
+    snapshot.cpu_idle = read_cpu_idle()
+    snapshot.memory = read_meminfo()
+    (snapshot.disk_usage, snapshot.inode_usage) = read_disk_usage()
+    snapshot.disk_io = read_diskstats()
+    try:
+        snapshot.temperatures = psutil.sensors_temperatures()
+    except Exception:
+        # Not every platform has temperature sensors.
+        snapshot.temperatures = {}
+    snapshot.cgroups = cgroups.read_all()
+    return snapshot
+
+# read_loadavg(): Function that reads /proc/loadavg.  Returns a hash table of
+#   the one, five, and fifteen minute system load averages.
+def read_loadavg():
+    with open("/proc/loadavg", "r") as file:
+        fields = file.read().split()
+    return {"one_minute": float(fields[0]), "five_minute": float(fields[1]),
+        "fifteen_minute": float(fields[2])}
+
+# read_cpu_idle(): Function that reads the total CPU time counters from
+#   /proc/stat and works out the percentage of time the CPUs spent idle since
+#   the last time it was called.  Returns a floating point number.
+def read_cpu_idle():
+    global previous_cpu_times
+
+    with open("/proc/stat", "r") as file:
+        fields = file.readline().split()
+
+    # user, nice, system, idle, iowait, irq, softirq, steal.  Guest time is
+    # already counted in user and nice.
+    cpu_times = [int(i) for i in fields[1:9]]
+    previous = previous_cpu_times or [0] * len(cpu_times)
+    previous_cpu_times = cpu_times
+
+    total = sum(cpu_times) - sum(previous)
+    if total <= 0:
+        return 100.0
+    return round((cpu_times[3] - previous[3]) / total * 100.0, 1)
+
+# read_meminfo(): Function that reads /proc/meminfo.  Returns a hash table of
+#   total, free, buffers, cached, and available memory in bytes.
+def read_meminfo():
+    meminfo = {}
+    with open("/proc/meminfo", "r") as file:
+        for line in file:
+            (key, value) = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+
+    return {"total": meminfo["MemTotal"], "free": meminfo["MemFree"],
+        "buffers": meminfo.get("Buffers", 0),
+        "cached": meminfo.get("Cached", 0) + meminfo.get("SReclaimable", 0),
+        "available": meminfo.get("MemAvailable", meminfo["MemFree"])}
+
+# read_disk_usage(): Function that works out the percentage of disk space
+#   and of inodes used on every mounted filesystem that has a device behind
+#   it.  Returns two hash tables of mount points to percentages, disk space
+#   and inodes.  Filesystems that make inodes as they need them (btrfs, for
+#   one) aren't in the second.
+def read_disk_usage():
+    disk_used = {}
+    inodes_used = {}
+    for mount_point in get_mount_points():
+        try:
+            stats = os.statvfs(mount_point)
+        except Exception:
+            # Docker causes this to not work with permissions problems.
+            logging.debug("Skipping disk device " + mount_point + " due to restrictive permissions.")
+            continue
+
+        if stats.f_files:
+            inodes_used[mount_point] = round((stats.f_files - stats.f_ffree) / stats.f_files * 100.0, 1)
+
+        used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+        total = used + stats.f_bavail * stats.f_frsize
+        if not total:
+            disk_used[mount_point] = 0.0
+            continue
+        disk_used[mount_point] = round(used / total * 100.0, 1)
+    return (disk_used, inodes_used)
+
+# read_diskstats(): Function that reads the I/O counters of every disk out of
+#   /proc/diskstats and works out what each disk has been doing since the
+#   last time it was called.  Returns a hash table of disks to hash tables of
+#   "reads" and "writes" (per second), "read_bytes" and "write_bytes" (per
+#   second), "await" (average milliseconds per operation, including time
+#   spent queued), and "utilization" (percentage of the time the disk had
+#   I/O in flight).  Empty the first time.
+def read_diskstats():
+    global previous_diskstats
+    global previous_diskstats_time
+
+    now = time.monotonic()
+    disks = get_block_devices()
+    counters = {}
+    try:
+        with open("/proc/diskstats", "r") as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 14 or fields[2] not in disks:
+                    continue
+
+                # Reads completed, sectors read, milliseconds reading, writes
+                # completed, sectors written, milliseconds writing, and
+                # milliseconds spent doing I/O.
+                counters[fields[2]] = (int(fields[3]), int(fields[5]),
+                    int(fields[6]), int(fields[7]), int(fields[9]),
+                    int(fields[10]), int(fields[12]))
+    except Exception as e:
+        logging.debug("Unable to read /proc/diskstats: " + str(e))
+        return {}
+
+    disk_io = {}
+    elapsed = now - previous_diskstats_time
+    if previous_diskstats and elapsed > 0:
+        for disk in counters:
+            if disk not in previous_diskstats:
+                continue
+            delta = [i - j for (i, j) in zip(counters[disk],
+                previous_diskstats[disk])]
+
+            # The counters go back to zero if the disk is removed and put
+            # back.
+            if min(delta) < 0:
+                continue
+            (reads, read_sectors, read_ms, writes, write_sectors, write_ms,
+                busy_ms) = delta
+            operations = reads + writes
+            disk_io[disk] = {"reads": reads / elapsed,
+                "writes": writes / elapsed,
+                "read_bytes": read_sectors * sector_size / elapsed,
+                "write_bytes": write_sectors * sector_size / elapsed,
+                "await": (read_ms + write_ms) / operations if operations else 0.0,
+                "utilization": min(100.0, busy_ms / (elapsed * 1000.0) * 100.0)}
+
+    previous_diskstats = counters
+    previous_diskstats_time = now
+    return disk_io
+
+# get_block_devices(): Function that lists the whole disks on the system, so
+#   that partitions aren't counted twice.  Loopback devices and RAM disks
+#   aren't interesting, so they're left out.  They're only listed once.
+#   Returns a set.
+def get_block_devices():
+    global block_devices
+
+    if block_devices is None:
+        block_devices = set()
+        try:
+            for device in os.listdir("/sys/block"):
+                if device.startswith(("loop", "ram", "zram")):
+                    continue
+                block_devices.add(device)
+        except Exception as e:
+            logging.debug("Unable to list block devices: " + str(e))
+    return block_devices
+
+# get_mount_points(): Function that returns the mount points of every mounted
+#   filesystem that has a device behind it, reading them again only if
+#   something's been mounted or unmounted since the last time.  Returns a
+#   list.
+def get_mount_points():
+    global mount_points
+    global mounts_file
+    global mounts_poll
+
+    if mounts_file is None:
+        mounts_file = open("/proc/self/mounts", "r")
+        mounts_poll = select.poll()
+        mounts_poll.register(mounts_file, select.POLLPRI | select.POLLERR)
+    elif mount_points is not None and not mounts_poll.poll(0):
+        return mount_points
+
+    mounts_file.seek(0)
+    mount_points = []
+    for line in mounts_file.read().splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0] in ["", "none"]:
+            continue
+        if fields[2] in get_nodev_filesystems():
+            continue
+        mount_points.append(_unescape(fields[1]))
+    logging.debug("Mounted filesystems: " + str(mount_points))
+    return mount_points
+
+# get_nodev_filesystems(): Function that reads the filesystem types which
+#   don't have a device behind them from /proc/filesystems.  They never change
+#   so they're only read once.  Returns a set.
+def get_nodev_filesystems():
+    global nodev_filesystems
+
+    if nodev_filesystems is None:
+        nodev_filesystems = set()
+        with open("/proc/filesystems", "r") as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) == 2 and fields[0] == "nodev":
+                    nodev_filesystems.add(fields[1])
+    return nodev_filesystems
+
+# _unescape(): Helper function that turns the octal escapes the kernel puts in
+#   mount points (\040 for a space) back into characters.
+def _unescape(path):
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)),
+        path)
+
+if "__name__" == "__main__":
+    pass
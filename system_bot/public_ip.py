@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# public_ip.py - Module that finds out the public IP address of the system
+#   system_bot.py is running on by asking web services that answer with the
+#   address of whoever's asking.  Every service it knows about is asked at
+#   the same time and the first one to give a real IP address wins, so one
+#   slow or dead service doesn't hold anything up.  The answer is cached for
+#   a while and refreshed in the background, so the "ip" command doesn't
+#   have to wait for anybody.  Whenever the address changes, a function is
+#   called to say so.
+#
+#   A system with both IPv4 and IPv6 has two public addresses, and which one
+#   a service sees depends on how it was reached.  So that answers can be
+#   compared, every service is asked over the same IP version (IPv4 unless
+#   configured otherwise), and answers in the other version are ignored.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Services are only asked over one IP version, so a service that
+#        answers over IPv6 doesn't look like the address changed.  The
+#        services are asked without holding the lock, so the cached address
+#        can be used while a lookup is in progress.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import concurrent.futures
+import ipaddress
+import logging
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Variables global to this module.
+# URLs of the web services to ask, how long (in seconds) to wait for them to
+# answer, and how long (in seconds) an answer is good for.
+providers = []
+timeout = 5.0
+ttl = 300.0
+
+# IP version (4 or 6) to ask the web services over.
+family = 4
+
+# Function to call (with the old and new addresses) when the address
+# changes.
+on_change = None
+
+# The last address found, and when (time.monotonic()) it was found.
+address = None
+resolved_at = None
+
+# Threads the web services are asked from, one per service.
+pool = None
+
+# Protects the address.  It's never held while the web services are being
+# asked.
+lock = threading.Lock()
+
+# Keeps the address from being looked up by more than one thread at a time.
+# Whoever's second gets the last known address, or if there isn't one yet,
+# waits for the answer the first one found.
+resolving = threading.Lock()
+
+# Classes.
+# FamilyAdapter: Class that makes requests only connect over one IP version,
+#   by binding every connection to the unspecified address of that version.
+class FamilyAdapter(HTTPAdapter):
+
+    # Initialize new instances of the class.  Takes one argument, the IP
+    # version (4 or 6).
+    def __init__(self, version):
+        self.source_address = ("0.0.0.0", 0)
+        if version == 6:
+            self.source_address = ("::", 0)
+        super(FamilyAdapter, self).__init__()
+
+    # init_poolmanager(): Sets up the connection pool with the source address.
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = self.source_address
+        super(FamilyAdapter, self).init_poolmanager(*args, **kwargs)
+
+# Functions.
+# configure(): Sets up the web services to ask.  Takes one argument, a list
+#   of URLs (or a comma separated string of them), and optionally how long
+#   to wait for them, how long an answer is good for, a function to call
+#   when the address changes, and the IP version (4 or 6) to ask them over.
+def configure(provider_list, request_timeout=5.0, cache_ttl=300.0,
+    change_function=None, ip_version=4):
+    global providers
+    global timeout
+    global ttl
+    global on_change
+    global family
+    global pool
+
+    if isinstance(provider_list, str):
+        provider_list = provider_list.split(",")
+    providers = [i.strip() for i in provider_list if i.strip()]
+    timeout = float(request_timeout)
+    ttl = float(cache_ttl)
+    on_change = change_function
+    try:
+        family = int(ip_version)
+    except ValueError:
+        family = None
+    if family not in [4, 6]:
+        raise ValueError("The IP version to ask for the public IP address over has to be 4 or 6, not " + str(ip_version) + ".")
+    if pool:
+        pool.shutdown(wait=False)
+    pool = None
+    if providers:
+        pool = ThreadPoolExecutor(max_workers=len(providers),
+            thread_name_prefix="public_ip")
+    logging.debug("Public IP address providers (over IPv" + str(family) + "): " + ", ".join(providers))
+
+# lookup(): Returns the public IP address of the system.  A cached answer is
+#   used if it isn't too old, otherwise the web services are asked.  If none
+#   of them answer, or another thread is already asking them, the last known
+#   address is used anyway.  Takes one
+#   optional argument, whether or not to ignore the cache.  Returns a string,
+#   or None if the address has never been found.
+def lookup(force=False):
+    with lock:
+        if not force and _fresh():
+            return address
+        known = address
+
+    if not resolving.acquire(blocking=known is None):
+        return known
+    try:
+        # Somebody else might've just looked it up.
+        with lock:
+            if not force and _fresh():
+                return address
+        found = _resolve()
+    finally:
+        resolving.release()
+    return _update(found)
+
+# refresh(): Asks the web services for the address again, so the cache is
+#   always fresh when somebody wants it.  Meant to be run periodically.
+#   Takes no arguments.
+def refresh():
+    lookup(force=True)
+
+# _fresh(): Helper function that returns True if the cached address isn't too
+#   old to use.
+def _fresh():
+    return address is not None and time.monotonic() - resolved_at < ttl
+
+# _resolve(): Helper function that asks every web service at the same time
+#   and takes the first real IP address any of them answers with.  Returns
+#   the address, or None if none of them answered.
+def _resolve():
+    if not pool:
+        return None
+
+    found = None
+    asking = [pool.submit(_ask, i) for i in providers]
+    try:
+        for answer in concurrent.futures.as_completed(asking, timeout=timeout):
+            if answer.result():
+                found = answer.result()
+                break
+    except concurrent.futures.TimeoutError:
+        pass
+
+    # The slower services are left to finish on their own, and their answers
+    # thrown away.
+    for i in asking:
+        i.cancel()
+    return found
+
+# _update(): Helper function that replaces the cached address with a new one
+#   and says so if it changed.  Takes one argument, the address the web
+#   services answered with (or None if none of them did).  Returns the
+#   address, or the last known address if there's no new one.
+def _update(found):
+    global address
+    global resolved_at
+
+    with lock:
+        previous = address
+        if not found:
+            logging.warning("None of the public IP address services answered.  Using the last known address: " + str(previous))
+            return previous
+        address = found
+        resolved_at = time.monotonic()
+
+    if previous and previous != found and on_change:
+        logging.info("Public IP address changed from " + previous + " to " + found + ".")
+        try:
+            on_change(previous, found)
+        except Exception as e:
+            logging.warning("Unable to report the change of public IP address: " + str(e))
+    return found
+
+# _ask(): Helper function that asks one web service for the address.  Takes
+#   one argument, the URL of the service.  Returns the address as a string,
+#   or None if the service didn't answer with a real IP address.
+def _ask(provider):
+    try:
+        with requests.Session() as session:
+            session.mount("http://", FamilyAdapter(family))
+            session.mount("https://", FamilyAdapter(family))
+            request = session.get(provider, timeout=timeout)
+    except requests.RequestException as e:
+        logging.debug("Unable to contact IP address service " + provider + ": " + str(e))
+        return None
+
+    if request.status_code != requests.codes.ok:
+        logging.debug("IP address service " + provider + " returned HTTP error code " + str(request.status_code) + ".")
+        return None
+
+    try:
+        found = ipaddress.ip_address(request.text.strip())
+    except ValueError:
+        logging.debug("IP address service " + provider + " answered with something that isn't an IP address: " + request.text[:100])
+        return None
+
+    # A proxy or NAT64 gateway in the way can make a service see the other
+    # kind of address, which can't be compared with the rest.
+    if found.version != family:
+        logging.debug("IP address service " + provider + " answered with an IPv" + str(found.version) + " address: " + str(found))
+        return None
+    return str(found)
+
+if "__name__" == "__main__":
+    pass
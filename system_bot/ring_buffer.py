@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# ring_buffer.py - Module that implements a fixed-size window of samples for
+#   system_bot.py which keeps its mean and variance up to date as samples are
+#   added and the oldest ones fall out (Welford's algorithm, run forwards to
+#   add a sample and backwards to remove one).  Adding a sample and asking for
+#   the standard deviation both take the same amount of time no matter how
+#   big the window is, so long baselines are cheap even on small machines.
+#
+#   Running a floating point sum forwards and backwards for long enough lets
+#   rounding errors creep in, so every time the window has been completely
+#   replaced the sums are worked out again from scratch.  That's still a
+#   constant amount of work per sample, on average.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import math
+
+from array import array
+
+# RingBuffer: Class that holds up to a fixed number of floating point samples,
+#   oldest first, along with their running mean and variance.
+class RingBuffer(object):
+
+    # Initialize new instances of the class.  Takes one argument, the maximum
+    # number of samples to hold.
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.samples = array("d", [0.0] * self.capacity)
+
+        # Index of the oldest sample and number of samples held.
+        self.head = 0
+        self.count = 0
+
+        # Running mean and sum of squared differences from the mean.
+        self.mean = 0.0
+        self.m2 = 0.0
+
+        # Number of samples replaced since the sums were last recalculated.
+        self.replaced = 0
+
+    def __len__(self):
+        return self.count
+
+    # append(): Adds a sample to the window.  If the window is full the
+    #   oldest sample falls out of it.  Takes one argument, the sample.
+    def append(self, value):
+        value = float(value)
+        if self.count == self.capacity:
+            self._remove(self.samples[self.head])
+            self.samples[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+            self._add(value)
+            self.replaced = self.replaced + 1
+            if self.replaced >= self.capacity:
+                self._recalculate()
+            return
+
+        self.samples[(self.head + self.count) % self.capacity] = value
+        self.count = self.count + 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    # variance(): Returns the sample variance of the window (the same thing
+    #   statistics.variance() would), or 0.0 if there are fewer than two
+    #   samples.
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return max(self.m2, 0.0) / (self.count - 1)
+
+    # stdev(): Returns the sample standard deviation of the window (the same
+    #   thing statistics.stdev() would), or 0.0 if there are fewer than two
+    #   samples.
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+    # values(): Returns the samples in the window as a list, oldest first.
+    def values(self):
+        return [self.samples[(self.head + i) % self.capacity]
+            for i in range(self.count)]
+
+    # _add(): Helper method that folds a sample into the running sums when the
+    #   window is full.  The sample count doesn't change because _remove() was
+    #   just called.
+    def _add(self, value):
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    # _remove(): Helper method that takes a sample out of the running sums
+    #   (Welford's algorithm in reverse).  The caller keeps track of the count.
+    def _remove(self, value):
+        if self.count == 1:
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+        old_mean = (self.count * self.mean - value) / (self.count - 1)
+        self.m2 = self.m2 - (value - self.mean) * (value - old_mean)
+        self.mean = old_mean
+
+    # _recalculate(): Helper method that works the running sums out from
+    #   scratch to get rid of accumulated rounding errors.
+    def _recalculate(self):
+        self.replaced = 0
+        values = self.values()
+        self.mean = math.fsum(values) / self.count
+        self.m2 = math.fsum((i - self.mean) ** 2 for i in values)
+
+if "__name__" == "__main__":
+    pass
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# scheduler.py - Module that runs system_bot.py's periodic jobs (the system
+#   checks, the process watchdog, sending the outbox) each on its own
+#   interval.  The jobs are kept in a heap ordered by when they're due next,
+#   so the scheduler always knows how long it can sleep and never has to look
+#   at jobs that aren't due.  Each job is due again one interval after it was
+#   last due, not after it last finished, so a slow run doesn't push the
+#   schedule back; if a job falls more than a whole interval behind, the runs
+#   it missed are skipped rather than run back to back.
+#
+#   Jobs that spend their time waiting on the network (looking up the public
+#   IP address, probing services) can run in the background, on a thread of
+#   their own, so they don't hold up the jobs behind them.  If one hasn't
+#   finished by the time it's due again, that run is skipped.  What a
+#   background job returns can be handed to a function that runs on the
+#   scheduler's thread, for anything that isn't safe to do from another
+#   thread (like checking the alert rules).
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.1 - Jobs can run in the background.  Jobs have to run every so many
+#        seconds, not every 0 seconds.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Classes.
+# Job: Class that holds one periodic job.
+class Job(object):
+
+    # Initialize new instances of the class.  Takes three arguments, the name
+    # of the job, how often to run it (in seconds), and the function to call
+    # (with no arguments).  Optionally takes whether to run it in the
+    # background, and for background jobs, a function to call on the
+    # scheduler's thread with whatever the job returned.
+    def __init__(self, name, interval, function, background=False,
+        then=None):
+        self.name = name
+        self.interval = float(interval)
+        self.function = function
+        self.background = background
+        self.then = then
+
+        # The thread a background job is running on.
+        self.thread = None
+
+        # How many times the job has run, how many runs it's missed, and how
+        # long the last run took.
+        self.runs = 0
+        self.missed = 0
+        self.duration = 0.0
+
+# Scheduler: Class that runs Jobs when they're due.
+class Scheduler(object):
+
+    # Initialize new instances of the class.
+    def __init__(self):
+        # Heap of (time due, sequence number, Job) tuples.  The sequence
+        # number keeps jobs that are due at the same time in the order they
+        # were added.
+        self.heap = []
+        self.sequence = itertools.count()
+        self.jobs = {}
+
+        # Wakes run() up early when a job is added or the scheduler is
+        # stopped.
+        self.condition = threading.Condition()
+        self.running = False
+
+        # List of (Job, result) tuples of background jobs that have finished,
+        # waiting for their then functions to be called.
+        self.finished = []
+
+    # every(): Adds a job that runs every so often.  Takes three arguments,
+    #   the name of the job, the number of seconds between runs, and the
+    #   function to call.  Optionally takes how long to wait before the first
+    #   run (defaults to running it straight away), whether to run it in the
+    #   background, and a function to hand what a background job returns to.
+    #   Returns the Job.  Raises ValueError if the number of seconds isn't
+    #   more than 0.
+    def every(self, name, interval, function, delay=0.0, background=False,
+        then=None):
+        if not float(interval) > 0:
+            raise ValueError("Job " + name + " has to run every so many seconds, not every " + str(interval) + ".")
+        job = Job(name, interval, function, background, then)
+        with self.condition:
+            self.jobs[name] = job
+            heapq.heappush(self.heap, (time.monotonic() + float(delay),
+                next(self.sequence), job))
+            self.condition.notify()
+        logging.debug("Scheduled job " + name + " every " + str(job.interval) + " seconds.")
+        return job
+
+    # run(): Runs jobs as they come due until stop() is called.  Blocks the
+    #   calling thread.
+    def run(self):
+        self.running = True
+        while True:
+            with self.condition:
+                while self.running and not self.finished:
+                    if self.heap:
+                        wait = self.heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                if not self.running:
+                    return
+                finished = None
+                if self.finished:
+                    finished = self.finished.pop(0)
+                else:
+                    (due, sequence, job) = heapq.heappop(self.heap)
+
+            # A background job has finished, so hand what it found over.
+            if finished:
+                (job, result) = finished
+                self._call(job, job.then, result)
+                continue
+
+            if not job.background:
+                self._run_job(job)
+            elif job.thread and job.thread.is_alive():
+                job.missed = job.missed + 1
+                logging.debug("Job " + job.name + " is still running from the last time, so it's been skipped.")
+            else:
+                job.thread = threading.Thread(target=self._run_in_background,
+                    args=(job,), name=job.name, daemon=True)
+                job.thread.start()
+
+            # Due again one interval after it was due this time, skipping
+            # any runs it's too far behind to make.
+            now = time.monotonic()
+            next_due = due + job.interval
+            if next_due <= now:
+                missed = int((now - next_due) // job.interval) + 1
+                job.missed = job.missed + missed
+                next_due = next_due + missed * job.interval
+                logging.debug("Job " + job.name + " fell behind and skipped " + str(missed) + " runs.")
+            with self.condition:
+                heapq.heappush(self.heap, (next_due, next(self.sequence),
+                    job))
+
+    # stop(): Makes run() return once the job it's running (if any) is done.
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    # _run_job(): Helper method that runs a job and keeps track of how long
+    #   it took.  A job that crashes is logged and run again next time.
+    #   Returns what the job returned, or None if it crashed.
+    def _run_job(self, job):
+        start = time.monotonic()
+        result = self._call(job, job.function)
+        job.runs = job.runs + 1
+        job.duration = time.monotonic() - start
+        logging.debug("Job " + job.name + " took %.3fs." % job.duration)
+        return result
+
+    # _run_in_background(): Helper method that runs a background job, and
+    #   queues up what it returned for its then function (if it has one and
+    #   the job didn't crash).
+    def _run_in_background(self, job):
+        result = self._run_job(job)
+        if job.then and result is not None:
+            with self.condition:
+                self.finished.append((job, result))
+                self.condition.notify()
+
+    # _call(): Helper method that calls one of a job's functions and logs it
+    #   if it crashes.  Takes the job, the function, and any arguments to pass
+    #   to it.  Returns what the function returned, or None if it crashed.
+    def _call(self, job, function, *args):
+        try:
+            return function(*args)
+        except Exception as e:
+            logging.exception("Job " + job.name + " failed: " + str(e))
+            return None
+
+if "__name__" == "__main__":
+    pass
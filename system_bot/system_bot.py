@@ -11,6 +11,89 @@
 
 # License: GPLv3
 
+# v4.27 - The number of stats with a history is limited (history_metrics),
+#       stats that haven't been seen for history_expiry days are forgotten,
+#       and the history is written to disk when the bot shuts down.  The
+#       public IP address and the service probes are checked in the
+#       background, so they don't hold up the system checks.  How often
+#       things are done has to be more than 0 seconds.  The aggregator only
+#       takes pushes from fleet_hosts hosts, and only listens on the network
+#       if there's a fleet_key.
+#       A command that fails is still measured, and only up to the point
+#       where it failed.
+#       polling_time can be less than 4 seconds, and defaults to 10 seconds
+#       like the configuration file says.
+#       history_metrics defaults to 200 stats.  The public IP address is
+#       looked up over one IP version (ip_addr_family).
+# v4.26 - Fleet mode: with aggregator set, the bot is an agent that only
+#       collects the system's stats and pushes what's changed to a central
+#       bot over HTTP.  With fleet_port set, the bot is that central bot: it
+#       takes pushes from agents, checks every host against the alert rules,
+#       and answers "<stat> on all hosts" and "hosts".
+# v4.25 - Services can be probed ([probe:<name>] sections: TCP, HTTP, or
+#       Unix domain sockets), all at the same time with timeouts, with alerts
+#       if they stop answering or get slower than usual.  Added the
+#       "services" command.
+# v4.24 - Cgroups (containers, systemd units) can be monitored: memory and
+#       CPU time used against their limits, memory pressure, throttling, OOM
+#       kills, and disk I/O (see cgroups).  Added the "cgroups" command.
+# v4.23 - Log files can be watched for lines that match [log:<name>] rules,
+#       which are sent as alerts.
+# v4.22 - The public IP address is cached and looked up in the background,
+#       from several services at once (ip_addr_site can list more than one),
+#       with a timeout.  The user is told when it changes.
+# v4.21 - The memory, CPU time, file descriptors, and threads monitored
+#       processes use are kept track of, with alerts if they're leaking memory
+#       or file descriptors (memory_leak_rate, fd_leak_rate).  Added the
+#       "process stats" command.
+# v4.20 - The stats the checks collect can be served over HTTP, in
+#       Prometheus' text format and as JSON, for dashboards to scrape (see
+#       exporter_port).
+# v4.19 - Commands are handled by a thread of their own, so they're answered
+#       straight away instead of waiting for the system checks.  The system
+#       checks, the process watchdog, and the outbox each run on their own
+#       schedule (see scheduler.py).
+# v4.18 - Added the "disk io" command.  Inode usage and disk I/O (saturated or
+#       slow disks) set off alerts, with thresholds inode_usage,
+#       disk_utilization, and disk_await.
+# v4.17 - "traffic" also says how fast each network interface is sending and
+#       receiving (bytes and packets per second), how much of its link speed
+#       that is, and how fast it's been at its busiest over the last day.
+#       Links running at more than link_saturation percent of their speed
+#       set off an alert.
+# v4.16 - Load and temperature spikes are readings that are unusually far
+#       above an EWMA or hour of the day baseline (see anomaly.py), instead
+#       of a window whose standard deviation is too high.
+# v4.15 - Alerts are decided by rules (see alerts.py) instead of a counter per
+#       check threaded through the main loop.  The built-in rules can be
+#       changed and new ones added with [alert:<name>] sections.  Rules have
+#       separate trigger and clear levels and their own cooldowns, and
+#       everything one pass turns up is sent as one message.
+# v4.14 - Any number of OpenWRT devices can be monitored at once, one
+#       [openwrt:<name>] section each.  They're polled in parallel, each
+#       with its own windows and alert counters, and the alerts from one pass
+#       go out as a single message.
+# v4.13 - OpenWRT devices are polled over kept-alive connections with
+#       timeouts, and each endpoint is fetched at most once per run of the
+#       main loop.
+# v4.12 - The system checks share one snapshot of /proc per run of the main
+#       loop.
+# v4.11 - Every stat the bot collects is kept in a history with one minute,
+#       five minute, and one hour resolution, which can be asked about with
+#       the "history" command.
+# v4.10 - The busiest processes are measured by a background thread, so "top
+#       processes" answers straight away with real CPU percentages.
+# v4.9 - Processes the bot restarts are supervised directly, restarted the
+#       moment they exit according to a restart policy, and given up on if
+#       they crash loop.
+# v4.8 - Every command is timed and its outbound HTTP requests counted, per
+#       kind of command.  The totals are kept in a metrics file and can be
+#       asked for with the "stats" command.
+# v4.7 - Messages to the user go through an on-disk outbox which is sent to
+#       the XMPP bridge in batches and retried with backoff, so alerts aren't
+#       lost when the XMPP bridge is down.
+# v4.6 - Replies carry the correlation ID of the command they answer so the
+#       XMPP bridge can trace command latency.
 # v4.5 - Made disk space usage messages easier to read by adding space used
 #       and total space available.
 #        - Made memory usage messages easier to understand, too.
@@ -60,19 +143,35 @@
 
 # Load modules.
 import argparse
+import atexit
 import configparser
 import json
 import logging
 import os
 import psutil
 import requests
+import signal
 import sys
+import threading
 import time
 
+import alerts
+import anomaly
+import cgroups
+import exporter
+import fleet
 import globals
+import instrumentation
+import logwatch
+import openwrt
+import outbox
 import parser
 import processes
+import probes
+import public_ip
+import scheduler
 import system_stats
+import timeseries
 
 # Global variables.
 # Handle to an argument parser object.
@@ -96,6 +195,23 @@ bot_name = ""
 # A list of processes on the system to monitor.  Can be empty.
 processes_to_monitor = []
 
+# What to do when a process the bot has restarted exits again: "always"
+# restart it, or only restart it "on-failure" (non-zero exit status).  The
+# first restart is immediate, after that the bot waits twice as long each
+# time, between restart_backoff and maximum_restart_backoff seconds.  If a
+# process is restarted more than crash_loop_restarts times in
+# crash_loop_window seconds, the bot gives up on it and tells the user.
+restart_policy = "always"
+restart_backoff = 1
+maximum_restart_backoff = 300
+crash_loop_restarts = 5
+crash_loop_window = 600
+
+# Number of seconds between measurements of how much CPU time each process is
+# using.  The "top processes" command reports the busiest processes as of the
+# last measurement.
+cpu_sample_interval = 5
+
 # URL of the message queue to pull orders from.
 message_queue = ""
 
@@ -103,7 +219,7 @@ message_queue = ""
 config_log = ""
 
 # Number of seconds in between pings to the message queue.
-polling_time = 0
+polling_time = 10
 
 # Time (in seconds) between polling the various status markers.  This should be
 # a fraction of the message queue poll time, perhaps 20-25%, with a hardwired
@@ -121,14 +237,10 @@ maximum_length = 0
 # Configuration for the logger.
 loglevel = None
 
-# Used to determine when to poll the message queue.
-loop_counter = 0
-
-# Handle to a requests object.
-request = None
-
-# Command from the message queue.
-command = ""
+# Correlation ID of the command being handled by this thread, if any.  Sent
+# back with replies so the XMPP bridge can trace them.  None for unsolicited
+# messages (alerts).
+current_command = threading.local()
 
 # Multiple of polling_time that must pass between sending alerts.  Defaults to
 # 3600 seconds (one hour).
@@ -140,27 +252,127 @@ disk_usage = 90.0
 # Percentage of memory remaining to consider critical.  Defaults to 15%.
 memory_remaining = 15.0
 
-# Counters used to keep the bot from sending alerts too often.
-sysload_counter = 0
-cpu_idle_time_counter = 0
-disk_usage_counter = 0
-memory_utilization_counter = 0
-memory_free_counter = 0
-temperature_counter = 0
-
-# List of dead processes on the system.  If it's ever populated something died
-# and needs attended to.
-dead_processes = None
-
-# URL of web service that just returns the IP address of the host.
+# Percentage of a network interface's link speed to consider saturated.
+# Defaults to 90%.
+link_saturation = 90.0
+
+# Percentage of inodes used to consider critical, percentage of the time a
+# disk can be busy before it's considered saturated, and the average number
+# of milliseconds a disk operation can take before the disk is considered too
+# slow.  Default to 90%, 90%, and one second.
+inode_usage = 90.0
+disk_utilization = 90.0
+disk_await = 1000.0
+
+# How many megabytes of memory and how many file descriptors a monitored
+# process can steadily gain per hour before it's considered to be leaking
+# them.  Default to 50 MB and 100 file descriptors an hour.
+memory_leak_rate = 50.0
+fd_leak_rate = 100.0
+
+# Cgroups to monitor (paths in the cgroup filesystem or names of systemd
+# units), separated by commas, and where the cgroup v2 filesystem is mounted.
+cgroups_to_monitor = ""
+cgroup_root = "/sys/fs/cgroup"
+
+# Percentage of its memory limit a cgroup can use, percentage of the time it
+# can spend stalled waiting for memory, and percentage of its scheduling
+# periods it can be throttled in before the user hears about it.  Default to
+# 90%, 10%, and 25%.
+cgroup_memory_usage = 90.0
+cgroup_memory_pressure = 10.0
+cgroup_throttling = 25.0
+
+# Alert rules (alerts.Rule): the built-in ones, changed or added to by any
+# [alert:<name>] sections of the configuration file.
+alert_rules = []
+
+# Log rules (logwatch.LogRule), one for each [log:<name>] section of the
+# configuration file.
+log_rules = []
+
+# Service probes (probes.Probe), one for each [probe:<name>] section of the
+# configuration file.
+service_probes = []
+
+# Number of seconds between probing the services (defaults to how often the
+# system is checked), number of seconds each probe waits for an answer (each
+# [probe:<name>] section can have its own), and number of milliseconds
+# slower than usual a service has to get before the user hears about it.
+probe_interval = 0.0
+probe_timeout = 5.0
+probe_slowdown = 100.0
+
+# URLs of web services that just return the IP address of the host, separated
+# by commas.
 ip_addr_web_service = ""
 
+# Number of seconds to wait for the IP address services to answer, and number
+# of seconds an answer is good for.  The public IP address is looked up again
+# in the background every ip_addr_ttl seconds, and the user is told if it's
+# changed.
+ip_addr_timeout = 5.0
+ip_addr_ttl = 300.0
+
+# IP version (4 or 6) to ask the IP address services over, so their answers
+# can be compared.
+ip_addr_family = 4
+
+# Path to the file messages waiting to be sent to the XMPP bridge are kept in,
+# and the maximum number of messages it'll hold.  The outbox file defaults to
+# <bot_name>.outbox.
+outbox_file = ""
+outbox_size = 1000
+
+# Path to the file per-command statistics are kept in.  Defaults to
+# <bot_name>.metrics.
+metrics_file = ""
+
+# Path to the directory the history of the system stats is kept in.  Defaults
+# to <bot_name>.history.  The most stats to keep a history of, and how many
+# days a stat can go without being seen before its history is deleted.
+history_dir = ""
+history_metrics = 200
+history_expiry = 30
+
+# Address and port to serve the stats on for dashboards to scrape (see
+# exporter.py).  If the port is 0 they aren't served.
+exporter_address = "127.0.0.1"
+exporter_port = 0
+
+# Fleet mode.  If aggregator is the base URL of another bot, this one is an
+# agent: it only collects the system's stats and pushes them there.  If
+# fleet_port isn't 0 this bot is the aggregator, and takes pushes from agents
+# on fleet_address:fleet_port.  Agents and the aggregator have to agree on
+# fleet_key, if there is one (the aggregator has to have one unless it only
+# listens on localhost).  A host that hasn't pushed for fleet_timeout seconds
+# is considered unreachable (0 means three times however often it pushes).
+# The aggregator takes pushes from up to fleet_hosts hosts.
+aggregator = ""
+fleet_key = ""
+fleet_address = "127.0.0.1"
+fleet_port = 0
+fleet_timeout = 0.0
+fleet_hosts = 100
+
 # Hostname and port of the web server on the embedded device to monitor.  If
 # there is a constructed openwrt_url, then we know external monitoring mode
 # is on.
 openwrt_host = ""
 openwrt_port = 0
 
+# Number of seconds to wait for the OpenWRT device to answer, and number of
+# seconds to reuse its answers for (defaults to half of status_polling, so
+# each run of the main loop asks it for each thing at most once).
+openwrt_timeout = 5
+openwrt_cache_ttl = 0
+
+# OpenWRT devices to monitor at the same time (openwrt.Device), one for each
+# [openwrt:<name>] section of the configuration file.  If there are any, the
+# periodic checks are run against them instead of the system the bot is
+# running on.
+openwrt_devices = []
+
 # Functions.
 # set_loglevel(): Turn a string into a numerical value which Python's logging
 #   module can use because.
@@ -180,23 +392,21 @@ def set_loglevel(loglevel):
 
 # send_message_to_user(): Function that does the work of sending messages back
 # to the user by way of the XMPP bridge.  Takes one argument, the message to
-#   send to the user.  Returns a True or False which delineates whether or not
-#   it worked.
+#   send to the user.  The message goes into the outbox first, so if the XMPP
+#   bridge can't be reached right now it'll be sent later.  Returns a True or
+#   False which delineates whether or not it was sent right away.
 def send_message_to_user(message):
-    # Headers the XMPP bridge looks for for the message to be valid.
-    headers = {"Content-type": "application/json"}
-
     # Set up a hash table of stuff that is used to build the HTTP request to
     # the XMPP bridge.
     reply = {}
     reply["name"] = bot_name
     reply["reply"] = message
+    reply["id"] = getattr(current_command, "id", None)
 
-    # Send an HTTP request to the XMPP bridge containing the message for the
-    # user.
-    request = requests.put(server + "replies", headers=headers,
-        data=json.dumps(reply))
-    return
+    # Put the message into the outbox and try to send everything waiting in
+    # it to the XMPP bridge.
+    outbox.append(reply)
+    return outbox.flush()
 
 # online_help(): Function that returns text - online help - to the user.  Takes
 #   no arguments, returns a complex string.
@@ -215,26 +425,495 @@ def online_help():
 
     # Continue building the help message.
     message = message + """
-    I currently monitor system load, CPU idle time, disk utilization, and memory utilization.  The interactive commands I currently support are:
+    I currently monitor system load, CPU idle time, disk utilization, inode usage, disk I/O, memory utilization, network traffic, hardware temperatures, and the memory and CPU time cgroups use against their limits.  The interactive commands I currently support are:
 
     help - Display this online help.
     load/sysload/system load - Get current system load.
     uname/info/system info - Get system info.
     cpus/CPUs - Get number of CPUs in the system.
     disk/disk usage/storage - Enumerate disk devices on the system and amount of storage used.
+    disk io/io stats/iostat/io/inodes - What each disk is doing (operations and bytes per second, average wait, how busy it is) and how many inodes are used on each filesystem.
     memory/free memory/RAM/free ram - Amount of free memory.
     uptime - How long the system has been online, in days, hours, minutes, and seconds.
     IP address/public IP/IP addr/public IP address/addr - Current publically routable IP address of this host.
     IP/local IP/ local addr - Current (internal) IP of this host.
-    network traffic/traffic volume/network stats/traffic stats/traffic count - Bytes sent and received per network interface.
+    network traffic/traffic volume/network stats/traffic stats/traffic count - Bytes sent and received per network interface, and how fast.
     System temperature/system temp/temperature/temp/overheating/core temperature/core temp - Hardware temperature in Centigrade and Fahrenheit, if temperature sensors are enabled.
     top processes/busy processes/busiest processes - Top 5 busiest processes on the system.
+    process stats [<process>] - How much memory, CPU time, open files, and threads a monitored process is using and has used over the last day, and whether its memory use or open files have been growing.  On its own, lists the monitored processes.
+    hosts/fleet - The load, CPU idle time, and free memory of every host in the fleet, as of the last time they reported in.
+    <stat> on all hosts/fleet <stat> - A stat on every host in the fleet ("load on all hosts", "disk on all hosts").
+    services/probes/service status - Whether each service I probe answered the last time, and how long it took.
+    cgroups/containers [stats/usage] - How much memory, CPU time, and disk I/O each monitored cgroup is using, compared to its limits, and how often it's been throttled or stalled waiting for memory.
     date/time/local date/local time/datetime/local datetime - Current date and time.
+    stats/command stats/bot stats - How long each kind of command takes me and how much network traffic it causes.
+    history - List the stats I keep a history of.
+    history <stat> [[over the] last <n> minutes/hours/days] - Lowest, average, and highest value of a stat over the last hour (or n minutes/hours/days).  Stats whose names start with <stat> are included, so "history disk" covers every disk.
+    history <stat> from <time> to <time> - The same, between two times (3am, 3:15pm, 15:15).
+    history <stat> at <time> - The value of a stat around a particular time.
 
     All commands are case-insensitive.
     """
     return message
 
+# history_report(): Function that builds a message about the history of one
+#   or more stats over a span of time.  Takes one argument, a hash table
+#   from parser.parse_history().  Returns a string.
+def history_report(history):
+    if not history["metric"]:
+        names = timeseries.list_metrics()
+        if not names:
+            return "I haven't collected any stats yet."
+        return "I keep a history of these stats: " + ", ".join(names)
+
+    names = timeseries.find_metrics(history["metric"])
+    if not names:
+        return "I don't have a history of " + history["metric"] + ".  Send me \"history\" to see which stats I do have."
+
+    def when(timestamp):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+    message = "Between " + when(history["start"]) + " and " + when(history["end"]) + ":\n"
+    for name in names[0:10]:
+        summary = timeseries.query(name, history["start"], history["end"])
+        if not summary:
+            message = message + name + ": no samples.\n"
+            continue
+        message = message + name + ": lowest %.2f (%s), average %.2f, highest %.2f (%s), from %d samples at %d second resolution.\n" % (summary["min"], when(summary["min_time"]), summary["mean"], summary["max"], when(summary["max_time"]), summary["count"], summary["resolution"])
+    if len(names) > 10:
+        message = message + "...and " + str(len(names) - 10) + " more."
+    return message
+
+# handle_command(): Function that carries out a command from the user and
+#   sends the answer back.  Takes one argument, the parsed command.
+def handle_command(command):
+    # Measure what it costs to carry out the command.
+    if isinstance(command, dict):
+        instrumentation.start(command["type"])
+    else:
+        instrumentation.start(command)
+
+    # Whatever happens while carrying out the command, stop measuring it,
+    # or the next command's numbers will be wrong.
+    try:
+        # If the user is requesting online help...
+        if command == "help":
+            send_message_to_user(online_help())
+
+        # If the user is requesting system load...
+        if command == "load":
+            load = system_stats.sysload()
+            message = "The current system load is " + str(load["one_minute"]) + " on the one minute average and " + str(load["five_minute"]) + " on the five minute average."
+            send_message_to_user(message)
+
+        # Basic system information.
+        if command == "info":
+            info = system_stats.uname()
+            message = "System " + info["hostname"] + " in running kernel version " + info["version"] + " compiled by " + info["buildinfo"] + " on the " + info["arch"] + " processor architecture."
+            send_message_to_user(message)
+
+        # Number of CPUs on the system.
+        if command == "cpus":
+            info = system_stats.cpus()
+            message = "The system has " + str(info) + " CPUs available to it."
+            send_message_to_user(message)
+
+        # Disk usage.
+        if command == "disk":
+            info = system_stats.get_disk_usage()
+            message = "System disk space usage:\n"
+            for key in list(info.keys()):
+                # Start a message line.
+                message = message + "\t" + key + " - ("
+
+                # Get disk usage (in bytes) for this device.
+                space = system_stats.get_disk_space(key)
+
+                # Add the disk space used to the message.
+                message = message + system_stats.convert_bytes(space["used"]) + " / "
+
+                # Add the total disk space.
+                message = message + system_stats.convert_bytes(space["total"]) + ")"
+
+                # Finish the message.
+                # /home - (xGB out of yTB) z.0% in use.
+                message = message + " - " + str("%.2f" % info[key]) + "% in use.\n"
+            send_message_to_user(message)
+
+        # Disk I/O and inode usage.
+        if command == "disk io":
+            info = system_stats.disk_io()
+            if info is None:
+                message = "I can't monitor disk I/O in OpenWRT mode."
+            else:
+                (disk_io, inode_usage) = info
+                message = "Disk I/O:\n"
+                if not disk_io:
+                    message = message + "\tI don't have any measurements yet.\n"
+                for disk in sorted(disk_io):
+                    stats = disk_io[disk]
+                    # sda - 12.0 reads/s, 3.0 writes/s, 1.2 MB/s read,
+                    # 300 KB/s written, 4.5 ms average wait, 12.0% busy.
+                    message = message + "\t" + disk + " - "
+                    message = message + str(round(stats["reads"], 1)) + " reads/s, "
+                    message = message + str(round(stats["writes"], 1)) + " writes/s, "
+                    message = message + system_stats.convert_bytes(stats["read_bytes"]) + "/s read, "
+                    message = message + system_stats.convert_bytes(stats["write_bytes"]) + "/s written, "
+                    message = message + str(round(stats["await"], 1)) + " ms average wait, "
+                    message = message + str(round(stats["utilization"], 1)) + "% busy.\n"
+                message = message + "Inodes used:\n"
+                for mount_point in sorted(inode_usage):
+                    message = message + "\t" + mount_point + " - " + str("%.2f" % inode_usage[mount_point]) + "% in use.\n"
+            send_message_to_user(message)
+
+        # Whether the services being probed are answering.
+        if command == "services":
+            if not probes.probes:
+                message = "I'm not probing any services."
+            else:
+                message = "Services:\n"
+                for probe in probes.probes:
+                    message = message + "\t" + probe.name + " (" + probe.kind + " " + probe.target + ") - "
+                    if probe.name not in probes.results:
+                        message = message + "not probed yet.\n"
+                        continue
+                    (when, latency, error) = probes.results[probe.name]
+                    if error:
+                        message = message + "not answering: " + error
+                    else:
+                        message = message + "answered in " + str(round(latency, 1)) + " ms"
+                    message = message + ", " + str(int(time.time() - when)) + " seconds ago.\n"
+            send_message_to_user(message)
+
+        # What the monitored cgroups are using.
+        if command == "cgroups":
+            info = system_stats.cgroup_usage()
+            if info is None:
+                message = "I can't monitor cgroups in OpenWRT mode."
+            elif not cgroups.monitored:
+                message = "I'm not monitoring any cgroups."
+            else:
+                message = "Cgroups:\n"
+                for name in cgroups.monitored:
+                    if name not in info:
+                        message = message + "\t" + name + " - not running.\n"
+                        continue
+                    stats = info[name]
+                    # nginx.service - 120 MB / 512 MB (23.44%) memory, 0.0%
+                    # stalled for memory, 12.5% of a CPU / 50.0%, throttled in
+                    # 0.0% of periods, 1.2 KB/s read, 300 KB/s written.
+                    message = message + "\t" + name + " - " + system_stats.convert_bytes(stats["memory"])
+                    if stats["memory_limit"]:
+                        message = message + " / " + system_stats.convert_bytes(stats["memory_limit"]) + " (" + str("%.2f" % (stats["memory"] / stats["memory_limit"] * 100.0)) + "%)"
+                    message = message + " memory"
+                    if stats["memory_pressure"] is not None:
+                        message = message + ", " + str(stats["memory_pressure"]) + "% stalled for memory"
+                    if "cpu" in stats:
+                        message = message + ", " + str(round(stats["cpu"], 1)) + "% of a CPU"
+                        if stats["cpu_limit"]:
+                            message = message + " / " + str(round(stats["cpu_limit"], 1)) + "%"
+                        message = message + ", throttled in " + str(round(stats["throttled"], 1)) + "% of periods, "
+                        message = message + system_stats.convert_bytes(stats["read_bytes"]) + "/s read, "
+                        message = message + system_stats.convert_bytes(stats["write_bytes"]) + "/s written"
+                    message = message + ".\n"
+            send_message_to_user(message)
+
+        # Memory utilization.
+        if command == "memory":
+            info = system_stats.memory_utilization()
+            logging.debug("value of info: " + str(info))
+
+            # x GB / y GB (z%) memory in use.
+            message = system_stats.convert_bytes(info.used)
+            message = message + " / " + system_stats.convert_bytes(info.total)
+            message = message + " (" + str(info.percent) + "%) memory in use.  "
+
+            # a GB / y GB (b%)  free.
+            message = message + system_stats.convert_bytes(info.free + info.buffers + info.cached)
+            message = message + " / " + system_stats.convert_bytes(info.total)
+            message = message + " (" + str(100.0 - info.percent) + "%) free."
+            logging.debug("Value of message: " + str(message))
+            send_message_to_user(message)
+
+        # System uptime.
+        if command == "uptime":
+            info = system_stats.uptime()
+            message = "The system has been online for " + info + "."
+            send_message_to_user(message)
+
+        # Public IP address.
+        if command == "ip":
+            info = system_stats.current_ip_address()
+            if info:
+                message = "The system's current public IP address is " + info + "."
+            else:
+                message = "None of the services I ask for this system's public IP address are answering, and I don't know what it was last."
+            send_message_to_user(message)
+
+        # Local IP address.
+        if command == "local ip":
+            info = system_stats.local_ip_address()
+            message = "The system's local IP address is " + info + "."
+            send_message_to_user(message)
+
+        # Network traffic stats per interface.
+        if command == "traffic":
+            info = system_stats.network_traffic()
+            message = ""
+            if not info:
+                message = "I was unable to get network traffic statistics."
+            else:
+                for i in list(info.keys()):
+                    message = message + "Network interface " + i + ":\n"
+                    message = message + info[i]["sent"] + " sent.\n"
+                    message = message + info[i]["received"] + " received.\n"
+                    if "sending" in info[i]:
+                        message = message + "Sending " + info[i]["sending"] + ", receiving " + info[i]["receiving"] + ".\n"
+                    if "utilization" in info[i]:
+                        message = message + "Using " + info[i]["utilization"] + ".\n"
+                    if "peak_sent" in info[i] and "peak_received" in info[i]:
+                        message = message + "Busiest in the last day: " + info[i]["peak_sent"] + " sent, " + info[i]["peak_received"] + " received.\n"
+                    message = message + "\n"
+            send_message_to_user(message)
+
+        # System temperature.
+        if command == "temperature":
+            info = system_stats.get_hardware_temperatures()
+            message = ""
+            if not info:
+                message = "This system does not appear to have functioning temperature sensors.  This is common on virtual machines."
+            else:
+                for sensor in list(info.keys()):
+                    label = sensor
+                    for device in info[sensor]:
+                        # If the sensor has its own name, use that instead.
+                        if device[0]:
+                            label = device[0]
+
+                        # Skip buggy sensors that return negative
+                        # temperatures.
+                        if device[1] <= 0.0:
+                            continue
+
+                        message = message + "Temperature sensor " + label + ": " + str(device[1]) + " degrees Centigrade (" + str(system_stats.centigrade_to_fahrenheit(device[1])) + " degrees Fahrenheit)\n"
+            send_message_to_user(message)
+
+        # Busiest running processes.
+        if command == "processes":
+            info = processes.get_top_processes()
+
+            # Possible case: Everything was asleep the last time CPU
+            # usage was measured, so CPU utilization is 0.0 across the
+            # board, meaning there's an empty list.
+            if not info:
+                message = "Over the last few seconds, every process on the system has had a CPU utilization of 0.0.  Everything's looking quiet."
+            else:
+                message = "The busiest processes on the system are:\n\n"
+                for i in info:
+                    message = message + str(i["pid"]) + "\t" + i["name"] + "\t" + str(i["cpu_percent"]) + "%\n"
+            send_message_to_user(message)
+
+        # Local date and time?
+        if command == "datetime":
+            info = system_stats.local_datetime()
+            message = "The current date and time is: " + info
+            send_message_to_user(message)
+
+        # The bot's own per-command statistics.
+        if command == "stats":
+            message = "This is what carrying out each kind of command has cost me so far:\n\n"
+            message = message + instrumentation.report()
+            send_message_to_user(message)
+
+        # Fall-through.
+        # The history of a stat.
+        if isinstance(command, dict) and command["type"] == "history":
+            send_message_to_user(history_report(command))
+
+        # The resources a monitored process has been using.
+        if isinstance(command, dict) and command["type"] == "process stats":
+            send_message_to_user(process_report(command["name"]))
+
+        if isinstance(command, dict) and command["type"] == "fleet":
+            send_message_to_user(fleet_report(command["metric"]))
+
+        if command == "unknown":
+            message = "I didn't recognize that command."
+            send_message_to_user(message)
+    finally:
+        instrumentation.finish()
+
+# poll_message_queue(): Function that asks the message queue for the next
+#   command from the user.  Takes no arguments.  Returns a (command,
+#   correlation ID) tuple, or None if there isn't a command waiting (or the
+#   message queue couldn't be reached).
+def poll_message_queue():
+    try:
+        logger.debug("Contacting message queue: " + message_queue)
+        request = requests.get(message_queue)
+        logger.debug("Response from server: " + request.text)
+    except:
+        logger.warning("Connection attempt to message queue timed out or failed.  Going back to sleep to try again later.")
+        return None
+
+    # Test the HTTP response code.
+    if request.status_code != 200:
+        return None
+    logger.debug("Message queue " + bot_name + " found.")
+
+    # Extract the command.
+    command = json.loads(request.text)
+    logger.debug("Command from user: " + str(command))
+    if not command["command"]:
+        logger.debug("Empty command.")
+        return None
+    return (command["command"], command.get("id"))
+
+# command_worker(): Function that's run by a thread of its own to handle
+#   commands from the user, so they're answered no matter what the system
+#   checks are doing.  Polls the message queue every polling_time seconds,
+#   and when there's a command asks again straight away in case the user has
+#   sent more than one.  Takes no arguments.  Never returns.
+def command_worker():
+    while True:
+        command = poll_message_queue()
+        if not command:
+            time.sleep(float(polling_time))
+            continue
+
+        # Replies carry the correlation ID of the command they answer.
+        current_command.id = command[1]
+        try:
+            command = parser.parse_command(command[0])
+            logger.debug("Parsed command: " + str(command))
+            handle_command(command)
+        except Exception as e:
+            logger.exception("Unable to carry out command " + str(command) + ": " + str(e))
+            send_message_to_user("Something went wrong while I was carrying out that command: " + str(e))
+        finally:
+            current_command.id = None
+
+# check_system_health(): Function that checks the system runtime stats.  If
+#   anything is too far out of whack, an alert is sent via the XMPP bridge's
+#   response queue.  All of the stats come from the same snapshot of the
+#   system and every alert rule is checked against them, and whatever the
+#   rules turn up is sent as one message.  When there are several OpenWRT
+#   devices to monitor they're all checked at the same time, and that's one
+#   message, too.  Takes no arguments.
+def check_system_health():
+    if openwrt_devices:
+        system_stats.check_openwrt_devices(openwrt_devices,
+            send_message_to_user)
+    else:
+        system_stats.take_snapshot()
+        system_stats.check_system(send_message_to_user)
+
+# push_stats(): Function that collects the system's stats and pushes them to
+#   the aggregator, for agent mode.  Takes no arguments.
+def push_stats():
+    system_stats.take_snapshot()
+    fleet.push(system_stats.collect_metrics(), status_polling)
+
+# check_processes(): Function that looks for monitored processes which have
+#   died, restarts them, and tells the user.  Takes no arguments.
+def check_processes():
+    dead_processes = processes.check_process_list(processes_to_monitor)
+    if dead_processes:
+        message = "WARNING: The following monitored processes seem to have crashed:\n"
+        for i in dead_processes:
+            message = message + i[0] + "\n"
+        message = message + "I am now attempting to restart them."
+        send_message_to_user(message)
+        dead_processes = processes.restart_crashed_processes(dead_processes)
+
+    # At this point in the check, if there are any dead processes, they
+    # didn't restart and something went wrong.
+    if dead_processes:
+        message = "WARNING: The following crashed processes could not be restarted:\n"
+        for i in dead_processes:
+            message = message + i[0] + "\n"
+        message = message + "You need to log into the server and restart them manually."
+        send_message_to_user(message)
+
+# process_report(): Function that builds a message about the resources one
+#   or more monitored processes have been using: what they're using now,
+#   their lowest, average, and highest usage over the last day, and how fast
+#   their memory use and open files have been growing.  Takes one argument,
+#   the name of a monitored process (or part of one), or None to list them.
+#   Returns a string.
+def process_report(name):
+    if not processes_to_monitor:
+        return "I'm not monitoring any processes."
+    patterns = [i[0] for i in processes_to_monitor]
+    if not name:
+        return "I'm keeping track of these processes: " + ", ".join(patterns)
+
+    # Commands come in lowercase.
+    found = [i for i in patterns if i.lower() == name]
+    if not found:
+        found = [i for i in patterns if name in i.lower()]
+    if not found:
+        return "I'm not monitoring a process called " + name + ".  Send me \"process stats\" to see which ones I am."
+
+    now = time.time()
+    current = processes.last_resources
+    kinds = [("process_rss", "Memory", " MB"), ("process_cpu", "CPU", "%"),
+        ("process_fds", "Open files", ""), ("process_threads", "Threads", "")]
+    message = ""
+    for pattern in found:
+        message = message + pattern + ":\n"
+        if "process_rss:" + pattern not in current:
+            message = message + "\tIt isn't running right now.\n"
+        for (kind, label, unit) in kinds:
+            metric = kind + ":" + pattern
+            history = metric.lower().replace(" ", "_")
+            line = "\t" + label + ": "
+            if metric in current:
+                line = line + "%.2f%s now" % (current[metric], unit)
+            else:
+                line = line + "unknown now"
+            summary = timeseries.query(history, now - 86400, now)
+            if summary:
+                line = line + ", lowest %.2f%s, average %.2f%s, highest %.2f%s over the last day" % (summary["min"], unit, summary["mean"], unit, summary["max"], unit)
+
+            # Only memory and open files leak.
+            if kind in ("process_rss", "process_fds"):
+                fit = anomaly.trend([(i[0], i[2]) for i in timeseries.buckets(history,
+                    alerts.slope_resolution, now - 6 * 3600, now)])
+                if fit and fit[1] >= alerts.steady_growth:
+                    line = line + ", changing by %.2f%s an hour over the last six hours" % (fit[0] * 3600.0, unit)
+            message = message + line + ".\n"
+    return message
+
+# fleet_report(): Function that builds a message about a stat on every host
+#   in the fleet, from the stats they last pushed.  Takes one argument, the
+#   start of the names of the stats to report ("load" covers load, load5, and
+#   load15), or None to sum up every host.  Returns a string.
+def fleet_report(metric):
+    if not fleet_port:
+        return "I'm not collecting stats from any other hosts.  Set fleet_port to turn that on."
+    found = fleet.report(metric)
+    if len(found) < 2:
+        return "No other hosts have reported in yet."
+
+    if metric:
+        message = metric + " on all hosts:\n"
+    else:
+        message = "Hosts:\n"
+    for (host, age, stale, metrics) in found:
+        # host1 - load 0.52, load5 0.48, load15 0.4 (12 seconds ago).
+        message = message + "\t" + host + " - "
+        if stale:
+            message = message + "hasn't reported in for " + str(int(age)) + " seconds.\n"
+            continue
+        if not metrics:
+            message = message + "no such stat"
+        message = message + ", ".join(i + " " + str(round(metrics[i], 2)) for i in sorted(metrics))
+        if age is not None:
+            message = message + " (" + str(int(age)) + " seconds ago)"
+        message = message + ".\n"
+    return message
+
 # Core code...
 # Allocate a command-line argument parser.
 argparser = argparse.ArgumentParser(description="A construct that monitors system statistics and sends alerts via the XMPP bridge in the event that things get too far out of whack.")
@@ -248,7 +927,7 @@ argparser.add_argument("--loglevel", action="store",
     help="Valid log levels: critical, error, warning, info, debug, notset.  Defaults to INFO.")
 
 # Time (in seconds) between polling the message queues.
-argparser.add_argument("--polling", action="store", help="Default: 60 seconds")
+argparser.add_argument("--polling", action="store", help="Default: 10 seconds")
 
 # Time (in seconds) in between sending warnings to the user.
 argparser.add_argument("--time-between-alerts", action="store",
@@ -268,8 +947,9 @@ if not os.path.exists(config_file):
     sys.exit(1)
 config.read(config_file)
 
-# Get the URL of the message queue to contact.
-server = config.get("DEFAULT", "queue")
+# Get the URL of the message queue to contact.  Agents (see aggregator) never
+# talk to it, so they don't need one.
+server = config.get("DEFAULT", "queue", fallback="")
 
 # Get the name of the message queue to report to.
 bot_name = config.get("DEFAULT", "bot_name")
@@ -299,6 +979,86 @@ disk_usage = float(config.get("DEFAULT", "disk_usage"))
 # Get the percentage of critical memory remaining from the config file.
 memory_remaining = float(config.get("DEFAULT", "memory_remaining"))
 
+# Get the percentage of a network link's speed to consider saturated.  This is
+# optional.
+try:
+    link_saturation = float(config.get("DEFAULT", "link_saturation"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the inode and disk I/O thresholds.  These are optional.
+try:
+    inode_usage = float(config.get("DEFAULT", "inode_usage"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    disk_utilization = float(config.get("DEFAULT", "disk_utilization"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    disk_await = float(config.get("DEFAULT", "disk_await"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    memory_leak_rate = float(config.get("DEFAULT", "memory_leak_rate"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fd_leak_rate = float(config.get("DEFAULT", "fd_leak_rate"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get how often to probe the services, how long to wait for them, and how
+# much slower they can get.  These are optional.
+try:
+    probe_interval = float(config.get("DEFAULT", "probe_interval"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    probe_timeout = float(config.get("DEFAULT", "probe_timeout"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    probe_slowdown = float(config.get("DEFAULT", "probe_slowdown"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the cgroups to monitor and their thresholds.  These are optional.
+try:
+    cgroups_to_monitor = config.get("DEFAULT", "cgroups")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    cgroup_root = config.get("DEFAULT", "cgroup_root")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    cgroup_memory_usage = float(config.get("DEFAULT", "cgroup_memory_usage"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    cgroup_memory_pressure = float(config.get("DEFAULT", "cgroup_memory_pressure"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    cgroup_throttling = float(config.get("DEFAULT", "cgroup_throttling"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
 # Get the number of standard deviations from the config file.
 standard_deviations = config.get("DEFAULT", "standard_deviations")
 
@@ -306,12 +1066,117 @@ standard_deviations = config.get("DEFAULT", "standard_deviations")
 minimum_length = config.get("DEFAULT", "minimum_length")
 maximum_length = config.get("DEFAULT", "maximum_length")
 
+# Get the path to the outbox file and the maximum number of messages it'll
+# hold.  These are optional.
+try:
+    outbox_file = config.get("DEFAULT", "outbox_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    outbox_size = int(config.get("DEFAULT", "outbox_size"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the path to the file per-command statistics are kept in.  This is
+# optional.
+try:
+    metrics_file = config.get("DEFAULT", "metrics_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the path to the directory the history of the system stats is kept in.
+# This is optional.
+try:
+    history_dir = config.get("DEFAULT", "history_dir")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    history_metrics = int(config.get("DEFAULT", "history_metrics"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    history_expiry = float(config.get("DEFAULT", "history_expiry"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    exporter_port = int(config.get("DEFAULT", "exporter_port"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    exporter_address = config.get("DEFAULT", "exporter_address")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the fleet mode settings.  These are optional.
+try:
+    aggregator = config.get("DEFAULT", "aggregator")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fleet_key = config.get("DEFAULT", "fleet_key", raw=True)
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fleet_address = config.get("DEFAULT", "fleet_address")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fleet_port = int(config.get("DEFAULT", "fleet_port"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fleet_timeout = float(config.get("DEFAULT", "fleet_timeout"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    fleet_hosts = int(config.get("DEFAULT", "fleet_hosts"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+if fleet_port and not fleet_key and not fleet.loopback(fleet_address):
+    logging.error("Taking pushes from agents on " + fleet_address + " needs a fleet_key, or anybody who can reach it can fill up the history.")
+    sys.exit(1)
+if aggregator and not fleet.host_name_format.match(bot_name):
+    logging.error("In agent mode bot_name is the name of the host, so it can only have letters, numbers, dots, dashes, and underscores in it.")
+    sys.exit(1)
+if not server and not aggregator:
+    logging.error("The configuration file needs a queue to contact.")
+    sys.exit(1)
+
 # Get the URL of the web service that just returns an IP address.
 try:
     ip_addr_web_service = config.get("DEFAULT", "ip_addr_site")
 except:
     logging.error("You need to specify a URL to a web service that only returns an IP address when you hit it.  There should be one in the configuration file.  If not, you might need a new copy of the config file because a directive is missing.")
     sys.exit(1)
+try:
+    ip_addr_timeout = float(config.get("DEFAULT", "ip_addr_timeout"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    ip_addr_ttl = float(config.get("DEFAULT", "ip_addr_ttl"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    ip_addr_family = config.get("DEFAULT", "ip_addr_family")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
 
 # Set the loglevel from the override on the command line.
 if args.loglevel:
@@ -330,8 +1195,11 @@ if args.time_between_alerts:
     time_between_alerts = int(args.time_between_alerts)
 
 # Calculate how often the bot checks the system stats.  This is how often the
-# main loop runs.
-status_polling = int(polling_time) / 4
+# main loop runs.  If polling_time isn't a number it's caught further down.
+try:
+    status_polling = float(polling_time) / 4
+except ValueError:
+    status_polling = 0
 
 # See if there's a list of processes to monitor in the configuration file, and
 # if so read it into the list.
@@ -340,6 +1208,41 @@ if config.has_section("processes to monitor"):
         if "process" in i:
             processes_to_monitor.append(config.get("processes to monitor", i).split(','))
 
+# Get the settings for restarting monitored processes.  These are optional.
+try:
+    restart_policy = config.get("DEFAULT", "restart_policy").lower()
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    restart_backoff = float(config.get("DEFAULT", "restart_backoff"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    maximum_restart_backoff = float(config.get("DEFAULT",
+        "maximum_restart_backoff"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    crash_loop_restarts = int(config.get("DEFAULT", "crash_loop_restarts"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    crash_loop_window = float(config.get("DEFAULT", "crash_loop_window"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get how often to measure the CPU usage of every process.  This is optional.
+try:
+    cpu_sample_interval = float(config.get("DEFAULT", "cpu_sample_interval"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
 # See if the bot is configured for remote monitoring mode of embedded devices.
 if config.has_section("openwrt"):
     logging.debug("Detected remote monitoring of OpenWRT devices mode.")
@@ -357,6 +1260,184 @@ if config.has_section("openwrt"):
 
     globals.openwrt_url = "http://" + openwrt_host + ":" + openwrt_port
 
+    try:
+        openwrt_timeout = float(config.get("openwrt", "openwrt_timeout"))
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+    try:
+        openwrt_cache_ttl = float(config.get("openwrt", "openwrt_cache_ttl"))
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+
+# See if the bot is configured to monitor more than one OpenWRT device.  Each
+# one has its own [openwrt:<name>] section.
+for section in config.sections():
+    if not section.startswith("openwrt:"):
+        continue
+    name = section.split(":", 1)[1].strip()
+    try:
+        host = config.get(section, "openwrt_host")
+        port = config.get(section, "openwrt_port")
+    except:
+        logging.error("OpenWRT device " + name + " needs both openwrt_host and openwrt_port set.")
+        sys.exit(1)
+    try:
+        device_timeout = float(config.get(section, "openwrt_timeout"))
+    except:
+        device_timeout = None
+    openwrt_devices.append(openwrt.Device(name, "http://" + host + ":" + port,
+        device_timeout))
+
+# Set up the built-in alert rules, then see if the configuration file changes
+# any of them or adds more.  Each one has its own [alert:<name>] section;
+# giving one the name of a built-in rule replaces it, and "enabled = no"
+# turns it off.
+alert_rules = alerts.default_rules(time_between_alerts, disk_usage,
+    memory_remaining, standard_deviations, minimum_length, maximum_length,
+    link_saturation, inode_usage, disk_utilization, disk_await,
+    memory_leak_rate, fd_leak_rate, cgroup_memory_usage,
+    cgroup_memory_pressure, cgroup_throttling, probe_slowdown)
+for section in config.sections():
+    if not section.startswith("alert:"):
+        continue
+    name = section.split(":", 1)[1].strip()
+    alert_rules = [i for i in alert_rules if i.name != name]
+    try:
+        if not config.getboolean(section, "enabled"):
+            continue
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+
+    rule = {"clear": None, "cooldown": time_between_alerts, "message": "",
+        "clear_message": "", "minimum_samples": minimum_length,
+        "window": int(maximum_length) - 1, "supersedes": None,
+        "seasonal": False, "minimum_change": 0.0}
+    for i in list(rule.keys()):
+        try:
+            rule[i] = config.get(section, i)
+        except:
+            # Nothing to do here, it's an optional configuration setting.
+            pass
+    condition = [i for i in alerts.conditions if config.has_option(section, i)]
+    if not config.has_option(section, "metric") or len(condition) != 1:
+        logging.error("Alert rule " + name + " needs a metric and one of " + ", ".join(alerts.conditions) + ".")
+        sys.exit(1)
+    try:
+        alert_rules.append(alerts.Rule(name, config.get(section, "metric"),
+            condition[0], config.get(section, condition[0]), **rule))
+    except Exception as e:
+        logging.error("Alert rule " + name + " doesn't make sense: " + str(e))
+        sys.exit(1)
+
+# Log rules come from [log:<name>] sections.  Each one gets an alert rule
+# that fires when lines match it, so it has a cooldown like any other alert.
+# Patterns are read as-is, so regular expressions don't need their percent
+# signs doubled.
+for section in config.sections():
+    if not section.startswith("log:"):
+        continue
+    name = section.split(":", 1)[1].strip()
+    try:
+        if not config.getboolean(section, "enabled"):
+            continue
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+
+    if not config.has_option(section, "files") or not config.has_option(section, "pattern"):
+        logging.error("Log rule " + name + " needs files and a pattern.")
+        sys.exit(1)
+    rule = {"cooldown": time_between_alerts,
+        "message": "WARNING: " + name + " in {file}: {line}",
+        "ignore_case": False}
+    for i in list(rule.keys()):
+        try:
+            rule[i] = config.get(section, i)
+        except:
+            # Nothing to do here, it's an optional configuration setting.
+            pass
+    try:
+        log_rules.append(logwatch.LogRule(name, config.get(section, "files"),
+            config.get(section, "pattern", raw=True), rule["ignore_case"]))
+        alert_rules.append(alerts.Rule("log:" + name, "log_matches:" + name,
+            "above", 0.0, None, rule["cooldown"], rule["message"]))
+    except Exception as e:
+        logging.error("Log rule " + name + " doesn't make sense: " + str(e))
+        sys.exit(1)
+
+# Service probes come from [probe:<name>] sections.  probe_timeout can be set
+# for all of them in the [DEFAULT] section, or for each one.  A probe with a
+# latency setting also gets an alert rule that fires when the service takes
+# longer than that many milliseconds to answer.
+for section in config.sections():
+    if not section.startswith("probe:"):
+        continue
+    name = section.split(":", 1)[1].strip()
+    try:
+        if not config.getboolean(section, "enabled"):
+            continue
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+
+    if not config.has_option(section, "target"):
+        logging.error("Service probe " + name + " needs a target.")
+        sys.exit(1)
+    probe = {"type": None, "probe_timeout": probe_timeout, "send": "",
+        "expect": "", "status": None, "latency": None,
+        "cooldown": time_between_alerts,
+        "message": "WARNING: Service {instance} ({target}) took {value} ms to answer."}
+    for i in list(probe.keys()):
+        try:
+            probe[i] = config.get(section, i, raw=i in ["send", "expect"])
+        except:
+            # Nothing to do here, it's an optional configuration setting.
+            pass
+    try:
+        service_probes.append(probes.Probe(name, config.get(section, "target"),
+            probe["type"], probe["probe_timeout"],
+            probe["send"], probe["expect"], probe["status"]))
+        if probe["latency"]:
+            alert_rules.append(alerts.Rule("probe:" + name,
+                "probe_latency:" + name, "above", probe["latency"],
+                float(probe["latency"]) * 0.8, probe["cooldown"],
+                probe["message"], "Service {instance} is answering in {value} ms again."))
+    except Exception as e:
+        logging.error("Service probe " + name + " doesn't make sense: " + str(e))
+        sys.exit(1)
+if not probe_interval:
+    probe_interval = float(status_polling)
+
+# Everything the bot does periodically has to be done every so many seconds,
+# or it'll never do anything else.
+for (setting, value) in [("polling_time", polling_time),
+    ("ip_addr_ttl", ip_addr_ttl), ("probe_interval", probe_interval),
+    ("cpu_sample_interval", cpu_sample_interval)]:
+    try:
+        if float(value) > 0:
+            continue
+    except ValueError:
+        pass
+    logging.error(setting + " has to be a number of seconds greater than 0, not " + str(value) + ".")
+    sys.exit(1)
+
+# How long to reuse answers from OpenWRT devices applies to all of them, so
+# with several devices it goes in the [DEFAULT] section.
+if openwrt_devices:
+    try:
+        openwrt_cache_ttl = float(config.get("DEFAULT", "openwrt_cache_ttl"))
+    except:
+        # Nothing to do here, it's an optional configuration setting.
+        pass
+
+if globals.openwrt_url or openwrt_devices:
+    if not openwrt_cache_ttl:
+        openwrt_cache_ttl = status_polling / 2
+    openwrt.configure(openwrt_timeout, openwrt_cache_ttl)
+
 # In debugging mode, dump the bot'd configuration.
 logger.info("Everything is configured.")
 logger.debug("Values of configuration variables as of right now:")
@@ -374,260 +1455,170 @@ else:
     logger.debug("Value of time_between_alerts (in seconds): " + str(time_between_alerts))
 logger.debug("Critical disk space usage: " + str(disk_usage))
 logger.debug("Critical memory remaining: " + str(memory_remaining))
-logger.debug("Value of loop_counter (in seconds): " + str(status_polling))
-logger.debug("URL of web service that returns public IP address: " + ip_addr_web_service)
+logger.debug("Saturated network link: " + str(link_saturation) + "%")
+logger.debug("Critical inode usage: " + str(inode_usage) + "%")
+logger.debug("Saturated disk: " + str(disk_utilization) + "% busy or " + str(disk_await) + " ms per operation")
+logger.debug("Leaking monitored process: " + str(memory_leak_rate) + " MB or " + str(fd_leak_rate) + " file descriptors more per hour")
+if cgroups_to_monitor:
+    logger.debug("Cgroups to monitor: " + cgroups_to_monitor + " (in " + cgroup_root + ")")
+    logger.debug("Cgroup limits: " + str(cgroup_memory_usage) + "% of memory, " + str(cgroup_memory_pressure) + "% stalled for memory, " + str(cgroup_throttling) + "% throttled")
+logger.debug("Alert rules: " + ", ".join(i.name for i in alert_rules))
+for i in service_probes:
+    logger.debug("Service probe " + i.name + ": " + i.kind + " " + i.target + ", " + str(i.timeout) + " second timeout")
+if service_probes:
+    logger.debug("Seconds between service probes: " + str(probe_interval))
+for i in log_rules:
+    logger.debug("Log rule " + i.name + ": " + i.pattern + " in " + ", ".join(i.paths))
+logger.debug("Seconds between system checks: " + str(status_polling))
+logger.debug("URLs of web services that return public IP address: " + ip_addr_web_service)
+logger.debug("Public IP address services timeout: " + str(ip_addr_timeout) + " seconds, answers good for " + str(ip_addr_ttl) + " seconds, asked over IPv" + str(ip_addr_family) + ".")
+logger.debug("Outbox file: " + outbox_file)
+logger.debug("Maximum number of messages in the outbox: " + str(outbox_size))
+logger.debug("Metrics file: " + str(metrics_file))
+logger.debug("History directory: " + str(history_dir))
+logger.debug("Keeping the history of up to " + str(history_metrics) + " stats, for " + str(history_expiry) + " days after they were last seen.")
+if exporter_port:
+    logger.debug("Serving stats on: " + exporter_address + ":" + str(exporter_port))
+if aggregator:
+    logger.debug("Agent mode: pushing stats to " + aggregator)
+if fleet_port:
+    logger.debug("Taking pushes from agents on: " + fleet_address + ":" + str(fleet_port))
 if len(processes_to_monitor):
     logger.debug("There are " + str(len(processes_to_monitor)) + " processes to watch over on the system.")
     for i in processes_to_monitor:
         print("    " + i[0])
+    logger.debug("Restart policy: " + restart_policy)
+    logger.debug("Restart backoff: " + str(restart_backoff) + " to " + str(maximum_restart_backoff) + " seconds.")
+    logger.debug("Crash loop: more than " + str(crash_loop_restarts) + " restarts in " + str(crash_loop_window) + " seconds.")
+logger.debug("Seconds between CPU usage measurements: " + str(cpu_sample_interval))
 if globals.openwrt_url:
     logging.debug("OpenWRT remote monitoring mode active.")
     logger.debug("URL of OpenWRT remote monitoring server: " + globals.openwrt_url)
+    logger.debug("OpenWRT request timeout: " + str(openwrt_timeout) + " seconds.")
+    logger.debug("OpenWRT responses reused for: " + str(openwrt_cache_ttl) + " seconds.")
+if openwrt_devices:
+    logger.debug("Monitoring " + str(len(openwrt_devices)) + " OpenWRT devices:")
+    for i in openwrt_devices:
+        logger.debug("    " + i.name + ": " + i.url)
+
+# In agent mode all the bot does is collect the system's stats and push them
+# to the aggregator, which keeps their history and decides what the user
+# hears about.  There's no XMPP bridge, no commands, no alerts, and nothing
+# kept on disk.
+if aggregator:
+    cgroups.configure(cgroups_to_monitor, cgroup_root)
+    processes.track_resources(processes_to_monitor)
+    fleet.configure_agent(aggregator, bot_name, fleet_key)
+    jobs = scheduler.Scheduler()
+    jobs.every("fleet push", float(status_polling), push_stats)
+    logger.info("Agent mode: pushing stats to " + aggregator + " every " + str(status_polling) + " seconds.")
+    jobs.run()
+    sys.exit(0)
+
+# Set up the outbox.  Anything left in it from the last time the bot ran will
+# be sent along with the first message.
+if not outbox_file:
+    outbox_file = bot_name + ".outbox"
+outbox.configure(server, outbox_file, outbox_size)
+
+# Load the per-command statistics from the last time the bot ran.
+if not metrics_file:
+    metrics_file = bot_name + ".metrics"
+instrumentation.configure(metrics_file)
+
+# Set up the alert rules.
+alerts.configure(alert_rules, time_between_alerts != 0)
+
+# Load the history of the system stats.  Whatever hasn't been written to disk
+# yet is when the bot shuts down, including when it's told to by the init
+# system.
+if not history_dir:
+    history_dir = bot_name + ".history"
+timeseries.configure(history_dir, history_metrics, history_expiry)
+atexit.register(timeseries.flush)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# Start watching the log files.
+logwatch.configure(log_rules)
+
+# Set up the cgroups to monitor.
+cgroups.configure(cgroups_to_monitor, cgroup_root)
+
+# Set up the service probes.
+probes.configure(service_probes)
+
+# Set up the services the public IP address is looked up with.  If it
+# changes, the user hears about it.
+try:
+    public_ip.configure(ip_addr_web_service, ip_addr_timeout, ip_addr_ttl,
+        lambda old, new: send_message_to_user("The system's public IP address has changed from " + old + " to " + new + "."),
+        ip_addr_family)
+except ValueError as e:
+    logging.error(str(e))
+    sys.exit(1)
 
-# Try to contact the XMPP bridge.  Keep trying until you reach it or the
-# system shuts down.
-logger.info("Trying to contact XMPP message bridge...")
-while True:
-    try:
-        send_message_to_user(bot_name + " now online.")
-        break
-    except:
-        logger.warning("Unable to reach message bus.  Going to try again in %s seconds." % polling_time)
-        time.sleep(float(polling_time))
-
-# Go into a loop in which the bot polls the configured message queue to see
-# if it has any HTTP requests waiting for it.
-logger.debug("Entering main loop to handle requests.")
-while True:
-
-    # Reset the command from the message bus, just in case.
-    command = ""
-
-    # Start checking the system runtime stats.  If anything is too far out of
-    # whack, send an alert via the XMPP bridge's response queue.
-    sysload_counter = system_stats.check_sysload(sysload_counter,
-        time_between_alerts, status_polling, standard_deviations,
-        minimum_length, maximum_length, send_message_to_user)
-    cpu_idle_time_counter = system_stats.check_cpu_idle_time(
-        cpu_idle_time_counter, time_between_alerts, status_polling,
-        send_message_to_user)
-    disk_usage_counter = system_stats.check_disk_usage(disk_usage_counter,
-        time_between_alerts, status_polling, disk_usage, send_message_to_user)
-    memory_free_counter = system_stats.check_memory_utilization(
-        memory_free_counter, time_between_alerts, status_polling,
-        memory_remaining, send_message_to_user)
-    temperature_counter = system_stats.check_hardware_temperatures(
-        temperature_counter, time_between_alerts, status_polling,
-        standard_deviations, minimum_length, maximum_length,
-        send_message_to_user)
-
-    # Increment loop_counter by status_polling.  Seems obvious, but this makes
-    # it easy to grep for.
-    loop_counter = loop_counter + status_polling
-
-    # If loop_counter is equal to polling_time, and there are any processes to
-    # monitor, look for them.
-    if int(loop_counter) >= int(polling_time) and processes_to_monitor:
-        dead_processes = processes.check_process_list(processes_to_monitor)
-        if dead_processes:
-            message = "WARNING: The following monitored processes seem to have crashed:\n"
-            for i in dead_processes:
-                message = message + i[0] + "\n"
-            message = message + "I am now attempting to restart them."
-            send_message_to_user(message)
-            dead_processes = processes.restart_crashed_processes(dead_processes)
-
-        # At this point in the check, if there are any dead processes, they
-        # didn't restart and something went wrong.
-        if dead_processes:
-            message = "WARNING: The following crashed processes could not be restarted:\n"
-            for i in dead_processes:
-                message = message + i[0] + "\n"
-            message = message + "You need to log into the server and restart them manually."
-            send_message_to_user(message)
+# Serve the stats for dashboards to scrape, if asked to.
+if exporter_port:
+    exporter.start(exporter_address, exporter_port)
 
-    # If loop_counter is equal to polling_time, check the message queue for
-    # commands.
-    if int(loop_counter) >= int(polling_time):
-        try:
-            logger.debug("Contacting message queue: " + message_queue)
-            request = requests.get(message_queue)
-            logger.debug("Response from server: " + request.text)
-        except:
-            logger.warn("Connection attempt to message queue timed out or failed.  Going back to sleep to try again later.")
-            time.sleep(float(status_polling))
-            continue
+# Take pushes from agents, if this bot is the aggregator.
+if fleet_port:
+    fleet.start(fleet_address, fleet_port, bot_name, fleet_key, fleet_timeout,
+        fleet_hosts)
 
-        # Test the HTTP response code.
-        # Success.
-        if request.status_code == 200:
-            logger.debug("Message queue " + bot_name + " found.")
-
-            # Extract the command.
-            command = json.loads(request.text)
-            logger.debug("Command from user: " + str(command))
-            command = command["command"]
-            if not command:
-                logger.debug("Empty command.")
-                logger.debug("Resetting loop_counter.")
-                loop_counter = 0
-                time.sleep(float(polling_time))
-                continue
-
-            # Parse the command.
-            command = parser.parse_command(command)
-            logger.debug("Parsed command: " + str(command))
+# Set up supervision of the processes the bot restarts.
+processes.configure_supervisor(send_message_to_user, restart_policy,
+    restart_backoff, maximum_restart_backoff, crash_loop_restarts,
+    crash_loop_window)
 
-            # If the user is requesting online help...
-            if command == "help":
-                send_message_to_user(online_help())
-
-            # If the user is requesting system load...
-            if command == "load":
-                load = system_stats.sysload()
-                message = "The current system load is " + str(load["one_minute"]) + " on the one minute average and " + str(load["five_minute"]) + " on the five minute average."
-                send_message_to_user(message)
-
-            # Basic system information.
-            if command == "info":
-                info = system_stats.uname()
-                message = "System " + info["hostname"] + " in running kernel version " + info["version"] + " compiled by " + info["buildinfo"] + " on the " + info["arch"] + " processor architecture."
-                send_message_to_user(message)
-
-            # Number of CPUs on the system.
-            if command == "cpus":
-                info = system_stats.cpus()
-                message = "The system has " + str(info) + " CPUs available to it."
-                send_message_to_user(message)
-
-            # Disk usage.
-            if command == "disk":
-                info = system_stats.get_disk_usage()
-                message = "System disk space usage:\n"
-                for key in list(info.keys()):
-                    # Start a message line.
-                    message = message + "\t" + key + " - ("
-
-                    # Get disk usage (in bytes) for this device.
-                    space = system_stats.get_disk_space(key)
-
-                    # Add the disk space used to the message.
-                    message = message + system_stats.convert_bytes(space["used"]) + " / "
-
-                    # Add the total disk space.
-                    message = message + system_stats.convert_bytes(space["total"]) + ")"
-
-                    # Finish the message.
-                    # /home - (xGB out of yTB) z.0% in use.
-                    message = message + " - " + str("%.2f" % info[key]) + "% in use.\n"
-                send_message_to_user(message)
-
-            # Memory utilization.
-            if command == "memory":
-                info = system_stats.memory_utilization()
-                logging.debug("value of info: " + str(info))
-
-                # x GB / y GB (z%) memory in use.
-                message = system_stats.convert_bytes(info.used)
-                message = message + " / " + system_stats.convert_bytes(info.total)
-                message = message + " (" + str(info.percent) + "%) memory in use.  "
-
-                # a GB / y GB (b%)  free.
-                message = message + system_stats.convert_bytes(info.free + info.buffers + info.cached)
-                message = message + " / " + system_stats.convert_bytes(info.total)
-                message = message + " (" + str(100.0 - info.percent) + "%) free."
-                logging.debug("Value of message: " + str(message))
-                send_message_to_user(message)
-
-            # System uptime.
-            if command == "uptime":
-                info = system_stats.uptime()
-                message = "The system has been online for " + info + "."
-                send_message_to_user(message)
-
-            # Public IP address.
-            if command == "ip":
-                info = system_stats.current_ip_address(ip_addr_web_service)
-                message = "The system's current public IP address is " + info + "."
-                send_message_to_user(message)
-
-            # Local IP address.
-            if command == "local ip":
-                info = system_stats.local_ip_address()
-                message = "The system's local IP address is " + info + "."
-                send_message_to_user(message)
-
-            # Network traffic stats per interface.
-            if command == "traffic":
-                info = system_stats.network_traffic()
-                message = ""
-                if not info:
-                    message = "I was unable to get network traffic statistics."
-                else:
-                    for i in list(info.keys()):
-                        message = message + "Network interface " + i + ":\n"
-                        message = message + info[i]["sent"] + " sent.\n"
-                        message = message + info[i]["received"] + " received.\n"
-                        message = message + "\n"
-                send_message_to_user(message)
-
-            # System temperature.
-            if command == "temperature":
-                info = system_stats.get_hardware_temperatures()
-                message = ""
-                if not info:
-                    message = "This system does not appear to have functioning temperature sensors.  This is common on virtual machines."
-                else:
-                    for sensor in list(info.keys()):
-                        label = sensor
-                        for device in info[sensor]:
-                            # If the sensor has its own name, use that instead.
-                            if device[0]:
-                                label = device[0]
-
-                            # Skip buggy sensors that return negative
-                            # temperatures.
-                            if device[1] <= 0.0:
-                                continue
-
-                            message = message + "Temperature sensor " + label + ": " + str(device[1]) + " degrees Centigrade (" + str(system_stats.centigrade_to_fahrenheit(device[1])) + " degrees Fahrenheit)\n"
-                send_message_to_user(message)
-
-            # Busiest running processes.
-            if command == "processes":
-                info = processes.get_top_processes()
-
-                # Possible case: The CPU usage snapshot is taken when
-                # everything is asleep, so CPU utilization is 0.0 across the
-                # board, meaning there's an empty list.
-                if not info:
-                    message = "At this nanosecond, every process on the system has a CPU utilization of 0.0.  Everything's looking quiet."
-                else:
-                    message = "The busiest processes on the system are:\n\n"
-                    for i in info:
-                        message = message + str(i["pid"]) + "\t" + i["name"] + "\t" + str(i["cpu_percent"]) + "%\n"
-                send_message_to_user(message)
-
-            # Local date and time?
-            if command == "datetime":
-                info = system_stats.local_datetime()
-                message = "The current date and time is: " + info
-                send_message_to_user(message)
-
-            # Fall-through.
-            if command == "unknown":
-                message = "I didn't recognize that command."
-                send_message_to_user(message)
-
-        # NOTE: We don't short-circuit all of the above checks with the
-        # continue statement because we want the loop to fall down here every
-        # time it runs to...
-        # Reset loop counter.
-        logger.debug("Resetting loop_counter.")
-        loop_counter = 0
-
-    # Bottom of loop.  Go to sleep for a while before running again.
-    time.sleep(float(status_polling))
+# Start measuring how busy each process is, and keep track of the resources
+# the monitored processes are using.
+processes.start_cpu_sampler(cpu_sample_interval)
+processes.track_resources(processes_to_monitor)
+
+# Tell the user the bot is online.  If the XMPP bridge can't be reached yet
+# the message waits in the outbox, and the bot gets on with monitoring the
+# system in the meantime.
+logger.info("Trying to contact XMPP message bridge...")
+if not send_message_to_user(bot_name + " now online."):
+    logger.warning("Unable to reach message bus.  Messages will wait in the outbox until it comes back.")
+
+# Handle commands from the user on a thread of their own, so they're
+# answered straight away even while the system checks are running.
+logger.debug("Starting the command handler.")
+threading.Thread(target=command_worker, name="commands", daemon=True).start()
+
+# Run the periodic jobs, each on its own schedule: the system checks every
+# status_polling seconds, the process watchdog every polling_time seconds,
+# anything still waiting in the outbox (it backs off on its own if the XMPP
+# bridge is still down) every polling_time seconds, the public IP address
+# every ip_addr_ttl seconds, the log files every status_polling seconds, and
+# the service probes every probe_interval seconds (the public IP address and
+# the probes on threads of their own, so a web service that's slow to answer
+# doesn't hold up the system checks), the stats agents have
+# pushed every status_polling seconds, and stats that haven't been seen for
+# too long are forgotten every hour.
+jobs = scheduler.Scheduler()
+jobs.every("system checks", float(status_polling), check_system_health)
+if processes_to_monitor:
+    jobs.every("process watchdog", float(polling_time), check_processes,
+        delay=float(polling_time))
+jobs.every("outbox", float(polling_time), outbox.flush,
+    delay=float(polling_time))
+jobs.every("public ip", ip_addr_ttl, public_ip.refresh, background=True)
+if log_rules:
+    jobs.every("log files", float(status_polling),
+        lambda: system_stats.check_logs(send_message_to_user))
+if service_probes:
+    jobs.every("service probes", probe_interval, probes.check,
+        background=True,
+        then=lambda results: system_stats.check_probes(send_message_to_user, results))
+if fleet_port:
+    jobs.every("fleet", float(status_polling),
+        lambda: system_stats.check_fleet(send_message_to_user))
+jobs.every("history", 3600.0, timeseries.prune, delay=3600.0)
+logger.debug("Entering main loop to run periodic jobs.")
+jobs.run()
 
 # Fin.
 sys.exit(0)
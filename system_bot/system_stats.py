@@ -10,6 +10,54 @@
 
 # License: GPLv3
 
+# v4.22 - Hosts in the fleet that have stopped reporting in are rolled up by
+#       the name of the rule, like OpenWRT devices.
+# v4.21 - check_probes() can be handed the results of probes that have
+#       already run.
+# v4.20 - network_rates() uses time.monotonic(), so the clock being set
+#       doesn't throw the traffic rates off.
+# v4.19 - Unreachable OpenWRT devices are rolled up by the name of the rule,
+#       not its message, so [alert:unreachable] can change the message.
+# v4.18 - Added check_fleet(), which checks the stats agents have pushed to
+#       this bot.  check_system() hands its stats to fleet.py so they can be
+#       compared with the rest of the fleet.
+# v4.17 - Added check_probes(), which probes the services being monitored.
+# v4.16 - collect_metrics() also gathers what the monitored cgroups are using
+#       compared to their limits, and added cgroup_usage().
+# v4.15 - Added check_logs(), which looks for log lines that match the log
+#       rules.
+# v4.14 - current_ip_address() uses public_ip.py, which caches the address
+#       and asks several services at once.
+# v4.13 - collect_metrics() also gathers how much memory, CPU time, file
+#       descriptors, and threads each monitored process is using.
+# v4.12 - The stats the checks collect are handed to exporter.py, so they
+#       can be scraped.
+# v4.11 - collect_metrics() also gathers inode usage and disk I/O from the
+#       snapshot, and disk_io() reports them.
+# v4.10 - network_rates() also works out packets per second and how much of
+#       each link's speed is in use, and network_traffic() reports how fast
+#       each interface is sending and receiving now and at its busiest over
+#       the last day.
+# v4.9 - The periodic checks are replaced by collect_metrics(), which gathers
+#       every stat into one hash table, and the alert rules in alerts.py,
+#       which decide what the user hears about.  check_system() and
+#       check_openwrt_devices() send everything from one pass as one message.
+#       record_network_traffic() is now network_rates().
+# v4.8 - The periodic checks can be run against any number of OpenWRT devices
+#       at once, each with its own windows and alert counters, and everything
+#       they find is sent as one message.
+# v4.7 - The periodic checks skip a run if the OpenWRT device couldn't be
+#       reached instead of treating the error values as stats.
+# v4.6 - The periodic checks all work from one snapshot of /proc taken at the
+#       start of each run of the main loop (see procfs.py) instead of each
+#       making their own calls.
+# v4.5 - Every stat the checks collect is added to the history kept by
+#       timeseries.py.  Added record_network_traffic() so that network traffic
+#       goes into the history as well.
+# v4.4 - Replaced the running lists of system load averages and device
+#       temperatures with ring buffers that keep their standard deviations up
+#       to date as they go, so each check costs the same no matter how long
+#       the lists are.
 # v4.3 - Fixed a bug in Fahrenheit to Centigrade conversion.  Oops.
 #       - Added a utility function get_disk_space(), which returns the amount
 #       of disk space used by a mount point.
@@ -36,7 +84,7 @@
 # v1.0 - Initial release.
 
 # TO-DO:
-# - Optimize the temperature monitoring loop for the general case.
+# -
 
 # Load modules.
 import logging
@@ -44,26 +92,66 @@ import math
 import os
 import psutil
 import requests
-import statistics
 import sys
 import time
 
 from datetime import timedelta
 
+import alerts
+import exporter
+import fleet
 import globals
+import logwatch
 import openwrt
+import probes
+import processes
+import procfs
+import public_ip
+import timeseries
 
 # Variables global to this module.
-# Running lists of system averages.
-one_minute_average = []
-five_minute_average = []
-fifteen_minute_average = []
+# Snapshot of /proc the periodic checks work from.  Taken once per run of the
+# main loop by take_snapshot().
+snapshot = None
 
-# Running lists of device temperatures in case the drivers don't have a sense
-# of high or critical temperatures.
-device_temperatures = {}
+# Network traffic counters as of the last time network_rates() ran, and when
+# that was (time.monotonic()).
+previous_traffic = None
+previous_traffic_time = 0.0
+
+# Hash table of network interfaces to how fast they were sending and
+# receiving as of the last time network_rates() ran: bytes and packets per
+# second, and the percentage of the link speed in use (if it's known).
+current_traffic = {}
+
+# Hash table of network interfaces to link speeds in megabits per second (0
+# if unknown), and when they were last looked up.  They hardly ever change.
+link_speeds = {}
+link_speeds_time = 0.0
+
+# Metrics collect_metrics() gathers for the alert rules that aren't worth
+# keeping a history of.
+unrecorded = ("high_temperature:", "critical_temperature:")
 
 # Functions.
+# take_snapshot(): Function that reads everything the periodic checks need
+#   out of /proc in one go.  In OpenWRT mode there's nothing local to read.
+#   Takes no arguments.
+def take_snapshot():
+    global snapshot
+
+    if globals.openwrt_url:
+        snapshot = None
+        return
+    snapshot = procfs.take_snapshot()
+
+# current_snapshot(): Function that returns the snapshot the periodic checks
+#   should work from, taking one if there isn't one yet.
+def current_snapshot():
+    if snapshot is None:
+        take_snapshot()
+    return snapshot
+
 # sysload(): Function that takes a snapshot of the current system load
 #   averages.  Takes no arguments.  Returns system loads as a hash table.
 def sysload():
@@ -74,81 +162,251 @@ def sysload():
     sysload["fifteen_minute"] = system_load[2]
     return sysload
 
-# check_sysload: Function that pulls the current system load and tests the
-#   load averages to see if they're too high.  Takes seven arguments, the
-#   sysload counter, the time between alerts, the value of status_polling, the
-#   number of standard deviations to calculate, minimum and maximum system
-#   stat queue lengths, and the name of a function to send a message with.
-#   Sends a message to the user, returns an updated
-#   value for sysload_counter.
-def check_sysload(sysload_counter, time_between_alerts, status_polling,
-    std_devs, sys_avg_min_len, sys_avg_max_len, send_message_to_user):
+# collect_metrics(): Function that gathers every stat the alert rules and
+#   the history work from into one hash table: "load", "load5", "load15",
+#   "cpu_idle", "memory_free" (percent), "disk:<mount point>" and
+#   "inodes:<mount point>" (percent used), "io_reads:<disk>" and
+#   "io_writes:<disk>" (per second), "io_read_bytes:<disk>" and
+#   "io_write_bytes:<disk>" (per second), "io_await:<disk>" (milliseconds),
+#   "io_util:<disk>" (percent of the time busy),
+#   "temperature:<sensor>" (Centigrade), "high_temperature:<sensor>" and
+#   "critical_temperature:<sensor>" (what the driver considers too hot, if
+#   anything), and "sent:<interface>" and "received:<interface>" (bytes per
+#   second), and for each monitored process "process_rss:<process>"
+#   (megabytes), "process_cpu:<process>" (percent of a CPU),
+#   "process_fds:<process>", and "process_threads:<process>", and for each
+#   monitored cgroup "cgroup_memory:<cgroup>" (megabytes),
+#   "cgroup_memory_used:<cgroup>" (percent of memory.max, if it has a limit),
+#   "cgroup_memory_pressure:<cgroup>" (percent of the last ten seconds spent
+#   stalled waiting for memory), "cgroup_oom_kills:<cgroup>",
+#   "cgroup_cpu:<cgroup>" (percent of a CPU), "cgroup_cpu_used:<cgroup>"
+#   (percent of cpu.max, if it has a limit), "cgroup_throttled:<cgroup>"
+#   (percent of scheduling periods throttled in), and "cgroup_reads",
+#   "cgroup_writes", "cgroup_read_bytes", and "cgroup_write_bytes" (per
+#   second).  OpenWRT
+#   devices also get "reachable" (1.0 or 0.0), and if
+#   they can't be reached that's all they get.  Optionally takes an OpenWRT
+#   device (openwrt.Device) to collect from instead of the system the bot was
+#   configured for.  Returns a hash table of metric names to floating point
+#   values.
+def collect_metrics(device=None):
+    metrics = {}
+    openwrt_url = device.url if device else globals.openwrt_url
+    if openwrt_url:
+        return collect_openwrt_metrics(openwrt_url)
+
+    current = current_snapshot()
+    metrics["load"] = current.loadavg["one_minute"]
+    metrics["load5"] = current.loadavg["five_minute"]
+    metrics["load15"] = current.loadavg["fifteen_minute"]
+    metrics["cpu_idle"] = current.cpu_idle
+
+    memory_stats = current.memory
+    calculated_free_memory = memory_stats["free"] + memory_stats["buffers"] + memory_stats["cached"]
+    logging.debug("Calculated free memory: %s" % convert_bytes(calculated_free_memory))
+    if memory_stats["total"]:
+        metrics["memory_free"] = round(calculated_free_memory / memory_stats["total"] * 100.0, 2)
+
+    for disk in current.disk_usage:
+        metrics["disk:" + disk] = current.disk_usage[disk]
+    for disk in current.inode_usage:
+        metrics["inodes:" + disk] = current.inode_usage[disk]
+    for disk in current.disk_io:
+        for i in current.disk_io[disk]:
+            if i == "utilization":
+                metrics["io_util:" + disk] = current.disk_io[disk][i]
+            else:
+                metrics["io_" + i + ":" + disk] = current.disk_io[disk][i]
+
+    # Temperature readings take the form of lists of tuples:
+    #   0: Internal label (can be blank)
+    #   1: Current temperature (in Centigrade)
+    #   2: Temperature the driver considers too high (can be None)
+    #   3: Temperature the driver considers dangerously high (can be None)
+    # Some sensors have internal names, some don't.  If this sensor has one,
+    # it's used instead of the name of the driver.
+    for temp_sensor in current.temperatures:
+        for i in current.temperatures[temp_sensor]:
+            label = i[0] or temp_sensor
+
+            # Make sure the temperature makes sense.
+            if i[1] <= 0.0:
+                logging.debug("Temperature for device " + label + " is negative.  This makes no sense.  Skipping.")
+                continue
+            metrics["temperature:" + label] = i[1]
+            if i[2]:
+                metrics["high_temperature:" + label] = i[2]
+            if i[3]:
+                metrics["critical_temperature:" + label] = i[3]
+
+    metrics.update(network_rates())
+    metrics.update(processes.resource_metrics())
+    metrics.update(cgroup_metrics(current.cgroups))
+    logging.debug("Current metrics: " + str(metrics))
+    return metrics
+
+# cgroup_metrics(): Function that turns what the monitored cgroups are using
+#   into metrics.  Takes one argument, a hash table from cgroups.read_all().
+#   Returns a hash table of metric names to values (see collect_metrics()).
+def cgroup_metrics(cgroup_stats):
+    metrics = {}
+    for name in cgroup_stats:
+        stats = cgroup_stats[name]
+        metrics["cgroup_memory:" + name] = round(stats["memory"] / 1048576.0, 2)
+        if stats["memory_limit"]:
+            metrics["cgroup_memory_used:" + name] = round(stats["memory"] / stats["memory_limit"] * 100.0, 2)
+        if stats["memory_pressure"] is not None:
+            metrics["cgroup_memory_pressure:" + name] = stats["memory_pressure"]
+
+        # Rates aren't known until the cgroup's been read twice.
+        if "cpu" not in stats:
+            continue
+        metrics["cgroup_cpu:" + name] = round(stats["cpu"], 2)
+        if stats["cpu_limit"]:
+            metrics["cgroup_cpu_used:" + name] = round(stats["cpu"] / stats["cpu_limit"] * 100.0, 2)
+        metrics["cgroup_throttled:" + name] = round(stats["throttled"], 2)
+        metrics["cgroup_oom_kills:" + name] = stats["oom_kills"]
+        for i in ("reads", "writes", "read_bytes", "write_bytes"):
+            metrics["cgroup_" + i + ":" + name] = stats[i]
+    return metrics
+
+# collect_openwrt_metrics(): Function that gathers the stats collect_metrics()
+#   can get from an OpenWRT device.  Takes one argument, the base URL of the
+#   device.  Returns a hash table of metric names to values.
+def collect_openwrt_metrics(openwrt_url):
+    metrics = {}
+
+    # If the device can't be reached, there's nothing else to go on.
+    if not openwrt.get(openwrt_url + "/cgi-bin/system/info"):
+        metrics["reachable"] = 0.0
+        return metrics
+    metrics["reachable"] = 1.0
+
+    current_load_avg = openwrt.sysload(openwrt_url)
+    if current_load_avg["one_minute"] >= 0:
+        metrics["load"] = current_load_avg["one_minute"]
+        metrics["load5"] = current_load_avg["five_minute"]
+        metrics["load15"] = current_load_avg["fifteen_minute"]
+    metrics["cpu_idle"] = openwrt.cpu_idle_time(openwrt_url)
+
+    # Storage the device can't report on comes back as a string.
+    disk_usage = openwrt.get_disk_usage(openwrt_url)
+    for disk in disk_usage:
+        if isinstance(disk_usage[disk], float):
+            metrics["disk:" + disk] = disk_usage[disk]
+
+    # OpenWRT doesn't say how much memory there is in total, so the amount
+    # free can't be worked out as a percentage.
+    return metrics
+
+# record_metrics(): Function that adds everything collect_metrics() gathered
+#   to the history, except for the temperature limits set by the drivers
+#   which never change.  Takes one argument, the hash table of metrics, and
+#   optionally a prefix to put in front of every metric's name.
+def record_metrics(metrics, prefix=""):
+    now = time.time()
+    for metric in metrics:
+        if metric.startswith(unrecorded):
+            continue
+        timeseries.record(prefix + metric, metrics[metric], now)
+
+# check_system(): Function that collects the stats of the system, adds them
+#   to the history, and checks them against the alert rules.  Everything the
+#   rules turn up is sent as one message.  Takes one argument, the name of a
+#   function to send messages with.
+def check_system(send_message_to_user):
+    metrics = collect_metrics()
+    record_metrics(metrics)
+    exporter.publish(metrics)
+    fleet.set_local(metrics)
+    message = alerts.consolidate(alerts.evaluate(metrics))
+    if message:
+        send_message_to_user(message)
+
+# check_openwrt_devices(): Function that collects the stats of every OpenWRT
+#   device at the same time, adds them to the history, checks each device
+#   against the alert rules, and sends everything they found to the user in
+#   one message so that a site-wide outage doesn't turn into a storm of
+#   messages.  Takes two arguments, a list of devices (openwrt.Device) and
+#   the name of a function to send messages with.
+def check_openwrt_devices(devices, send_message_to_user):
+    def collect(device):
+        try:
+            return collect_metrics(device)
+        except Exception as e:
+            logging.warning("Unable to check OpenWRT device " + device.name + ": " + str(e))
+            return {}
+
+    results = openwrt.map_devices(collect, devices)
+
+    # Devices that can't be reached are rolled up into one line.
+    unreachable = []
     message = ""
-    std_dev = 0.0
-    if globals.openwrt_url:
-        current_load_avg = openwrt.sysload(globals.openwrt_url)
-    else:
-        current_load_avg = sysload()
-
-    logging.debug("Value of sys_avg_min_len: " + str(sys_avg_min_len))
-    logging.debug("Value of sys_avg_max_len: " + str(sys_avg_max_len))
-    logging.debug("Current system load averages: " + str(current_load_avg))
-
-    # Copy the load averages into the appropriate running lists.
-    one_minute_average.append(current_load_avg["one_minute"])
-    five_minute_average.append(current_load_avg["five_minute"])
-    fifteen_minute_average.append(current_load_avg["fifteen_minute"])
-
-    logging.debug("Length of one_minute_average: " + str(len(one_minute_average)))
-    logging.debug("Length of five_minute_average: " + str(len(five_minute_average)))
-    logging.debug("Length of fifteen_minute_average: " + str(len(fifteen_minute_average)))
-
-    # Pop the oldest values out of the lists to keep them at a manageable size.
-    if len(one_minute_average) >= int(sys_avg_max_len):
-        logging.debug("Removing oldest system load values.")
-        one_minute_average.pop(0)
-        five_minute_average.pop(0)
-        fifteen_minute_average.pop(0)
-
-    # To calculate the standard deviation of a group of values, there need to
-    # be several available.  Make sure this is the case.
-    if len(one_minute_average) < int(sys_avg_min_len):
-        logging.debug("Need more than " + str(sys_avg_min_len) + " samples of system load.  Waiting.")
-        return sysload_counter
-
-    # Calculate the standard deviations of the three system loads and send an
-    # alert if there's been a huge spike.
-    std_dev = statistics.stdev(one_minute_average)
-    logging.debug("Standard deviation of one minute system load: " + str(std_dev))
-    if std_dev > float(std_devs):
-        message = message + "WARNING: The current system load has spiked to " + str(current_load_avg["one_minute"]) + ".\n"
-
-    std_dev = statistics.stdev(five_minute_average)
-    logging.debug("Standard deviation of five minute system load: " + str(std_dev))
-    if std_dev > float(std_devs):
-        message = message + "WARNING: The five minute system load has spiked to " + str(current_load_avg["five_minute"]) + ".  What could be running that's doing this?\n"
-
-    std_dev = statistics.stdev(fifteen_minute_average)
-    logging.debug("Standard deviation of fifteen minute system load: " + str(std_dev))
-    if std_dev > float(std_devs):
-        message = message + "WARNING: The fifteen minute system load has spiked to " + str(current_load_avg["fifteen_minute"]) + ".  I think something's dreadfully wrong.\n"
-
-    # If a message has been constructed, check to see if it's been longer than
-    # the last time a message was sent.  If so, send it and reset the counter.
+    for (device, metrics) in zip(devices, results):
+        record_metrics(metrics, device.name + ":")
+        exporter.publish(metrics, device.name)
+        found = alerts.evaluate(metrics, device.name)
+        if any(name == "unreachable" for (name, text) in found):
+            unreachable.append(device.name)
+            found = [i for i in found if i[0] != "unreachable"]
+        message = message + alerts.consolidate(found, device.name + ": ")
+    if unreachable:
+        message = "WARNING: I can't reach " + str(len(unreachable)) + " of " + str(len(devices)) + " devices: " + ", ".join(unreachable) + "\n" + message
+
     if message:
-        # If time_between_alerts is zero, alerting has been disabled so just
-        # return.
-        if time_between_alerts == 0:
-            logging.debug("System load alerting disabled.")
-            return 0
-        if sysload_counter >= time_between_alerts:
-            send_message_to_user(message)
-            return 0
-
-        # If enough time between alerts hasn't passed yet, just increment the
-        # counter.
-        sysload_counter = sysload_counter + status_polling
-    return sysload_counter
+        send_message_to_user(message)
+
+# check_fleet(): Function that checks the stats the agents have pushed since
+#   the last time against the alert rules, each host with its own alert
+#   states, and adds them to the history.  Like check_openwrt_devices(),
+#   everything the hosts turn up is sent as one message, with the hosts that
+#   have stopped pushing rolled up into one line.  Takes one argument, the
+#   name of a function to send messages with.
+def check_fleet(send_message_to_user):
+    unreachable = []
+    message = ""
+    for (host, metrics) in fleet.collect():
+        record_metrics(metrics, host + ":")
+        exporter.publish(metrics, host)
+        found = alerts.evaluate(metrics, host)
+        if any(name == "unreachable" for (name, text) in found):
+            unreachable.append(host)
+            found = [i for i in found if i[0] != "unreachable"]
+        message = message + alerts.consolidate(found, host + ": ")
+    if unreachable:
+        message = "WARNING: " + str(len(unreachable)) + " hosts have stopped reporting in: " + ", ".join(unreachable) + "\n" + message
+
+    if message:
+        send_message_to_user(message)
+
+# check_logs(): Function that reads whatever's been added to the log files
+#   being watched, adds how many lines matched each log rule to the history,
+#   and checks them against the alert rules.  Everything they turn up is sent
+#   as one message.  Takes one argument, the name of a function to send
+#   messages with.
+def check_logs(send_message_to_user):
+    (metrics, context) = logwatch.check()
+    record_metrics(metrics)
+    message = alerts.consolidate(alerts.evaluate(metrics, context=context))
+    if message:
+        send_message_to_user(message)
+
+# check_probes(): Function that probes every service being monitored at the
+#   same time, adds whether they answered and how long they took to the
+#   history, and checks them against the alert rules.  Everything they turn
+#   up is sent as one message.  Takes one argument, the name of a function to
+#   send messages with, and optionally what probes.check() returned, if the
+#   probes have already been run (on another thread, so as not to hold up
+#   the system checks).
+def check_probes(send_message_to_user, results=None):
+    if results is None:
+        results = probes.check()
+    (metrics, context) = results
+    record_metrics(metrics)
+    exporter.publish(metrics, group="probes")
+    message = alerts.consolidate(alerts.evaluate(metrics, context=context))
+    if message:
+        send_message_to_user(message)
 
 # uname(): Function that calls os.uname(), extracts a few things.  This should
 #   only be called upon request by the user, or maybe when the bot starts up.
@@ -181,37 +439,6 @@ def cpu_idle_time():
     else:
         return psutil.cpu_times_percent()[3]
 
-# check_cpu_idle_time(): Monitors the amount of time the CPU(s) are idle.
-#   Takes four arguments: the CPU idle time counter, the time between alerts,
-#   the value of status_polling, and the name of a function to send a message
-#   with.  Sends an alert to the bot's owner if the CPU idle time is too low.
-#   Returns an updated value for cpu_idle_time_counter.
-def check_cpu_idle_time(cpu_idle_time_counter, time_between_alerts,
-        status_polling, send_message_to_user):
-    message = ""
-    idle_time = cpu_idle_time()
-
-    # Check the percentage of CPU idle time and construct a message for the
-    # bot's owner if it's too low.
-    if idle_time < 15.0:
-        message = "WARNING: The current CPU idle time is sitting at " + str(idle_time) + ".  What's keeping it so busy?"
-
-    # If a message has been built, check to see if enough time in between
-    # messages has passed.  If so, send the message.
-    if message:
-        # If time_between_alerts is zero, alerting has been disabled so just
-        # return.
-        if time_between_alerts == 0:
-            logging.debug("CPU idle time alerting disabled.")
-            return 0
-        if cpu_idle_time_counter >= time_between_alerts:
-            send_message_to_user(message)
-            return 0
-
-        # If not enough time has passed yet, just increment the counter.
-        cpu_idle_time_counter = cpu_idle_time_counter + status_polling
-    return cpu_idle_time_counter
-
 # get_disk_usage(): Takes no arguments.  Returns a hash table containing the
 #   disk device name as the key and percentage used as the value.
 def get_disk_usage():
@@ -241,6 +468,24 @@ def get_disk_usage():
             logging.debug("Skipping disk device " + i + " due to restrictive permissions.")
     return disk_used
 
+# disk_io(): Function that returns what the disks have been doing as of the
+#   last snapshot, and how many inodes are in use on each filesystem.  Takes
+#   no arguments.  Returns a tuple of two hash tables (see procfs.Snapshot),
+#   or None in OpenWRT mode.
+def disk_io():
+    if globals.openwrt_url:
+        return None
+    current = current_snapshot()
+    return (current.disk_io, current.inode_usage)
+
+# cgroup_usage(): Function that returns what the monitored cgroups were using
+#   as of the last snapshot.  Takes no arguments.  Returns a hash table (see
+#   cgroups.read_cgroup()), or None in OpenWRT mode.
+def cgroup_usage():
+    if globals.openwrt_url:
+        return None
+    return current_snapshot().cgroups
+
 # get_disk_space(): Takes a string corresponding to a mountpoint ("/home").
 #   Looks up the total amount of disk space, the amount of disk space used,
 #   and the amount of disk space free.  Returns those values as a hash table
@@ -261,100 +506,11 @@ def get_disk_space(device):
     logging.debug("Value of disk_space: " + str(disk_space))
     return disk_space
 
-# check_disk_usage(): Pull the amount of used storage for each disk device on
-#   the system and send the bot's owner an alert if one of the disks gets too
-#   full.  Takes as arguments the values of disk_usage_counter,
-#   time_between_alerts, status polling, the value of disk_usage, and the name
-#   of a function to send messages with.  Returns an updated value for
-#   disk_usage_counter.
-def check_disk_usage(disk_usage_counter, time_between_alerts, status_polling,
-    disk_usage, send_message_to_user):
-    message = ""
-    disk_space_free = get_disk_usage()
-
-    # Check the amount of space free on each disk device.  For each disk that's
-    # running low on space construct a line of the message.
-    for disk in list(disk_space_free.keys()):
-        if not disk_space_free[disk]:
-            logging.debug("disk_space_free[disk] value " + str(disk_space_free[disk]) + " isn't usable.  Forget it.")
-            continue
-        try:
-            if disk_space_free[disk] > disk_usage:
-                message = message + "WARNING: Disk device " + disk + " has " + str(100.0 - disk_space_free[disk]) + "% of its capacity left.\n"
-        except:
-                message = message + "NOTICE: Storage usage monitoring is not yet implemented for storage device " + disk + ".\n"
-
-    # If a message has been constructed, check how much time has passed since
-    # the last message was sent.  If enough time has, sent the bot's owner
-    # the message.
-    if message:
-        # If time_between_alerts is zero, alerting has been disabled so just
-        # return.
-        if time_between_alerts == 0:
-            logging.debug("Disk usage alerting disabled.")
-            return 0
-        if disk_usage_counter >= time_between_alerts:
-            send_message_to_user(message)
-            return 0
-
-        # Not enough time has passed.  Increment the counter and move on.
-        disk_usage_counter = disk_usage_counter + status_polling
-    return disk_usage_counter
-
 # memory_utilization(): Function that returns a snapshot of memory
 #    utilization.  Takes no arguments.
 def memory_utilization():
     return psutil.virtual_memory()
 
-# check_memory_utilization(): Function that checks how much memory is free on
-#   the system and alerts the bot's owner if it's below a certain amount.
-#   Takes five arguments, the current values of memory_free_counter and
-#   time_between_alerts, the value of status_polling, the value of
-#   memory_remaining, and the name of a function to send messages with.
-#   Returns an updated value for memory_free_counter.
-def check_memory_utilization(memory_free_counter, time_between_alerts,
-        status_polling, memory_remaining, send_message_to_user):
-    message = ""
-    if globals.openwrt_url:
-        memory_stats = openwrt.memory_utilization(globals.openwrt_url)
-        calculated_free_memory = memory_stats["free"] + memory_stats["buffers"] + memory_stats["cached"]
-    else:
-        memory_stats = memory_utilization()
-        calculated_free_memory = memory_stats.free + memory_stats.buffers + memory_stats.cached
-    logging.debug("Calculated free memory: %s" % convert_bytes(calculated_free_memory))
-
-    # Check the amount of memory free.  If it's below a critical threshold
-    # construct a message for the bot's owner.  It's formatted this way for
-    # clarity later.  Rounded off to two decimal places.
-    try:
-        calculated_free_memory = (calculated_free_memory / memory_stats.total)
-        calculated_free_memory = round(calculated_free_memory * 100.0, 2)
-        logging.debug("Percentage of free memory: %s" % str(calculated_free_memory))
-        if calculated_free_memory <= memory_remaining:
-            message = "WARNING: The amount of free memory has reached the critical point of " + str(calculated_free_memory) + "% free.  You'll want to see to this before the OOM killer starts reaping processes."
-    except:
-        # message = "Unable to get accurate memory stats from this platform."
-        # MOOF MOOF MOOF - commented out because the OpenWRT case tends to
-        # have a lot of false positives
-        pass
-
-    # If a message has been constructed, check how much time has passed since
-    # the last message was sent.  If enough time has, send the bot's owner the
-    # message.
-    if message:
-        # If time_between_alerts is zero, alerting has been disabled so just
-        # return.
-        if time_between_alerts == 0:
-            logging.debug("Memory utilization alerting disabled.")
-            return 0
-        if memory_free_counter >= time_between_alerts:
-            send_message_to_user(message)
-            return 0
-
-        # Not enough time has passed.  Increment the counter and move on.
-        memory_free_counter = memory_free_counter + status_polling
-    return memory_free_counter
-
 # uptime(): Function that returns the length of time the system has been
 #   online from /proc/uptime.  Takes no arguments, returns a string.
 def uptime():
@@ -374,30 +530,15 @@ def uptime():
         return uptime_string
 
 # current_ip_address(): Function that returns the current non-RFC 1989 IP
-#   address of the system using an external HTTP(S) service or REST API.
-#   Takes one argument, a string containing the URL to the service.  Returns
-#   the IP address as a string or None if it didn't work.
-def current_ip_address(ip_addr_service):
-    request = None
-
-    # Attempt to make an HTTP(S) request to the service that returns the
-    # public IP of the host.
-    request = requests.get(ip_addr_service)
-
-    # Handle catastrophic failure.
-    if not request:
-        logging.err("Failed to contact HTTP(S) service " + str(ip_addr_service) + " to get host's IP address.")
-        return None
-
-    # Handle HTTP error codes.
-    if request.status_code != requests.codes.ok:
-        logging.err("HTTP(S) request to IP address service " + str(ip_addr_service) + "failed, returned HTTP error code " + str(request.status_code) + ".")
-        return None
-
-    # Got the host's public IP address.  Explicitly cast to a string to make
-    # life easier four other modules.
-    logging.debug("Got current IP address of host: " + str(request.text))
-    return str(request.text)
+#   address of the system using external HTTP(S) services or REST APIs (see
+#   public_ip.py).  The address is cached and refreshed in the background,
+#   so this usually doesn't have to wait for the network.  Takes no
+#   arguments.  Returns the IP address as a string or None if it didn't
+#   work.
+def current_ip_address():
+    address = public_ip.lookup()
+    logging.debug("Got current IP address of host: " + str(address))
+    return address
 
 # local_ip_address(): Function that returns the local IP address of the system
 #   by querying the primary network interface.  Takes no arguments.  Returns
@@ -444,8 +585,9 @@ def local_ip_address():
 def convert_bytes(bytes):
     size_name = ("Bytes", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
 
-    # Catch the inactive interface case.
-    if (bytes == 0):
+    # Catch the inactive interface case (and rates of less than a byte per
+    # second, which would come out in yottabytes).
+    if (bytes < 1):
         return "0B"
 
     # Extract the whole number part of the traffic volume.  This is the index
@@ -463,13 +605,17 @@ def convert_bytes(bytes):
 
 # network_traffic(): Function that uses the psutil module to extract stats for
 #   every network interface on the system (except for the loopback) and returns
-#   them to the calling function.
+#   them to the calling function: the traffic volume to date, how fast it's
+#   sending and receiving right now, and the fastest it's sent and received
+#   over the last day.
 def network_traffic():
     stats = {}
+    if globals.openwrt_url:
+        return openwrt.network_traffic(globals.openwrt_url)
     nics = psutil.net_io_counters(pernic=True)
 
     # Get rid of the loopback interface.
-    del nics["lo"]
+    nics.pop("lo", None)
 
     # Prime the network stats hash table with the remaining network interfaces.
     for i in list(nics.keys()):
@@ -477,13 +623,104 @@ def network_traffic():
 
     # For each network interface on the system, convert bytes_sent and
     # bytes_recv into human-readable strings.
+    now = time.time()
     for i in list(nics.keys()):
         stats[i]["sent"] = convert_bytes(nics[i].bytes_sent)
         stats[i]["received"] = convert_bytes(nics[i].bytes_recv)
-        logging.debug("Traffic volume to date for " + i + ": " + str(stats[i]))
+
+        # Throughput as of the last run of the main loop.
+        if i in current_traffic:
+            rates = current_traffic[i]
+            stats[i]["sending"] = convert_bytes(rates["sent"]) + "/s (" + str(round(rates["packets_sent"], 1)) + " packets/s)"
+            stats[i]["receiving"] = convert_bytes(rates["received"]) + "/s (" + str(round(rates["packets_received"], 1)) + " packets/s)"
+            if "utilization" in rates:
+                stats[i]["utilization"] = str(round(rates["utilization"], 1)) + "% of " + str(link_speeds[i]) + " Mbit/s"
+
+        # The fastest it's been over the last day, from the history.
+        for direction in ["sent", "received"]:
+            peak = timeseries.query(direction + ":" + i.lower(), now - 86400,
+                now)
+            if peak:
+                stats[i]["peak_" + direction] = convert_bytes(peak["max"]) + "/s"
+        logging.debug("Traffic stats for " + i + ": " + str(stats[i]))
 
     return stats
 
+# network_rates(): Function that works out how fast every network interface
+#   on the system (except for the loopback) has been sending and receiving
+#   since the last time it was called, and how much of the link speed that
+#   is.  Takes no arguments.  Returns a hash table of "sent:<interface>" and
+#   "received:<interface>" (bytes per second), "packets_sent:<interface>" and
+#   "packets_received:<interface>" (packets per second), and
+#   "utilization:<interface>" (percent of the link speed, in whichever
+#   direction is busier) to values, which is empty the first time.
+def network_rates():
+    global previous_traffic
+    global previous_traffic_time
+    global current_traffic
+
+    rates = {}
+    if globals.openwrt_url:
+        return rates
+
+    # Rates are worked out from a clock that can't be set, so that the
+    # clock being changed doesn't turn into a burst of traffic.
+    now = time.monotonic()
+    nics = psutil.net_io_counters(pernic=True)
+    nics.pop("lo", None)
+
+    traffic = {}
+    if previous_traffic:
+        elapsed = now - previous_traffic_time
+        speeds = get_link_speeds(nics, now)
+        for i in nics:
+            if i not in previous_traffic or elapsed <= 0:
+                continue
+
+            # Counters go back to zero when an interface is reset.
+            sent = nics[i].bytes_sent - previous_traffic[i].bytes_sent
+            received = nics[i].bytes_recv - previous_traffic[i].bytes_recv
+            packets_sent = nics[i].packets_sent - previous_traffic[i].packets_sent
+            packets_received = nics[i].packets_recv - previous_traffic[i].packets_recv
+            if min(sent, received, packets_sent, packets_received) < 0:
+                continue
+
+            traffic[i] = {"sent": sent / elapsed,
+                "received": received / elapsed,
+                "packets_sent": packets_sent / elapsed,
+                "packets_received": packets_received / elapsed}
+            if speeds.get(i):
+                traffic[i]["utilization"] = max(sent, received) * 8.0 / elapsed / (speeds[i] * 1000000.0) * 100.0
+            for j in traffic[i]:
+                rates[j + ":" + i] = traffic[i][j]
+
+    previous_traffic = nics
+    previous_traffic_time = now
+    current_traffic = traffic
+    return rates
+
+# get_link_speeds(): Function that returns the link speed of every network
+#   interface, looking them up again if an interface shows up that hasn't
+#   been seen before or it's been five minutes.  Takes two arguments, the
+#   network interfaces (as returned by psutil.net_io_counters()) and the
+#   current time (time.monotonic()).  Returns a hash table of interfaces to megabits per second
+#   (0 if unknown).
+def get_link_speeds(nics, now):
+    global link_speeds
+    global link_speeds_time
+
+    if now - link_speeds_time >= 300 or any(i not in link_speeds for i in nics):
+        link_speeds = {}
+        try:
+            for (nic, stats) in psutil.net_if_stats().items():
+                link_speeds[nic] = stats.speed
+        except Exception as e:
+            logging.debug("Unable to get link speeds: " + str(e))
+        for i in nics:
+            link_speeds.setdefault(i, 0)
+        link_speeds_time = now
+    return link_speeds
+
 # centigrade_to_fahrenheit: Function that takes a floating point value
 #   representing a temperature in degrees Celsius, and returns a floating
 #   point value representing the temperature in degrees Fahrenheit.
@@ -507,150 +744,6 @@ def get_hardware_temperatures():
     else:
         return psutil.sensors_temperatures()
 
-# check_hardware_temperatures: Function that analyzes the values of the
-#   hardware temperatures and alerts the user if one of them has either reached
-#   a high or critical threshold.  Takes seven arguments, the current values of
-#   temperature_counter, time_between_alerts, the value of status_polling, the
-#   number of standard deviations to calculate, the minimum and maximum
-#   temperature stat queue lengths, and the name of a function to send
-#   messages with.  Returns an updated value for temperature_counter.
-def check_hardware_temperatures(temperature_counter, time_between_alerts,
-    status_polling, std_devs, sys_avg_min_len, sys_avg_max_len,
-    send_message_to_user):
-    logging.debug("Entered function system_stats.check_hardware_temperatures().")
-
-    message = ""
-    label = ""
-    temperatures = get_hardware_temperatures()
-    fahrenheit = 0.0
-    no_critical = False
-    no_high = False
-    std_dev = 0.0
-
-    # If we're running in a virtual machine, we'll get an empty hash table.
-    if not temperatures:
-        logging.debug("Running on a virtual machine.  Bouncing.")
-        return 0
-
-    # If we've made it this far, we're probably running on real hardware with
-    # at least one hardware sensor.
-    for temp_sensor in list(temperatures.keys()):
-        label = temp_sensor
-
-        # Temperature readings take the form of lists of tuples, where the
-        # tuples contain the actual data.
-        for i in temperatures[temp_sensor]:
-            no_high = False
-            no_critical = False
-
-            # Some sensors have internal names, some don't.  If this sensor
-            # has one, replace the label with it.
-            if i[0]:
-                label = i[0]
-            logging.debug("Name of sensor: " + label)
-
-            # Schema of tuples:
-            #   0: Internal label (can be blank)
-            #   1: Current temperature (in Centigrade)
-            #   2: Temperature the driver considers too high (can be None)
-            #   3: Temperature the driver considers dangerously high (can be
-            #       None)
-            # Check to see if the critical point is set and has been reached.
-            if i[3]:
-                if i[1] >= i[3]:
-                    if time_between_alerts == 0:
-                        logging.debug("System temperature alerting disabled.")
-                        continue
-                    fahrenheit = centigrade_to_fahrenheit(i[1])
-                    message = "WARNING: Temperature sensor " + label + " is now reading " + str(i[1]) + " degrees Centigrade (" + str(fahrenheit) + " degrees Fahrenheit).  This is alarmingly high!"
-                    send_message_to_user(message)
-                    continue
-            else:
-                no_critical = True
-                logging.debug("Sensor " + label + " does not have a critical point defined.")
-
-            # Check to see if the too high point is set and has been reached.
-            # We only want one of these.
-            if i[2]:
-                if i[1] >= i[2]:
-                    # If time_between_alerts is zero, alerting has been
-                    # disabled so just move on.
-                    if time_between_alerts == 0:
-                        logging.debug("System temperature alerting disabled.")
-                        continue
-
-                    fahrenheit = centigrade_to_fahrenheit(i[1])
-                    message = "DANGER: Temperature sensor " + label + " is now reading " + str(i[1]) + " degrees Centigrade (" + str(fahrenheit) + " degrees Fahrenheit).  Critical temperature reached!  Investigate immediately!"
-                    send_message_to_user(message)
-                    continue
-            else:
-                no_high = True
-                logging.debug("Sensor " + label + " does not have a high point defined.")
-
-            # If there are no high or critical points defined by the driver, we
-            # have to fall back on a statistical analysis of temperature
-            # history.
-            if no_high or no_critical:
-                std_dev = 0.0
-
-                # If a list of device temperatures for this device doesn't
-                # exist, add it to the hash.
-                if label not in list(device_temperatures.keys()):
-                    logging.debug("Creating temperature history for device " + label + ".")
-                    device_temperatures[label] = []
-
-                # Make sure the temperature makes sense.
-                if i[1] <= 0.0:
-                    logging.debug("Temperature for device " + label + " is negative.  This makes no sense.  Skipping.")
-                    continue
-
-                # Store the current temperature in Centigrade.
-                device_temperatures[label].append(i[1])
-                logging.debug("Length of device_temperatures[" + label + "]: " + str(len(device_temperatures[label])))
-
-                # Pop the oldest values out of the list to keep it at a
-                # manageable size.
-                if len(device_temperatures[label]) >= int(sys_avg_max_len):
-                    logging.debug("Removing oldest temperature for device_temperatures[" + label + "]."  )
-                    device_temperatures[label].pop(0)
-
-                # To calculate the standard deviation of a group of values,
-                # there need to be several available.  Make sure this is the
-                # case.
-                if len(device_temperatures[label]) < int(sys_avg_min_len):
-                    logging.debug("Need more than " + str(sys_avg_min_len) + " temperature samples.  Waiting.")
-                    continue
-
-                # Calculate the standard deviations of the three system loads
-                # and send an alert if there's been a spike.
-                std_dev = statistics.stdev(device_temperatures[label])
-                logging.debug("Standard deviation of temperature of sensor " + label + ": " + str(std_dev))
-                if std_dev > float(std_devs):
-                    # If time_between_alerts is zero, alerting has been
-                    # disabled so just move on.
-                    if time_between_alerts == 0:
-                        logging.debug("System temperature alerting disabled.")
-                        continue
-
-                    fahrenheit = centigrade_to_fahrenheit(i[1])
-                    message = message + "WARNING: The temperature of sensor " + label + " has spiked to " + str(i[1]) + " degrees Centigrade (" + str(fahrenheit) + " degrees Fahrenheit)!  Investigate immediately!"
-            # Bottom of cycle through sensors on this device.
-        # Bottom of cycle through temperature sensors on the system.
-
-    # If a message has been sent in the recent past, check to see if it's been
-    # longer than the last time a message was sent.  If so, reset the counter.
-    if message:
-        if temperature_counter >= time_between_alerts:
-            send_message_to_user(message)
-            logging.debug("Resetting time between alerts counter to 0.")
-            return 0
-
-        # If enough time between alerts hasn't passed yet, just increment the
-        # counter.
-        temperature_counter = temperature_counter + status_polling
-        logging.debug("Incrementing time between alerts counter.")
-    return temperature_counter
-
 # local_datetime: Utility function which gets the current date and time from
 #   the system and returns it as a string.  Returns None if it can't.  Takes
 #   no arguments.
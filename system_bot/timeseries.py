@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# timeseries.py - Module that keeps a history of the system stats system_bot.py
+#   collects so that questions like "what was the load at 3am?" can be
+#   answered.  Every sample is rolled up into one minute, five minute, and one
+#   hour buckets, each of which holds the number of samples, their sum, and
+#   the smallest and largest of them.  Each resolution of each metric is a
+#   fixed number of fixed-width buckets used round-robin (a bucket's slot is
+#   its start time divided by the resolution, modulo the number of slots), so
+#   the history takes up the same amount of memory and disk space no matter
+#   how long the bot runs.  The buckets are kept in memory in the same format
+#   they're written to disk in, and only buckets that changed are written.
+#
+#   A metric's buckets take up about 200 KB on disk.  In memory they're kept
+#   in pages of 64 buckets which are only allocated once something is written
+#   to them, and a metric's files aren't read until it's used, so a metric
+#   only takes up about 200 KB of memory once it has 90 days of history.
+#   That's still a lot on a small machine, so the number of metrics is
+#   limited too.  Interfaces, disks, processes, and hosts come and go, so
+#   metrics that haven't had a sample for a while are forgotten and their
+#   files deleted.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.3 - Buckets are allocated a page at a time as they're used, and a
+#        metric's files are only read the first time it's used.  Lowered the
+#        default number of metrics to 200.
+# v1.2 - Limited the number of metrics, and added prune() to forget the ones
+#        that haven't been seen for a while.
+# v1.1 - Added buckets(), so that other modules can learn from the history.
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import logging
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+# Constants.
+# Resolutions of the history (in seconds) and how many buckets of each to
+# keep: one minute buckets for a day, five minute buckets for a week, and one
+# hour buckets for 90 days.
+resolutions = [(60, 1440), (300, 2016), (3600, 2160)]
+
+# Layout of a bucket: start time, number of samples, sum, minimum, maximum.
+bucket = struct.Struct("<qIddd")
+
+# Number of buckets in a page of memory.
+page_size = 64
+
+# Variables global to this module.
+# Most metrics to keep a history of, and how many seconds a metric can go
+# without a sample before it's forgotten.
+maximum_metrics = 200
+expiry = 30 * 86400
+
+# Directory the history is kept in, one file per metric per resolution.  If
+# empty, the history is only kept in memory.
+history_dir = ""
+
+# Hash table of metric names to lists of Series, one per resolution, and
+# hash table of metric names to when they last had a sample.
+metrics = {}
+last_seen = {}
+
+# True once the user's been warned that there are too many metrics, so the
+# log isn't flooded.
+full = False
+
+# Protects the history.  Samples are recorded by the main loop but the
+# history can be read from other threads.
+lock = threading.Lock()
+
+# Classes.
+# Series: Class that holds the buckets of one metric at one resolution.
+class Series(object):
+
+    # Initialize new instances of the class.  Takes three arguments, the
+    # resolution in seconds, the number of buckets, and the path to the file
+    # the buckets are kept in (which can be empty).  The file isn't read
+    # until the buckets are used.
+    def __init__(self, resolution, size, path):
+        self.resolution = resolution
+        self.size = size
+        self.path = path
+
+        # Pages of buckets, None until something is written to them.
+        self.pages = None
+
+        # Slots that have changed since they were last written to disk, and
+        # the start time of the bucket most recently added to.
+        self.dirty = set()
+        self.current = None
+
+    # _load(): Allocates the list of pages and reads the pages that aren't
+    #   empty from disk, the first time the buckets are used.
+    def _load(self):
+        if self.pages is not None:
+            return
+        self.pages = [None] * ((self.size + page_size - 1) // page_size)
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as file:
+                for i in range(len(self.pages)):
+                    data = file.read(bucket.size * page_size)
+                    if not data:
+                        break
+                    if data.strip(b"\0"):
+                        self.pages[i] = bytearray(bucket.size * page_size)
+                        self.pages[i][0:len(data)] = data
+        except Exception as e:
+            logging.warning("Unable to load history file " + self.path + ": " + str(e))
+
+    # _read(): Returns the contents of a slot as a tuple of (start time,
+    #   count, sum, minimum, maximum).
+    def _read(self, slot):
+        self._load()
+        page = self.pages[slot // page_size]
+        if page is None:
+            return (0, 0, 0.0, 0.0, 0.0)
+        return bucket.unpack_from(page, slot % page_size * bucket.size)
+
+    # _bytes(): Returns the contents of a page as it's written to disk.
+    def _bytes(self, index):
+        length = min(page_size, self.size - index * page_size) * bucket.size
+        if self.pages[index] is None:
+            return bytes(length)
+        return self.pages[index][0:length]
+
+    # add(): Adds a sample to the bucket it falls into.  Takes two arguments,
+    #   the time of the sample and its value.  Returns True if this sample
+    #   started a new bucket.
+    def add(self, timestamp, value):
+        start = int(timestamp) // self.resolution * self.resolution
+        slot = (start // self.resolution) % self.size
+        (stored, count, total, minimum, maximum) = self._read(slot)
+
+        # Whatever was in the slot before is from a previous time around.
+        if stored != start:
+            (count, total, minimum, maximum) = (0, 0.0, value, value)
+        index = slot // page_size
+        if self.pages[index] is None:
+            self.pages[index] = bytearray(bucket.size * page_size)
+        bucket.pack_into(self.pages[index], slot % page_size * bucket.size,
+            start, count + 1, total + value, min(minimum, value),
+            max(maximum, value))
+        self.dirty.add(slot)
+
+        started = self.current is not None and start != self.current
+        self.current = start
+        return started
+
+    # get(): Returns the bucket that starts at a given time as a tuple of
+    #   (count, sum, minimum, maximum), or None if there isn't one.
+    def get(self, start):
+        slot = (start // self.resolution) % self.size
+        (stored, count, total, minimum, maximum) = self._read(slot)
+        if stored != start or not count:
+            return None
+        return (count, total, minimum, maximum)
+
+    # oldest(): Returns the earliest time this series can still have buckets
+    #   for.
+    def oldest(self, now):
+        return (int(now) // self.resolution - self.size + 1) * self.resolution
+
+    # save(): Writes the buckets that changed to disk.
+    def save(self):
+        if not self.path or not self.dirty:
+            self.dirty.clear()
+            return
+        try:
+            if not os.path.exists(self.path):
+                with open(self.path, "wb") as file:
+                    for i in range(len(self.pages)):
+                        file.write(self._bytes(i))
+            else:
+                with open(self.path, "r+b") as file:
+                    for slot in sorted(self.dirty):
+                        offset = slot % page_size * bucket.size
+                        file.seek(slot * bucket.size)
+                        file.write(self.pages[slot // page_size][offset:
+                            offset + bucket.size])
+            self.dirty.clear()
+        except Exception as e:
+            logging.warning("Unable to write history file " + self.path + ": " + str(e))
+
+# Functions.
+# configure(): Sets up the directory the history is kept in and loads the
+#   history of the metrics found in it, most recently updated first.  Metrics
+#   that haven't been updated for too long are deleted instead.  Takes one
+#   argument, the path to the directory (which can be empty), and optionally
+#   the most metrics to keep and how many days a metric can go without a
+#   sample before it's forgotten.
+def configure(path, maximum=None, expire_after=None):
+    global history_dir
+    global maximum_metrics
+    global expiry
+
+    if maximum:
+        maximum_metrics = int(maximum)
+    if expire_after:
+        expiry = float(expire_after) * 86400
+    history_dir = path
+    if not history_dir:
+        return
+    try:
+        os.makedirs(history_dir, exist_ok=True)
+    except Exception as e:
+        logging.warning("Unable to create history directory " + history_dir + ": " + str(e))
+        history_dir = ""
+        return
+
+    # The file of the finest resolution is written every minute the metric
+    # has a sample, so when it was last modified is when the metric was last
+    # seen.
+    found = []
+    for filename in os.listdir(history_dir):
+        (name, extension) = os.path.splitext(filename)
+        if extension == "." + str(resolutions[0][0]):
+            try:
+                modified = os.path.getmtime(os.path.join(history_dir, filename))
+            except OSError:
+                continue
+            found.append((modified, urllib.parse.unquote(name)))
+    found.sort(reverse=True)
+
+    now = time.time()
+    expired = [i for i in found if i[0] < now - expiry]
+    found = [i for i in found if i[0] >= now - expiry]
+    with lock:
+        for (modified, name) in expired:
+            logging.info("Forgetting the history of " + name + ", which hasn't been updated in " + str(int((now - modified) // 86400)) + " days.")
+            _delete_files(name)
+        for (modified, name) in found[:maximum_metrics]:
+            _get_metric(name)
+            last_seen[name] = modified
+    if len(found) > maximum_metrics:
+        logging.warning("Only loaded the history of " + str(maximum_metrics) + " of the " + str(len(found)) + " metrics in " + history_dir + ".")
+    logging.debug("Loaded the history of " + str(len(metrics)) + " metrics.")
+
+# record(): Adds a sample to the history of a metric.  Metric names are
+#   lowercase and don't contain spaces so they can be typed in chat.  Takes
+#   two arguments, the name of the metric and its value, and an optional
+#   third, the time of the sample (defaults to now).
+def record(metric, value, timestamp=None):
+    if value is None:
+        return
+    if timestamp is None:
+        timestamp = time.time()
+    metric = metric.lower().replace(" ", "_")
+
+    with lock:
+        series = _get_metric(metric)
+        if not series:
+            return
+        last_seen[metric] = timestamp
+
+        started = [i.add(timestamp, float(value)) for i in series]
+
+        # Whenever a minute goes by, write out everything that changed.
+        if started[0]:
+            for i in series:
+                i.save()
+
+# flush(): Writes every bucket that changed to disk.  Takes no arguments.
+def flush():
+    with lock:
+        for series in metrics.values():
+            for i in series:
+                i.save()
+
+# prune(): Forgets the metrics that haven't had a sample for too long, and
+#   deletes their files.  Takes no arguments.  Returns the number of metrics
+#   forgotten.
+def prune():
+    global full
+
+    now = time.time()
+    with lock:
+        expired = [i for i in metrics if last_seen.get(i, now) < now - expiry]
+        for metric in expired:
+            logging.info("Forgetting the history of " + metric + ", which hasn't had a sample in " + str(int((now - last_seen[metric]) // 86400)) + " days.")
+            del metrics[metric]
+            del last_seen[metric]
+            _delete_files(metric)
+        if len(metrics) < maximum_metrics:
+            full = False
+    return len(expired)
+
+# list_metrics(): Returns a sorted list of the names of the metrics that have
+#   a history.
+def list_metrics():
+    with lock:
+        return sorted(metrics)
+
+# find_metrics(): Finds the metrics a name the user typed refers to: the
+#   metric with that name, or failing that every metric that starts with it
+#   ("disk" means every disk).  Takes one argument, the name.  Returns a
+#   sorted list of metric names, which might be empty.
+def find_metrics(name):
+    name = name.lower()
+    with lock:
+        if name in metrics:
+            return [name]
+        return sorted(i for i in metrics if i.startswith(name))
+
+# query(): Summarizes the history of a metric over a span of time, using the
+#   finest resolution that still goes back that far.  Takes three arguments,
+#   the name of the metric and the start and end of the span (as Unix
+#   timestamps).  Returns a hash table with the resolution used, the number
+#   of samples, their minimum, mean, and maximum, and the start times of the
+#   buckets the minimum and maximum were found in, or None if there's no
+#   history for that span.
+def query(metric, start, end):
+    now = time.time()
+    with lock:
+        if metric not in metrics:
+            return None
+        series = metrics[metric]
+        for i in series:
+            if i.oldest(now) <= start:
+                break
+
+        summary = {"resolution": i.resolution, "count": 0, "sum": 0.0,
+            "min": None, "max": None, "min_time": None, "max_time": None}
+        first = max(int(start) // i.resolution * i.resolution, i.oldest(now))
+        for bucket_start in range(first, int(end) + 1, i.resolution):
+            found = i.get(bucket_start)
+            if not found:
+                continue
+            (count, total, minimum, maximum) = found
+            summary["count"] = summary["count"] + count
+            summary["sum"] = summary["sum"] + total
+            if summary["min"] is None or minimum < summary["min"]:
+                summary["min"] = minimum
+                summary["min_time"] = bucket_start
+            if summary["max"] is None or maximum > summary["max"]:
+                summary["max"] = maximum
+                summary["max_time"] = bucket_start
+
+    if not summary["count"]:
+        return None
+    summary["mean"] = summary["sum"] / summary["count"]
+    del summary["sum"]
+    return summary
+
+# buckets(): Returns every bucket of a metric at one resolution between two
+#   times, oldest first.  Takes four arguments, the name of the metric, the
+#   resolution (in seconds, one of resolutions), and the start and end of the
+#   span (as Unix timestamps).  Returns a list of (start time, count, mean,
+#   minimum, maximum) tuples, which might be empty.
+def buckets(metric, resolution, start, end):
+    found = []
+    now = time.time()
+    metric = metric.lower().replace(" ", "_")
+    with lock:
+        if metric not in metrics:
+            return found
+        for i in metrics[metric]:
+            if i.resolution == resolution:
+                break
+        else:
+            return found
+
+        first = max(int(start) // i.resolution * i.resolution, i.oldest(now))
+        for bucket_start in range(first, int(end) + 1, i.resolution):
+            bucket_found = i.get(bucket_start)
+            if not bucket_found:
+                continue
+            (count, total, minimum, maximum) = bucket_found
+            found.append((bucket_start, count, total / count, minimum,
+                maximum))
+    return found
+
+# most_recent(): Works out the last time the clock read a given time of day.
+#   Takes two arguments, the hour (0-23) and minute.  Returns a Unix
+#   timestamp.
+def most_recent(hour, minute):
+    now = time.localtime()
+    timestamp = time.mktime((now.tm_year, now.tm_mon, now.tm_mday, hour,
+        minute, 0, 0, 0, -1))
+    if timestamp > time.time():
+        timestamp = timestamp - 86400
+    return timestamp
+
+# _get_metric(): Helper function that returns the list of Series of a metric,
+#   creating (or loading) them if they don't exist yet.  The lock has to be
+#   held.  Returns None if there are already too many metrics.
+def _get_metric(metric):
+    global full
+
+    if metric not in metrics:
+        if len(metrics) >= maximum_metrics:
+            if not full:
+                logging.warning("There are already " + str(maximum_metrics) + " metrics with a history, so new ones (like " + metric + ") won't have one until old ones are forgotten.")
+                full = True
+            return None
+        series = []
+        for (resolution, size) in resolutions:
+            series.append(Series(resolution, size, _path(metric, resolution)))
+        metrics[metric] = series
+    return metrics[metric]
+
+# _path(): Helper function that returns the path to the file one resolution
+#   of a metric is kept in, or an empty string if the history is only kept in
+#   memory.
+def _path(metric, resolution):
+    if not history_dir:
+        return ""
+    return os.path.join(history_dir,
+        urllib.parse.quote(metric, safe="") + "." + str(resolution))
+
+# _delete_files(): Helper function that deletes the files a metric's history
+#   is kept in.
+def _delete_files(metric):
+    for (resolution, size) in resolutions:
+        path = _path(metric, resolution)
+        try:
+            if path:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Unable to delete history file " + path + ": " + str(e))
+
+if "__name__" == "__main__":
+    pass
@@ -12,6 +12,11 @@
 
 # License: GPLv3
 
+# v1.4 - Messages to the user go through an on-disk outbox (copy outbox.py
+#       from system_bot/) so they're sent in order once the XMPP bridge is
+#       reachable, instead of spinning at startup until it is.
+# v1.3 - Replies carry the correlation ID of the command they answer so the
+#       XMPP bridge can trace command latency.
 # v1.2 - Changed logging.warn() to logging.warning().
 #       - Reworked the startup logic so that being unable to immediately
 #       connect to either the message bus or the intended service is a
@@ -35,6 +40,9 @@ import requests
 import sys
 import time
 
+# Copy outbox.py from system_bot/ into your bot's directory.
+import outbox
+
 # Constants.
 # When POSTing something to a service, the correct Content-Type value has to
 # be set in the request.
@@ -70,6 +78,16 @@ user_command = None
 # Handle to a parsed user command.
 parsed_command = None
 
+# Correlation ID of the command being handled, if any.  Sent back with replies
+# so the XMPP bridge can trace them.
+command_id = None
+
+# Path to the file messages waiting to be sent to the XMPP bridge are kept in,
+# and the maximum number of messages it'll hold.  The outbox file defaults to
+# <bot_name>.outbox.
+outbox_file = ""
+outbox_size = 1000
+
 # Optional user-defined text strings for the online help and user interaction.
 user_text = None
 user_acknowledged = None
@@ -144,20 +162,21 @@ def parse_...(user_command):
 
 # send_message_to_user(): Function that does the work of sending messages back
 #   to the user by way of the XMPP bridge.  Takes one argument, the message to
-#   send to the user.  Returns a True or False which delineates whether or not
-#   it worked.
+#   send to the user.  The message goes into the outbox first, so if the XMPP
+#   bridge can't be reached right now it'll be sent later.  Returns a True or
+#   False which delineates whether or not it was sent right away.
 def send_message_to_user(message):
     # Set up a hash table of stuff that is used to build the HTTP request to
     # the XMPP bridge.
     reply = {}
     reply["name"] = bot_name
     reply["reply"] = message
+    reply["id"] = command_id
 
-    # Send an HTTP request to the XMPP bridge containing the message for the
-    # user.
-    request = requests.put(server + "replies", headers=custom_headers,
-        data=json.dumps(reply))
-    return
+    # Put the message into the outbox and try to send everything waiting in
+    # it to the XMPP bridge.
+    outbox.append(reply)
+    return outbox.flush()
 
 # online_help(): Utility function that sends online help to the user when
 #   requested.  Takes no args.  Returns nothing.
@@ -241,6 +260,19 @@ except:
     # Nothing to do here, it's an optional configuration setting.
     pass
 
+# Get the path to the outbox file and the maximum number of messages it'll
+# hold if defined in the config file.
+try:
+    outbox_file = config.get("DEFAULT", "outbox_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    outbox_size = int(config.get("DEFAULT", "outbox_size"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
 # Configure the logger.
 logging.basicConfig(level=loglevel, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
@@ -251,6 +283,12 @@ if args.polling:
 
 # Parse the rest of the configuration file...
 
+# Set up the outbox.  Anything left in it from the last time the bot ran will
+# be sent along with the first message.
+if not outbox_file:
+    outbox_file = bot_name + ".outbox"
+outbox.configure(server, outbox_file, outbox_size)
+
 # Debugging output, if required.
 logging.info("Everything is set up.")
 logging.debug("Values of configuration variables as of right now:")
@@ -264,18 +302,15 @@ if user_text:
     logging.debug("User-defined help text: " + user_text)
 if user_acknowledged:
     logging.debug("User-defined command acknowledgement text: " + user_acknowledged)
+logging.debug("Outbox file: " + outbox_file)
+logging.debug("Maximum number of messages in the outbox: " + str(outbox_size))
 # Other debugging output...
 
-# Try to contact the XMPP bridge.  Keep trying until you reach it or the
-# system shuts down.
+# Try to contact the XMPP bridge.  If it can't be reached yet the message
+# waits in the outbox and gets sent once it can.
 logging.info("Trying to contact XMPP message bridge...")
-while True:
-    try:
-        send_message_to_user(bot_name + " now online.")
-        break
-    except:
-        logging.warning("Unable to reach message bus.  Going to try again in %s seconds." % polling_time)
-        time.sleep(float(polling_time))
+if not send_message_to_user(bot_name + " now online."):
+    logging.warning("Unable to reach message bus.  Messages will wait in the outbox until it comes back.")
 
 # Trying to contact other resources and sleeping if we can't (like the above)
 # go here...
@@ -285,6 +320,10 @@ while True:
 logging.debug("Entering main loop to handle requests.")
 while True:
     user_command = None
+    command_id = None
+
+    # Send anything still waiting in the outbox.
+    outbox.flush()
 
     # Check the message queue for index requests.
     try:
@@ -303,6 +342,7 @@ while True:
         # Extract the user command.
         user_command = json.loads(request.text)
         logging.debug("Value of user_command: " + str(user_command))
+        command_id = user_command.get("id")
         user_command = user_command["command"]
 
         # Parse the user command.
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# instrumentation.py - Module that keeps track of what each kind of command
+#   costs a bot to carry out: how many times it's been run, how long it took
+#   (wall clock time and CPU time), and how many outbound HTTP requests it
+#   made and how many bytes they sent and received.  The bot calls start()
+#   when it knows what kind of command it's handling and finish() when it's
+#   done.  Outbound HTTP requests are counted by hooking the Requests module,
+#   so nothing else in the bot needs to change.  The totals are kept in a
+#   metrics file (JSON) so they survive the bot being restarted.
+#
+#   The same module is used by several bots, so if you change it here change
+#   it everywhere.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# By: The Doctor <drwho at virtadpt dot net>
+#       0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+# v1.0 - Initial release.
+
+# TO-DO:
+# -
+
+# Load modules.
+import json
+import logging
+import os
+import requests
+import threading
+import time
+
+# Variables global to this module.
+# Path to the file the totals are kept in.  If empty, they're only kept in
+# memory.
+metrics_file = ""
+
+# Running totals, keyed by the kind of command.
+stats = {}
+
+# The command currently being measured, if any.  Each thread measures its own
+# commands.
+current = threading.local()
+
+# Protects the running totals.
+lock = threading.Lock()
+
+# The original Session.send() from the Requests module, which _send() wraps.
+_original_send = requests.sessions.Session.send
+
+# Functions.
+# configure(): Sets up the metrics file and loads the totals from the last
+#   time the bot ran.  Takes one argument, the path to the metrics file (which
+#   can be empty).
+def configure(path):
+    global metrics_file
+
+    metrics_file = path
+    if not metrics_file or not os.path.exists(metrics_file):
+        return
+
+    with lock:
+        try:
+            with open(metrics_file, "r") as file:
+                stats.update(json.load(file))
+        except Exception as e:
+            logging.warning("Unable to load metrics file " + metrics_file +
+                ": " + str(e))
+
+# start(): Starts measuring a command.  If a command was already being
+#   measured in this thread it's finished first.  Takes one argument, the kind
+#   of command (which is what the totals are kept by).
+def start(command_type):
+    finish()
+    current.measurement = {"type": str(command_type),
+        "wall": time.monotonic(), "cpu": time.thread_time(),
+        "http_calls": 0, "bytes_sent": 0, "bytes_received": 0}
+
+# finish(): Stops measuring the command this thread is working on and adds it
+#   to the totals.  It's safe to call when nothing is being measured.  Takes
+#   no arguments.
+def finish():
+    measurement = getattr(current, "measurement", None)
+    if measurement is None:
+        return
+    current.measurement = None
+
+    wall = time.monotonic() - measurement["wall"]
+    cpu = time.thread_time() - measurement["cpu"]
+
+    with lock:
+        totals = stats.setdefault(measurement["type"], {"count": 0,
+            "wall_total": 0.0, "wall_max": 0.0, "cpu_total": 0.0,
+            "http_calls": 0, "bytes_sent": 0, "bytes_received": 0})
+        totals["count"] = totals["count"] + 1
+        totals["wall_total"] = totals["wall_total"] + wall
+        totals["wall_max"] = max(totals["wall_max"], wall)
+        totals["cpu_total"] = totals["cpu_total"] + cpu
+        for key in ["http_calls", "bytes_sent", "bytes_received"]:
+            totals[key] = totals[key] + measurement[key]
+        _save()
+
+    logging.debug("Command " + measurement["type"] + " took %.3fs (%.3fs CPU) and made %d HTTP requests." % (wall, cpu, measurement["http_calls"]))
+
+# report(): Builds a human readable summary of the totals, slowest kind of
+#   command first.  Takes no arguments.  Returns a string.
+def report():
+    message = ""
+
+    with lock:
+        if not stats:
+            return "I haven't measured any commands yet."
+
+        def mean_wall_time(command_type):
+            return stats[command_type]["wall_total"] / \
+                stats[command_type]["count"]
+
+        for command_type in sorted(stats, key=mean_wall_time, reverse=True):
+            totals = stats[command_type]
+            message = message + command_type + " (" + str(totals["count"]) + " times): "
+            message = message + "mean %.3fs, max %.3fs, mean CPU %.3fs, " % (
+                totals["wall_total"] / totals["count"], totals["wall_max"],
+                totals["cpu_total"] / totals["count"])
+            message = message + "%.1f HTTP requests, %d bytes sent, %d bytes received per command.\n" % (
+                totals["http_calls"] / totals["count"],
+                totals["bytes_sent"] // totals["count"],
+                totals["bytes_received"] // totals["count"])
+    return message
+
+# _send(): Helper function that stands in for the Requests module's
+#   Session.send(), which every outbound HTTP request goes through.  If a
+#   command is being measured in this thread the request and the bytes it
+#   moved are counted against it.
+def _send(self, request, **kwargs):
+    measurement = getattr(current, "measurement", None)
+    if measurement is None:
+        return _original_send(self, request, **kwargs)
+
+    measurement["http_calls"] = measurement["http_calls"] + 1
+    if request.body:
+        measurement["bytes_sent"] = measurement["bytes_sent"] + \
+            len(request.body)
+    response = _original_send(self, request, **kwargs)
+
+    # Don't read streamed responses here, the caller will want them.
+    if kwargs.get("stream"):
+        received = int(response.headers.get("Content-Length", 0))
+    else:
+        received = len(response.content)
+    measurement["bytes_received"] = measurement["bytes_received"] + received
+    return response
+
+# _save(): Helper function that rewrites the metrics file.  The file is
+#   replaced in one go so that a crash can't leave half of it behind.
+def _save():
+    if not metrics_file:
+        return
+    try:
+        with open(metrics_file + ".tmp", "w") as file:
+            json.dump(stats, file)
+        os.replace(metrics_file + ".tmp", metrics_file)
+    except Exception as e:
+        logging.warning("Unable to write to metrics file " + metrics_file +
+            ": " + str(e))
+
+# Count every outbound HTTP request the bot makes.
+requests.sessions.Session.send = _send
+
+if "__name__" == "__main__":
+    pass
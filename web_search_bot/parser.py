@@ -13,6 +13,12 @@
 
 # License: GPLv3
 
+# v1.2 - Added a command to get the bot's own per-command statistics.
+# v1.1 - Grammars are compiled once when the module is loaded instead of in
+#       every parse_*() call, and run through a dispatcher that only tries the
+#       ones that can start with the first word of the request.
+#       - The search category grammar is built once from every category Searx
+#       supports instead of once per category per request.
 # v1.0 - Initial release.
 
 # TO-DO:
@@ -28,6 +34,7 @@
 import logging
 import pyparsing as pp
 
+import dispatcher
 import globals
 
 # Constants.
@@ -54,6 +61,8 @@ default_email = ""
 # Parser primitives.
 # We define them up here because they'll be re-used over and over.
 help_command = pp.CaselessLiteral("help")
+stats_command = pp.Optional(pp.CaselessLiteral("bot") |
+    pp.CaselessLiteral("command")) + pp.CaselessLiteral("stats")
 get_command = pp.Optional(pp.CaselessLiteral("get"))
 top_command = pp.CaselessLiteral("top")
 results_count = (pp.Word(pp.nums) |
@@ -101,6 +110,43 @@ category_science_command = pp.CaselessLiteral("science").setResultsName("categor
 # &categories=videos
 category_science_command = pp.CaselessLiteral("videos").setResultsName("category")
 
+# Compiled grammars.  These are built once, when the module is loaded, instead
+# of every time a request comes in.
+# (list) (search) engines
+list_engines_command = pp.Optional(list_command) + \
+    pp.Optional(search_command) + engines_command
+
+# (get) top <foo> hits for <bar>
+get_request_command = get_command + top_command + results_count + \
+    hitsfor_command + pp.Group(search_terms).setResultsName("searchterms")
+
+# send/e-mail/email/mail (me) (<address>) top <foo> hits for <bar>
+email_results_command = send_command + destination + top_command + \
+    results_count + hitsfor_command + \
+    pp.Group(search_terms).setResultsName("searchterms")
+
+# search <shortcode> (for) <search terms>
+specific_search_command = search_command + shortcut_command + for_command + \
+    pp.Group(search_terms).setResultsName("searchterms")
+
+# list (search) categories
+list_categories_command = list_command + pp.Optional(search_command) + \
+    categories_command
+
+# search <category> (for) (top) (<n>) (hits for) <search terms>
+# The search categories aren't known until the bot has asked Searx what it
+# supports, so the list of categories is a placeholder that gets filled in by
+# update_search_categories().
+search_category_names = pp.Forward()
+search_category_command = search_command + \
+    search_category_names.setResultsName("category") + for_command + \
+    pp.Optional(top_command) + pp.Optional(results_count) + \
+    pp.Optional(hitsfor_command) + \
+    pp.Group(search_terms).setResultsName("searchterms")
+
+# The search categories search_category_names currently matches.
+compiled_search_categories = None
+
 # make_search_term(): Function that takes a string of the form "foo bar baz"
 #   and turns it into a URL encoded string "foo+bar+baz", which is then
 #   returned to the calling method.
@@ -126,6 +172,97 @@ def word_and_number(value):
         # Set a default number of search terms.
         return 10
 
+# update_search_categories(): Utility function that fills in the list of
+#   search categories the category search grammar matches from
+#   globals.search_categories.  Only does any work if the list has changed.
+#   Takes no arguments.
+def update_search_categories():
+    global compiled_search_categories
+
+    if compiled_search_categories == globals.search_categories:
+        return
+    logging.debug("Value of globals.search_categories: %s" % globals.search_categories)
+    if globals.search_categories:
+        search_category_names << pp.oneOf(globals.search_categories,
+            caseless=True)
+    else:
+        search_category_names << pp.NoMatch()
+    compiled_search_categories = list(globals.search_categories)
+
+# help_results(), list_results(), stats_results(), get_request_results(),
+# email_results(), specific_search_results(), list_categories_results(), and
+# search_category_results(): Functions that turn a successfully parsed request
+#   into the tuple of (number of search results, search string, destination)
+#   that the bot works with.  They're shared by the parse_*() functions and
+#   the dispatcher.
+def help_results(parsed_command):
+    return ("help", None, None)
+
+def list_results(parsed_command):
+    return ("list", None, None)
+
+def stats_results(parsed_command):
+    return ("stats", None, None)
+
+def get_request_results(parsed_command):
+    number_of_search_results = word_and_number(parsed_command["count"])
+
+    # Grab the search term.
+    search_term = make_search_term(parsed_command["searchterms"])
+
+    return (number_of_search_results, search_term, "XMPP")
+
+def email_results(parsed_command):
+    number_of_search_results = word_and_number(parsed_command["count"])
+
+    # Grab the search term.
+    search_term = make_search_term(parsed_command["searchterms"])
+
+    # Figure out which e-mail address to use - the default or the supplied
+    # one.  On error, use the default address.
+    if "dest" in list(parsed_command.keys()):
+        destination_address = parsed_command["dest"]
+    else:
+        destination_address = default_email
+    return (number_of_search_results, search_term, destination_address)
+
+def specific_search_results(parsed_command):
+    number_of_search_results = 10
+    engine = parsed_command["shortcode"]
+    searchterms = parsed_command["searchterms"]
+    logging.debug("Value of engine: %s" % engine)
+    logging.debug("Value of searchterms: %s" % searchterms)
+
+    # Check to see if the search engine is enabled.  We do this in a
+    # circuitous fashion because we want either the shortcode or a failure,
+    # while at the same time making it possible for the user to use the
+    # name of the search engine.
+    engine = is_enabled_engine(engine)
+    if not engine:
+        logging.debug("Engine %s matches but is not enabled." % engine)
+        return(0, "", "")
+
+    # Create a search term that includes the shortcode for the search
+    # engine.
+    searchterms.insert(0, engine)
+    searchterms = make_search_term(searchterms)
+
+    logging.debug("Returning number_of_search_results==%d, searchterms==%s, and XMPP." % (number_of_search_results, searchterms))
+    return (number_of_search_results, searchterms, "XMPP")
+
+def list_categories_results(parsed_command):
+    return ("categories", None, None)
+
+def search_category_results(parsed_command):
+    # Extract the specifics.
+    number_of_search_results = word_and_number(parsed_command["count"])
+    search_term = make_search_term(parsed_command["searchterms"])
+    category = parsed_command["category"]
+
+    # Append the search category to the search term.
+    search_term = search_term + "&categories=" + category
+    return (number_of_search_results, search_term, "XMPP")
+
 # parse_help(): Function that matches the word "help" all by itself in an
 #   input string.  Returns "help" for the number of search terms, None for the
 #   search string, and None for the destination e-mail.
@@ -133,7 +270,7 @@ def parse_help(request):
     logging.debug("Entered function parse_help().")
     try:
         parsed_command = help_command.parseString(request)
-        return ("help", None, None)
+        return help_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
@@ -144,11 +281,9 @@ def parse_help(request):
 #   destination e-mail.
 def parse_list(request):
     logging.debug("Entered function parse_list().")
-    command = pp.Optional(list_command) + pp.Optional(search_command)
-    command = command + engines_command
     try:
-        parsed_command = command.parseString(request)
-        return("list", None, None)
+        parsed_command = list_engines_command.parseString(request)
+        return list_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
@@ -160,19 +295,9 @@ def parse_list(request):
 #   XMPP bridge.
 def parse_get_request(request):
     logging.debug("Entered function parse_get_request().")
-    command = get_command + top_command + results_count + hitsfor_command
-    command = command + pp.Group(search_terms).setResultsName("searchterms")
-
-    number_of_search_results = 0
-
     try:
-        parsed_command = command.parseString(request)
-        number_of_search_results = word_and_number(parsed_command["count"])
-
-        # Grab the search term.
-        search_term = make_search_term(parsed_command["searchterms"])
-
-        return (number_of_search_results, search_term, "XMPP")
+        parsed_command = get_request_command.parseString(request)
+        return get_request_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
@@ -183,27 +308,9 @@ def parse_get_request(request):
 #   and an e-mail address.
 def parse_and_email_results(request):
     logging.debug("Entered function parse_and_email_results().")
-    command = send_command + destination + top_command + results_count
-    command = command + hitsfor_command
-    command = command + pp.Group(search_terms).setResultsName("searchterms")
-
-    number_of_search_results = 0
-    destination_address = ""
-
     try:
-        parsed_command = command.parseString(request)
-        number_of_search_results = word_and_number(parsed_command["count"])
-
-        # Grab the search term.
-        search_term = make_search_term(parsed_command["searchterms"])
-
-        # Figure out which e-mail address to use - the default or the supplied
-        # one.  On error, use the default address.
-        if "dest" in list(parsed_command.keys()):
-            destination_address = parsed_command["dest"]
-        else:
-            destination_address = default_email
-        return (number_of_search_results, search_term, destination_address)
+        parsed_command = email_results_command.parseString(request)
+        return email_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
@@ -216,41 +323,13 @@ def parse_and_email_results(request):
 #   requests.
 def parse_specific_search(request):
     logging.debug("Entered function parse_specific_search().")
-    command = search_command + shortcut_command + for_command
-    command = command + pp.Group(search_terms).setResultsName("searchterms")
-
-    number_of_search_results = 10
-    engine = ""
-    searchterms = []
-
     try:
-        parsed_command = command.parseString(request)
-        engine = parsed_command["shortcode"]
-        searchterms = parsed_command["searchterms"]
-        logging.debug("Value of engine: %s" % engine)
-        logging.debug("Value of searchterms: %s" % searchterms)
-
-        # Check to see if the search engine is enabled.  We do this in a
-        # circuitous fashion because we want either the shortcode or a failure,
-        # while at the same time making it possible for the user to use the
-        # name of the search engine.
-        engine = is_enabled_engine(engine)
-        if not engine:
-            logging.debug("Engine %s matches but is not enabled." % engine)
-            return(0, "", "")
-
-        # Create a search term that includes the shortcode for the search
-        # engine.
-        searchterms.insert(0, engine)
-        searchterms = make_search_term(searchterms)
-
+        parsed_command = specific_search_command.parseString(request)
+        return specific_search_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
 
-    logging.debug("Returning number_of_search_results==%d, searchterms==%s, and XMPP." % (number_of_search_results, searchterms))
-    return (number_of_search_results, searchterms, "XMPP")
-
 # is_enabled_engine(): Utility function that scans the list of enabled search
 #   engines and returns the shortcode for the search engine ("!foo") or None.
 def is_enabled_engine(engine):
@@ -272,10 +351,9 @@ def is_enabled_engine(engine):
 #   the destination e-mail.
 def parse_list_categories(request):
     logging.debug("Entered function parse_list_categories().")
-    command = list_command + pp.Optional(search_command) + categories_command
     try:
-        parsed_command = command.parseString(request)
-        return("categories", None, None)
+        parsed_command = list_categories_command.parseString(request)
+        return list_categories_results(parsed_command)
     except pp.ParseException as x:
         logging.info("No match: {0}".format(str(x)))
         return (None, None, None)
@@ -285,56 +363,49 @@ def parse_list_categories(request):
 #   for <foo>."
 def parse_search_category_request(request):
     logging.debug("Entered function parse_search_category_request().")
-    #command = search_command + category_files_command
-    #command = command + for_command + top_command + results_count
-    #command = command + hitsfor_command
-    #command = command + pp.Group(search_terms).setResultsName("searchterms")
-
-    command = None
-    number_of_search_results = 10
-    category = ""
-    searchterms = []
-
-    logging.debug("Value of globals.search_categories: %s" % globals.search_categories)
+    update_search_categories()
+    try:
+        parsed_command = search_category_command.parseString(request)
+        return search_category_results(parsed_command)
+    except pp.ParseException as x:
+        # Trap case: No categories matched.
+        logging.info("No categories matched.")
+        return (None, None, None)
 
-    for i in globals.search_categories:
-        logging.debug("Trying category %s." % i)
-        command = search_command
-        category_command = pp.CaselessLiteral(i).setResultsName("category")
-
-        # Assemble the search command custom for this iteration of the loop.
-        # The process is unrolled to make it easier to understand, and thus
-        # maintain later.
-        command = command + category_command
-        command = command + for_command
-        # There has to be a better way to do this.  I haven't figured it out
-        # yet, though.
-        command = command + pp.Optional(top_command)
-        command = command + pp.Optional(results_count)
-        command = command + pp.Optional(hitsfor_command)
-        command = command + pp.Group(search_terms).setResultsName("searchterms")
-
-        # See if the newly assembled command matches.
-        try:
-            parsed_command = command.parseString(request)
-
-            # Extract the specifics.
-            number_of_search_results = word_and_number(parsed_command["count"])
-            search_term = make_search_term(parsed_command["searchterms"])
-            category = parsed_command["category"]
-
-            # Append the search category to the search term.
-            search_term = search_term + "&categories=" + i
-
-            # Yup.
-            return (number_of_search_results, search_term, "XMPP")
-        except pp.ParseException as x:
-            # Nope.
-            logging.debug("Category %s didn't work." % i)
-
-    # Trap case: No categories matched.
-    logging.info("No categories matched.")
-    return (None, None, None)
+# usable(): Utility function that wraps one of the *_results() functions for
+#   the dispatcher.  Some requests parse but aren't usable (e.g., a search on
+#   an engine that isn't enabled), in which case the dispatcher has to move on
+#   to the next grammar.  Takes two arguments, the results function and
+#   whether or not the destination has to be an e-mail address.  Returns a
+#   function which returns the results or None.
+def usable(results_function, needs_email_address=False):
+    def action(parsed_command):
+        results = results_function(parsed_command)
+        if not results[0]:
+            return None
+        if needs_email_address and "@" not in results[2]:
+            return None
+        return results
+    return action
+
+# Compile every grammar into the dispatcher, in the order they've always been
+# tried in, along with the words that a matching request can start with.
+search_requests = dispatcher.Dispatcher()
+search_requests.register(["help"], help_command, help_results)
+search_requests.register(["list", "search", "engines"], list_engines_command,
+    list_results)
+search_requests.register(["get", "top"], get_request_command,
+    usable(get_request_results))
+search_requests.register(["send", "e-mail", "email", "mail"],
+    email_results_command, usable(email_results, True))
+search_requests.register(["search"], specific_search_command,
+    usable(specific_search_results))
+search_requests.register(["list"], list_categories_command,
+    list_categories_results)
+search_requests.register(["search"], search_category_command,
+    usable(search_category_results))
+search_requests.register(["stats", "bot", "command"], stats_command,
+    stats_results)
 
 # parse_search_request(): Takes a string and figures out what kind of search
 #   request the user wants.  Requests are something along the form of "top ten
@@ -347,7 +418,6 @@ def parse_search_request(search_request):
     number_of_search_results = 0
     search_term = ""
     email_address = ""
-    engine = ""
 
     # Clean up the search request.
     search_request = search_request.strip()
@@ -362,49 +432,15 @@ def parse_search_request(search_request):
         logging.debug("Got empty search request.")
         return (number_of_search_results, search_term, email_address)
 
-    # Attempt to parse a request for online help.
-    (number_of_search_results, search_term, email_address) = parse_help(search_request)
-    if number_of_search_results == "help":
-        logging.info("The user is asking for online help.")
-        return ("help", None, None)
-
-    # Attempt to parse a "list search engines" request.
-    (number_of_search_results, search_term, email_address) = parse_list(search_request)
-    if number_of_search_results == "list":
-        logging.info("The user has requested a list of search engines.")
-        return ("list", None, None)
-
-    # Attempt to parse a "get" request.
-    (number_of_search_results, search_term, email_address) = parse_get_request(search_request)
-    if number_of_search_results and (email_address == "XMPP"):
-        logging.info("The user has sent the search term " + str(search_term))
-        return (number_of_search_results, search_term, "XMPP")
-
-    # Attempt to parse an "email results" request.
-    (number_of_search_results, search_term, email_address) = parse_and_email_results(search_request)
-    if number_of_search_results and ("@" in email_address):
-        logging.info("The user has requested that search results for " + str(search_term) + " be e-mailed to " + email_address + ".")
-        return (number_of_search_results, search_term, email_address)
+    # Make sure the category search knows about every category Searx has.
+    update_search_categories()
 
-    # Attempt to parse a search for a specific engine.  If it works, prepend
-    # the string "!<search shortcode>" so that Searx knows to search on one
-    # search engine only.
-    (number_of_search_results, search_term, email_address) = parse_specific_search(search_request)
-    if number_of_search_results and (email_address == "XMPP"):
-        logging.info("The user has requested a specific search: " + str(search_term))
-        return (number_of_search_results, search_term, "XMPP")
-
-    # Attempt to parse a "list categories" request.
-    (number_of_search_results, search_term, email_address) = parse_list_categories(search_request)
-    if number_of_search_results == "categories":
-        logging.info("The user has requested a list of search categories.")
-        return ("categories", None, None)
-
-    # Attempt to parse a "search <category> for" search request.
-    (number_of_search_results, search_term, email_address) = parse_search_category_request(search_request)
-    if number_of_search_results and (email_address == "XMPP"):
-        logging.info("The user has sent the search term " + str(search_term))
-        return (number_of_search_results, search_term, "XMPP")
+    # Run the request through the dispatcher.  Only the grammars that can
+    # start with the first word of the request get tried.
+    parsed_request = search_requests.dispatch(search_request)
+    if parsed_request:
+        logging.info("Parsed search request: " + str(parsed_request))
+        return parsed_request
 
     # Fall-through - this should happen only if nothing at all matches.
     logging.info("Fell all the way through in parse_search_request().  Telling the user I didn't understand what they said.")
@@ -15,6 +15,9 @@
 
 # License: GPLv3
 
+# v5.4 - Every request is timed and its outbound HTTP requests counted, per
+#       kind of request.  The totals are kept in a metrics file and can be
+#       asked for with the "stats" command.
 # v5.3 - Added some new commands to the parser to implement searching in
 #       specific Searx categories.
 #       - Added code to pull the list of known categories from Searx.
@@ -103,6 +106,7 @@ import sys
 import time
 
 import globals
+import instrumentation
 import parser
 
 # Constants.
@@ -149,6 +153,10 @@ message = ""
 user_text = None
 user_acknowledged = None
 
+# Path to the file per-command statistics are kept in.  Defaults to
+# <bot_name>.metrics.
+metrics_file = ""
+
 # Functions.
 # set_loglevel(): Turn a string into a numerical value which Python's logging
 #   module can use because.
@@ -182,6 +190,8 @@ def online_help():
     reply = reply + globals.bot_name + ", (list (search)) engines\n\n"
     reply = reply + "I can run searches using specific search engines:\n\n"
     reply = reply + globals.bot_name + ", search <search engine shortcode> for <search request...>\n\n"
+    reply = reply + "I can tell you how long each kind of request takes me:\n\n"
+    reply = reply + globals.bot_name + ", (bot/command) stats\n\n"
     globals.send_message_to_user(globals.server, reply)
 
     # Now let's handle the "search categories" case.
@@ -323,6 +333,16 @@ except:
     # Nothing to do here, it's an optional configuration setting.
     pass
 
+# Get the path to the file per-command statistics are kept in if it's been
+# set.
+try:
+    metrics_file = config.get("DEFAULT", "metrics_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+if not metrics_file:
+    metrics_file = globals.bot_name + ".metrics"
+
 # Set the loglevel from the override on the command line.
 if args.loglevel:
     loglevel = set_loglevel(args.loglevel.lower())
@@ -354,6 +374,10 @@ if user_text:
     logger.debug("User-defined help text: " + user_text)
 if user_acknowledged:
     logger.debug("User-defined command acknowledgement text: " + user_acknowledged)
+logger.debug("Metrics file: " + metrics_file)
+
+# Load the per-command statistics from the last time the bot ran.
+instrumentation.configure(metrics_file)
 
 # Try to contact the XMPP bridge.  Keep trying until you reach it or the
 # system shuts down.
@@ -397,6 +421,10 @@ while True:
     destination_email_address = ""
     message = ""
 
+    # Most requests go straight back to the top of the loop when they're
+    # done, so this is where measuring the last one ends.
+    instrumentation.finish()
+
     # Check the message queue for search requests.
     try:
         logger.debug("Contacting message queue: " + message_queue)
@@ -429,6 +457,16 @@ while True:
         if destination_email_address == "XMPP":
             logger.debug("Sending search results back via XMPP.")
 
+        # Measure what it costs to carry out the request.  Searches are
+        # measured by where the results are going.
+        if isinstance(number_of_results, str):
+            instrumentation.start(number_of_results.lower())
+        elif search:
+            if destination_email_address == "XMPP":
+                instrumentation.start("search")
+            else:
+                instrumentation.start("e-mail search")
+
         # MOOF MOOF MOOF
         if destination_email_address:
             logger.debug("E-mail address to send search results to: " +
@@ -450,6 +488,14 @@ while True:
             globals.send_message_to_user(globals.server, reply)
             continue
 
+        # Test to see if the user requested the bot's own statistics.  If so,
+        # send them back to the user and restart the loop.
+        if (str(number_of_results).lower() == "stats"):
+            reply = "This is what carrying out each kind of request has cost me so far:\n\n"
+            reply = reply + instrumentation.report()
+            globals.send_message_to_user(globals.server, reply)
+            continue
+
         # Test to see if the user requested a list of search categories.  If
         # so, assemble a response, send it back to the user, and restart the
         # loop.
@@ -495,6 +541,7 @@ while True:
         # on with our lives.
         if destination_email_address == "XMPP":
             globals.send_message_to_user(globals.server, message)
+            instrumentation.finish()
             time.sleep(float(polling_time))
             continue
 
@@ -527,6 +574,7 @@ while True:
         logger.info("Message queue " + globals.bot_name + " does not exist.")
 
     # Sleep for the configured amount of time.
+    instrumentation.finish()
     time.sleep(float(polling_time))
 
 # Fin.